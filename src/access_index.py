@@ -0,0 +1,293 @@
+"""
+Point-in-time access index over membership validity intervals.
+A member can hold several roles: stacked renewals, overlapping memberships,
+or roles separated by a pause. Their validity is the union of the role
+intervals, merged per member into a sorted list of disjoint intervals. A
+centred interval tree over all members answers "who may enter at T", and
+sorted start and end arrays answer "how many are valid at T / on day D"
+with a couple of binary searches.
+
+Intervals are closed: a role is valid from StartDate through EndDate.
+
+Usage (front desk, against the Cardskipper mock):
+    python access_index.py who-at 2025-03-01T18:00:00
+    python access_index.py ends ana.novak@example.com
+    python access_index.py count-on 2025-03-01
+"""
+
+import argparse
+import bisect
+import sys
+import time
+from datetime import datetime, timedelta
+
+from expiry import DATE_FORMAT, parse_date
+
+# Roles that follow each other within this gap are one continuous interval
+CONTIGUOUS = timedelta(seconds=1)
+
+
+def member_roles(member, organisation_id=None):
+    """Return (organisation, role) pairs of a raw Cardskipper member.
+
+    Organisations.Organisation and Roles.Role hold a dict for a single
+    entry and a list for several.
+    """
+    organisations = member.get("Organisations", {}).get("Organisation", [])
+    if isinstance(organisations, dict):
+        organisations = [organisations]
+
+    pairs = []
+    for organisation in organisations:
+        if organisation_id is not None and str(organisation.get("Id")) != str(organisation_id):
+            continue
+        roles = organisation.get("Roles", {}).get("Role", [])
+        for role in [roles] if isinstance(roles, dict) else roles:
+            pairs.append((organisation, role))
+    return pairs
+
+
+def latest_role(member, organisation_id=None):
+    """Return the (organisation, role) pair that ends last, or (None, None)."""
+    pairs = member_roles(member, organisation_id)
+    if not pairs:
+        return None, None
+    return max(pairs, key=lambda pair: pair[1].get("EndDate") or "")
+
+
+def merge_intervals(intervals):
+    """Return the union of (start, end) intervals as a sorted list of disjoint intervals."""
+    merged = []
+    for start, end in sorted(i for i in intervals if i[0] is not None and i[1] is not None and i[0] <= i[1]):
+        if merged and start <= merged[-1][1] + CONTIGUOUS:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def member_intervals(member, organisation_id=None):
+    """Merged validity intervals of a raw Cardskipper member."""
+    return merge_intervals(
+        (parse_date(role.get("StartDate")), parse_date(role.get("EndDate")))
+        for _, role in member_roles(member, organisation_id)
+    )
+
+
+class _Node:
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+
+def _build_tree(intervals):
+    """Build a centred interval tree over (start, end, email) triples."""
+    if not intervals:
+        return None
+
+    points = sorted(p for start, end, _ in intervals for p in (start, end))
+    node = _Node()
+    node.center = points[len(points) // 2]
+
+    left, right, here = [], [], []
+    for interval in intervals:
+        if interval[1] < node.center:
+            left.append(interval)
+        elif interval[0] > node.center:
+            right.append(interval)
+        else:
+            here.append(interval)
+
+    node.by_start = sorted(here, key=lambda i: i[0])
+    node.by_end = sorted(here, key=lambda i: i[1], reverse=True)
+    node.left = _build_tree(left)
+    node.right = _build_tree(right)
+    return node
+
+
+class AccessIndex:
+    """Validity intervals of every member, queryable at any point in time.
+
+    Updates only touch the member's own interval list; the global
+    structures are rebuilt on the next query that needs them.
+    """
+    def __init__(self):
+        self._members = {}
+        self._tree = None
+        self._starts = None
+        self._ends = None
+        self._short_gaps = None
+
+    @classmethod
+    def from_members(cls, members, organisation_id=None):
+        """Build an index from raw Cardskipper members, keyed by email."""
+        index = cls()
+        for member in members:
+            email = member.get("ContactInfo", {}).get("EMail")
+            intervals = member_intervals(member, organisation_id)
+            if email and intervals:
+                # A member listed twice keeps the union of both records
+                index._members[email] = merge_intervals(index._members.get(email, []) + intervals)
+        return index
+
+    def __len__(self):
+        return len(self._members)
+
+    def set_member(self, email, intervals):
+        """Replace a member's intervals; an empty list removes the member."""
+        merged = merge_intervals(intervals)
+        if merged:
+            self._members[email] = merged
+        else:
+            self._members.pop(email, None)
+        self._tree = self._starts = self._ends = self._short_gaps = None
+
+    def intervals(self, email):
+        return list(self._members.get(email, ()))
+
+    def _covering(self, email, at):
+        intervals = self._members.get(email)
+        if not intervals:
+            return None
+        i = bisect.bisect_right(intervals, (at, datetime.max)) - 1
+        if i >= 0 and intervals[i][1] >= at:
+            return intervals[i]
+        return None
+
+    def is_valid(self, email, at=None):
+        return self._covering(email, at or datetime.now()) is not None
+
+    def access_ends(self, email, at=None):
+        """When the member's continuous access that covers at ends; None if not valid at at."""
+        interval = self._covering(email, at or datetime.now())
+        return interval[1] if interval else None
+
+    def next_window(self, email, at=None):
+        """The interval covering at, or else the next one to start; None if there is none."""
+        at = at or datetime.now()
+        for interval in self._members.get(email, ()):
+            if interval[1] >= at:
+                return interval
+        return None
+
+    def _ensure_built(self):
+        if self._starts is not None:
+            return
+        triples = [(start, end, email) for email, intervals in self._members.items() for start, end in intervals]
+        self._tree = _build_tree(triples)
+        self._starts = sorted(start for start, _, _ in triples)
+        self._ends = sorted(end for _, end, _ in triples)
+        # Gaps shorter than a day are where one member can have two
+        # intervals on the same day; count_on corrects for them
+        self._short_gaps = sorted(
+            (a[1], b[0])
+            for intervals in self._members.values()
+            for a, b in zip(intervals, intervals[1:])
+            if b[0] - a[1] < timedelta(days=1)
+        )
+
+    def who_at(self, at=None):
+        """Return the emails of every member valid at at; the time taken grows with how many there are."""
+        at = at or datetime.now()
+        self._ensure_built()
+        found = []
+        node = self._tree
+        while node is not None:
+            if at < node.center:
+                for start, _, email in node.by_start:
+                    if start > at:
+                        break
+                    found.append(email)
+                node = node.left
+            elif at > node.center:
+                for _, end, email in node.by_end:
+                    if end < at:
+                        break
+                    found.append(email)
+                node = node.right
+            else:
+                found.extend(email for _, _, email in node.by_start)
+                break
+        return found
+
+    def count_at(self, at=None):
+        """Number of members valid at at."""
+        at = at or datetime.now()
+        self._ensure_built()
+        # A member's intervals are disjoint, so at most one of them covers at
+        return bisect.bisect_right(self._starts, at) - bisect.bisect_left(self._ends, at)
+
+    def count_on(self, day):
+        """Number of members valid at any time on the given date."""
+        start = datetime(day.year, day.month, day.day)
+        end = start + timedelta(days=1) - timedelta(microseconds=1)
+        self._ensure_built()
+
+        overlapping = bisect.bisect_right(self._starts, end) - bisect.bisect_left(self._ends, start)
+        # Two intervals of one member both touch the day when the gap
+        # between them lies inside it
+        gaps = self._short_gaps
+        duplicates = sum(
+            1 for gap_start, gap_end in gaps[bisect.bisect_left(gaps, (start,)):bisect.bisect_right(gaps, (end,))]
+            if gap_start >= start and gap_end <= end
+        )
+        return overlapping - duplicates
+
+
+def format_date(value):
+    return value.strftime(DATE_FORMAT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-file", help="Cardskipper mock data file")
+    parser.add_argument("--organisation-id", help="only roles in this organisation")
+    commands = parser.add_subparsers(dest="command", required=True)
+    who_at = commands.add_parser("who-at", help="members who may enter at a time")
+    who_at.add_argument("at", nargs="?", help="%%Y-%%m-%%dT%%H:%%M:%%S, default now")
+    ends = commands.add_parser("ends", help="when a member's current access ends")
+    ends.add_argument("email")
+    ends.add_argument("--at", help="%%Y-%%m-%%dT%%H:%%M:%%S, default now")
+    count_on = commands.add_parser("count-on", help="number of members valid on a date")
+    count_on.add_argument("day", help="%%Y-%%m-%%d")
+    args = parser.parse_args(argv)
+
+    # Imported here so integration can import this module
+    import integration
+
+    integration.init()
+    cardskipper = integration.MockCardskipper(args.data_file or integration.CARDSKIPPER_MEMBERS_FILE)
+    index = cardskipper.access_index(args.organisation_id)
+    cardskipper.close()
+    index._ensure_built()
+
+    started = time.perf_counter()
+    if args.command == "who-at":
+        at = parse_date(args.at) if args.at else datetime.now()
+        emails = index.who_at(at)
+        elapsed = time.perf_counter() - started
+        for email in sorted(emails):
+            print(email)
+        print(f"{len(emails)} of {len(index)} members may enter at {format_date(at)}")
+    elif args.command == "ends":
+        at = parse_date(args.at) if args.at else datetime.now()
+        end = index.access_ends(args.email, at)
+        elapsed = time.perf_counter() - started
+        if end is not None:
+            print(f"{args.email}: access ends {format_date(end)}")
+        else:
+            window = index.next_window(args.email, at)
+            if window is not None:
+                print(f"{args.email}: no access now; next from {format_date(window[0])} to {format_date(window[1])}")
+            else:
+                print(f"{args.email}: no access at {format_date(at)}")
+    else:
+        day = datetime.strptime(args.day, "%Y-%m-%d")
+        count = index.count_on(day)
+        elapsed = time.perf_counter() - started
+        print(f"{count} of {len(index)} members valid on {args.day}")
+    print(f"Answered in {elapsed * 1000:.3f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Resumable backfill of a site: the first push of every member to IVMS.
+Active members are split into chunks by email when a run starts, and the
+chunks are stored in the integration database. A chunk's members are
+written to the database, and the chunk marked done, only after its updates
+reached IVMS (or a device backlog), in one transaction. A run that stops
+halfway is resumed at the first chunk that is not done; chunks run in
+parallel and progress is logged with an ETA.
+
+Usage:
+    python backfill.py --chunk-size 500 --workers 4
+    python backfill.py --restart
+"""
+
+import argparse
+import bisect
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from sync_plan import plan_changes, suppress_redundant_updates
+
+logger = logging.getLogger("MockIntegrationFinal.backfill")
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_WORKERS = 4
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            total_members INTEGER,
+            chunk_size INTEGER
+        )
+    """)
+    # A chunk holds the members from its first_email up to the next chunk's
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_chunks (
+            run_id INTEGER NOT NULL,
+            chunk_no INTEGER NOT NULL,
+            first_email TEXT NOT NULL,
+            members INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            pushed INTEGER DEFAULT 0,
+            queued INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            unmatched INTEGER DEFAULT 0,
+            finished_at TEXT,
+            PRIMARY KEY (run_id, chunk_no)
+        )
+    """)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Backfill:
+    """Checkpointed first push of all members of a MockSyncService's site."""
+    def __init__(self, service, chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS, clock=time.monotonic):
+        self.service = service
+        self.db = service.db
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.clock = clock
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self.db.writer.run(ensure_schema)
+
+    def stop(self):
+        """Let running chunks finish and start no new ones."""
+        self.stop_event.set()
+
+    def _current_run(self):
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT id, total_members FROM backfill_runs WHERE status = 'running' ORDER BY id DESC LIMIT 1")
+        return cursor.fetchone()
+
+    def _start_run(self, members):
+        emails = sorted(member["email"] for member in members)
+        chunks = [
+            (number, emails[start], len(emails[start:start + self.chunk_size]))
+            for number, start in enumerate(range(0, len(emails), self.chunk_size))
+        ]
+
+        def create(conn):
+            run_id = conn.execute(
+                "INSERT INTO backfill_runs (status, started_at, total_members, chunk_size) VALUES ('running', ?, ?, ?)",
+                (datetime.now().strftime(DATE_FORMAT), len(emails), self.chunk_size)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO backfill_chunks (run_id, chunk_no, first_email, members) VALUES (?, ?, ?, ?)",
+                [(run_id,) + chunk for chunk in chunks]
+            )
+            return run_id
+
+        run_id = self.db.writer.run(create)
+        logger.info("Backfill run %s started: %s members in %s chunks", run_id, len(emails), len(chunks))
+        return run_id, len(emails)
+
+    def abandon(self):
+        """Mark an unfinished run as abandoned, so the next run starts from scratch."""
+        return self.db.writer.execute(
+            "UPDATE backfill_runs SET status = 'abandoned', finished_at = ? WHERE status = 'running'",
+            (datetime.now().strftime(DATE_FORMAT),)
+        )
+
+    def run(self, progress=None):
+        """Run or resume the backfill; returns a summary dict.
+
+        progress(summary) is called after every chunk.
+        """
+        self.service.refresh_mirror()
+        members = self.service.cardskipper.get_active_members()
+
+        current = self._current_run()
+        if current:
+            run_id, total = current
+            logger.info("Resuming backfill run %s", run_id)
+        else:
+            run_id, total = self._start_run(members)
+
+        cursor = self.db.conn.cursor()
+        cursor.execute(
+            "SELECT chunk_no, first_email, status, members FROM backfill_chunks WHERE run_id = ? ORDER BY chunk_no",
+            (run_id,)
+        )
+        chunks = cursor.fetchall()
+        first_emails = [first_email for _, first_email, _, _ in chunks]
+
+        # Members are assigned to chunks by email range, so members that
+        # joined since the run started land in one of the chunks too
+        by_chunk = {}
+        for member in members:
+            number = max(0, bisect.bisect_right(first_emails, member["email"]) - 1)
+            by_chunk.setdefault(number, []).append(member)
+
+        pending = [number for number, _, status, _ in chunks if status != "done"]
+        summary = {
+            "run_id": run_id,
+            "chunks": len(chunks),
+            "chunks_done": len(chunks) - len(pending),
+            "members": total,
+            "members_done": sum(count for _, _, status, count in chunks if status == "done"),
+            "pushed": 0, "queued": 0, "failed": 0, "unmatched": 0,
+            "eta_seconds": None,
+            "finished": False,
+        }
+        if pending and summary["chunks_done"]:
+            logger.info("Skipping %s chunks finished before", summary["chunks_done"])
+
+        db_members = self.db.get_all_members()
+        claimed = {m["ivms_employee_no"] for m in db_members.values() if m["ivms_employee_no"]}
+        matcher = self.service.build_matcher(claimed)
+        started = self.clock()
+        done_at_start = summary["members_done"]
+
+        def process(number):
+            if self.stop_event.is_set():
+                return
+            try:
+                result = self._process_chunk(run_id, number, by_chunk.get(number, []), db_members, matcher)
+            except Exception:
+                # Chunks already running finish; the failed one stays pending
+                self.stop_event.set()
+                raise
+            with self._lock:
+                for key in ("pushed", "queued", "failed", "unmatched"):
+                    summary[key] += result[key]
+                summary["chunks_done"] += 1
+                summary["members_done"] += chunks[number][3]
+                # The ETA only counts work done in this session
+                rate = (summary["members_done"] - done_at_start) / max(self.clock() - started, 1e-9)
+                remaining = max(0, summary["members"] - summary["members_done"])
+                summary["eta_seconds"] = remaining / rate if rate else None
+                logger.info(
+                    "Backfill chunk %s/%s done: %.0f%% of members, %.0f members/s, ETA %s",
+                    summary["chunks_done"], summary["chunks"],
+                    100 * summary["members_done"] / max(summary["members"], 1), rate,
+                    format_duration(summary["eta_seconds"] or 0)
+                )
+                if progress:
+                    progress(dict(summary))
+
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backfill")
+        chunks_left = iter(pending)
+        running = set()
+        try:
+            # Chunks are handed out as workers free up, so a stop only has
+            # to wait for the ones already running
+            while True:
+                while len(running) < self.workers and not self.stop_event.is_set():
+                    number = next(chunks_left, None)
+                    if number is None:
+                        break
+                    running.add(pool.submit(process, number))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        except BaseException:
+            # A failed chunk or Ctrl-C: the running chunks finish, no new ones start
+            self.stop_event.set()
+            raise
+        finally:
+            # An error propagates once the running chunks are done
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        if summary["chunks_done"] == summary["chunks"]:
+            self.db.writer.execute(
+                "UPDATE backfill_runs SET status = 'done', finished_at = ? WHERE id = ?",
+                (datetime.now().strftime(DATE_FORMAT), run_id)
+            )
+            summary["finished"] = True
+            summary["eta_seconds"] = 0
+            logger.info("Backfill run %s finished in %s", run_id, format_duration(self.clock() - started))
+        return summary
+
+    def _process_chunk(self, run_id, number, members, db_members, matcher):
+        """Push one chunk to IVMS, then commit its members and checkpoint together."""
+        def match_member(member):
+            # The matcher is shared between chunks
+            with self._lock:
+                match = matcher.match(member)
+                if match and not match.needs_review:
+                    matcher.claim(match.employee_no)
+            return match
+
+        chunk_db_members = {m["email"]: db_members[m["email"]] for m in members if m["email"] in db_members}
+        changes = plan_changes(members, chunk_db_members, match_member)
+
+        # Users that already have the right validity on IVMS need no write
+        device_state = self.db.get_mirror_validity(u["ivms_employee_no"] for u in changes["updates"])
+        updates, _ = suppress_redundant_updates(changes["updates"], device_state)
+        results = self.service.router.push_updates(updates)
+
+        counts = {
+            "pushed": sum(1 for r in results if not r["failed"] and not r["queued"]),
+            "queued": sum(1 for r in results if r["queued"]),
+            "failed": sum(1 for r in results if r["failed"]),
+            "unmatched": len(changes["unmatched"]),
+        }
+        # Queued updates reach the device when its backlog is replayed
+        delivered = [u for u, r in zip(updates, results) if r["applied"] or r["queued"]]
+
+        def checkpoint(conn):
+            self.db.save_match_reviews(conn, changes["review"])
+            conn.executemany(
+                "UPDATE ivms_mirror SET begin_time = ?, end_time = ?, enable = 1 WHERE employee_no = ?",
+                [(u["start_date"], u["end_date"], u["ivms_employee_no"]) for u in delivered]
+            )
+            conn.execute("""
+                UPDATE backfill_chunks
+                SET status = 'done', pushed = ?, queued = ?, failed = ?, unmatched = ?, finished_at = ?
+                WHERE run_id = ? AND chunk_no = ?
+            """, (
+                counts["pushed"], counts["queued"], counts["failed"], counts["unmatched"],
+                datetime.now().strftime(DATE_FORMAT), run_id, number
+            ))
+
+        # Members whose update was rejected are left out, so the regular sync retries them
+        failed = {u["email"] for u, r in zip(updates, results) if r["failed"]}
+        writes = [w for w in changes["writes"] if w[0]["email"] not in failed]
+        if not self.db.update_members(writes, then=checkpoint):
+            raise RuntimeError(f"Could not save backfill chunk {number}")
+
+        with self._lock:
+            for member, ivms_employee_no, match in writes:
+                self.service.expiry.schedule(member["email"], member["end_date"], ivms_employee_no)
+        return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="chunks processed in parallel")
+    parser.add_argument("--restart", action="store_true", help="abandon an unfinished run and start over")
+    args = parser.parse_args(argv)
+
+    # Imported here so the module can be used without the mocks' setup
+    import integration
+
+    integration.init()
+    cardskipper = integration.MockCardskipper(integration.CARDSKIPPER_MEMBERS_FILE)
+    ivms = integration.MockIVMS(integration.IVMS_USERS_FILE)
+    db = integration.MockDatabase(integration.DB_FILE)
+    service = integration.MockSyncService(cardskipper, ivms, db)
+    backfill = Backfill(service, args.chunk_size, args.workers)
+    try:
+        if args.restart and backfill.abandon():
+            print("Unfinished backfill abandoned")
+        summary = backfill.run()
+        print(f"Backfill run {summary['run_id']}: {summary['chunks_done']}/{summary['chunks']} chunks, "
+              f"{summary['pushed']} pushed, {summary['queued']} queued, {summary['failed']} failed, "
+              f"{summary['unmatched']} unmatched")
+    except KeyboardInterrupt:
+        backfill.stop()
+        print("Interrupted; run again to resume")
+    finally:
+        service.close()
+        cardskipper.close()
+        ivms.close()
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Cardskipper to IVMS integration.
+Each benchmark builds its own synthetic data in a temporary directory.
+
+Usage:
+    python benchmark.py sharding --members 200000 --shards 1 2 4
+    python benchmark.py loading --members 200000
+    python benchmark.py startup --budget-ms 100
+    python benchmark.py storage --users 100000 --updates 100
+    python benchmark.py cardskipper --members 100000 --page-size 1000
+    python benchmark.py pacing --updates 5000 --device-capacity 800
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+
+def generate_members(count, seed=42):
+    """Generate simplified Cardskipper members (as returned by get_active_members)."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    members = []
+    for i in range(count):
+        end_date = now + timedelta(days=rng.randint(1, 365))
+        members.append({
+            "organization_member_id": str(100000 + i),
+            "first_name": f"First{i}",
+            "last_name": f"Last{i}",
+            "email": f"member{i}@example.com",
+            "phone": f"+3867{i:07d}",
+            "member_code": f"{i:06x}",
+            "start_date": (now - timedelta(days=rng.randint(1, 365))).strftime("%Y-%m-%dT%H:%M:%S"),
+            "end_date": end_date.strftime("%Y-%m-%dT%H:%M:%S"),
+            "role_id": "457",
+            "role_name": "24/7"
+        })
+    return members
+
+
+def generate_ivms_users(members):
+    """Generate an IVMS user for every member."""
+    return [
+        {
+            "employeeNo": f"{i:08d}",
+            "name": f"{m['first_name']} {m['last_name']}",
+            "gender": "male",
+            "email": m["email"],
+            "phoneNo": m["phone"],
+            "Valid": {"enable": True, "beginTime": m["start_date"], "endTime": m["end_date"]}
+        }
+        for i, m in enumerate(members)
+    ]
+
+
+class StaticCardskipper:
+    """Cardskipper stand-in returning a fixed member list."""
+    def __init__(self, members):
+        self.members = members
+
+    def get_active_members(self):
+        return self.members
+
+
+def bench_sharding(args):
+    """Time change planning for a steady-state cycle at different shard counts."""
+    from integration import MockDatabase, MockIVMS, MockSyncService
+
+    workdir = tempfile.mkdtemp(prefix="bench_sharding_")
+    members = generate_members(args.members)
+    ivms = MockIVMS(os.path.join(workdir, "ivms.json"))
+    ivms.store.replace(generate_ivms_users(members))
+
+    # Store every member as already synced, then renew a share of them
+    db = MockDatabase(os.path.join(workdir, "bench.db"))
+    db.update_members([(m, f"{i:08d}", None) for i, m in enumerate(members)])
+    rng = random.Random(1)
+    for member in rng.sample(members, int(len(members) * args.changed)):
+        member["end_date"] = (datetime.now() + timedelta(days=400)).strftime("%Y-%m-%dT%H:%M:%S")
+
+    print(f"Planning {len(members)} members ({args.changed:.0%} changed), {os.cpu_count()} CPU(s) available")
+    baseline = None
+    for shards in args.shards:
+        service = MockSyncService(StaticCardskipper(members), ivms, db, shards=shards)
+        try:
+            plan = service.plan_in_shards if shards > 1 else service.plan
+            # Warm up the worker pool outside the timed run
+            plan(members[:shards])
+            started = time.perf_counter()
+            changes = plan(members)
+            elapsed = time.perf_counter() - started
+        finally:
+            service.close()
+
+        baseline = baseline or elapsed
+        print(
+            f"  shards={shards:<3} {elapsed:8.2f} s  {len(members) / elapsed:10.0f} members/s  "
+            f"speedup {baseline / elapsed:4.2f}x  ({len(changes['updates'])} updates)"
+        )
+
+    db.close()
+
+
+def generate_raw_members(count, seed=42):
+    """Generate raw Cardskipper members as stored in the JSON export."""
+    return [
+        {
+            "OrganisationMemberId": m["organization_member_id"],
+            "Firstname": m["first_name"],
+            "Lastname": m["last_name"],
+            "MemberCode": m["member_code"],
+            "ContactInfo": {"EMail": m["email"], "CellPhone1": m["phone"]},
+            "Organisations": {"Organisation": {"Id": 123, "Roles": {"Role": {
+                "Id": int(m["role_id"]), "Name": m["role_name"],
+                "StartDate": m["start_date"], "EndDate": m["end_date"]
+            }}}}
+        }
+        for m in generate_members(count, seed)
+    ]
+
+
+def bench_loading(args):
+    """Compare time and peak memory of loading the active members from a JSON export."""
+    from integration import MockCardskipper
+
+    workdir = tempfile.mkdtemp(prefix="bench_loading_")
+    data_file = os.path.join(workdir, "members.json")
+    with open(data_file, "w") as f:
+        json.dump({"members": generate_raw_members(args.members)}, f, indent=2)
+    print(f"{args.members} members, {os.path.getsize(data_file) / 2**20:.1f} MiB on disk")
+
+    def whole_document():
+        # The previous approach: parse the file, then build the simplified list
+        cardskipper = MockCardskipper(data_file)
+        with open(data_file) as f:
+            cardskipper.store._members = json.load(f)["members"]
+        return cardskipper.get_active_members()
+
+    runs = [
+        ("json.load", whole_document),
+        ("streaming", lambda: MockCardskipper(data_file).get_active_members()),
+        ("streaming+mmap", lambda: MockCardskipper(data_file, use_mmap=True).get_active_members()),
+    ]
+    for name, load in runs:
+        tracemalloc.start()
+        started = time.perf_counter()
+        active = load()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  {name:<15} {elapsed:7.2f} s  peak {peak / 2**20:8.1f} MiB  ({len(active)} active)")
+        del active
+
+
+def bench_storage(args):
+    """Compare the JSON and SQLite mock backends: opening, paging and single-user updates."""
+    from integration import MockIVMS
+
+    workdir = tempfile.mkdtemp(prefix="bench_storage_")
+    users = generate_ivms_users(generate_members(args.users))
+    source = MockIVMS(os.path.join(workdir, "source.json"), storage="json")
+    source.store.replace(users)
+    print(f"{args.users} IVMS users, {os.path.getsize(source.data_file) / 2**20:.1f} MiB as JSON")
+
+    rng = random.Random(7)
+    targets = [user["employeeNo"] for user in rng.sample(users, min(args.updates, len(users)))]
+    for storage in ("json", "sqlite"):
+        data_file = os.path.join(workdir, f"ivms_{storage}.json")
+        source.store.export_json(data_file)
+        if storage == "sqlite":
+            # The first open imports the JSON file; time a later open
+            MockIVMS(data_file, storage=storage).close()
+
+        started = time.perf_counter()
+        ivms = MockIVMS(data_file, storage=storage)
+        opened = time.perf_counter() - started
+
+        started = time.perf_counter()
+        position = 0
+        while True:
+            page = ivms.search_users("1", position, 100)
+            position += page["numOfMatches"]
+            if page["responseStatusStrg"] != "MORE":
+                break
+        paged = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for employee_no in targets:
+            ivms.update_user_validity(employee_no, "2025-01-01T00:00:00", "2026-12-31T23:59:59")
+        per_update = (time.perf_counter() - started) / len(targets)
+        ivms.close()
+
+        print(f"  {storage:<7} open {opened:7.2f} s  page through {paged:7.2f} s  "
+              f"update {per_update * 1000:9.2f} ms/user")
+
+
+def bench_cardskipper(args):
+    """Fetch active members from a local Cardskipper stand-in with the API client."""
+    from cardskipper_client import CardskipperClient
+    from cardskipper_server import start_server
+
+    server = start_server(args.members, max_page_size=args.page_size)
+    print(f"Stand-in serving {args.members} members at {server.url}, {os.cpu_count()} CPU(s) available")
+    try:
+        for run in range(1, args.runs + 1):
+            client = CardskipperClient(server.url, "admin", "admin", organisation_id=123, page_size=args.page_size)
+            connections = server.connections
+            tracemalloc.start()
+            started = time.perf_counter()
+            members = client.get_active_members()
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            client.close()
+
+            print(
+                f"  run {run}: {elapsed:6.2f} s  {len(members) / elapsed:9.0f} members/s  "
+                f"{client.requests_sent} requests on {server.connections - connections} connection(s)  "
+                f"peak {peak / 2**20:6.1f} MiB  ({len(members)} active)"
+            )
+            del members
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_pacing(args):
+    """Bulk-push validity updates to a simulated controller that throttles beyond its capacity."""
+    from circuit_breaker import DeviceRouter
+    from integration import MockDatabase, MockIVMS
+
+    workdir = tempfile.mkdtemp(prefix="bench_pacing_")
+    members = generate_members(args.updates)
+    ivms = MockIVMS(os.path.join(workdir, "ivms.json"), storage="sqlite")
+    ivms.store.replace(generate_ivms_users(members))
+    ivms.max_users_per_second = args.device_capacity
+    ivms.request_seconds = args.request_ms / 1000
+    ivms.user_seconds = args.user_ms / 1000
+    db = MockDatabase(os.path.join(workdir, "integration.db"))
+
+    updates = [
+        {"email": m["email"], "ivms_employee_no": f"{i:08d}", "start_date": m["start_date"],
+         "end_date": (datetime.strptime(m["end_date"], "%Y-%m-%dT%H:%M:%S") + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%S")}
+        for i, m in enumerate(members)
+    ]
+    print(f"Device capacity {args.device_capacity:.0f} users/s, {args.request_ms:g} ms per request "
+          f"+ {args.user_ms:g} ms per user; pushing {len(updates)} updates")
+
+    router = DeviceRouter([ivms], db)
+    started = time.perf_counter()
+    results = router.push_updates(updates)
+    elapsed = time.perf_counter() - started
+    limits = router.pacing()[0]
+    applied = sum(r["applied"] for r in results)
+    queued = sum(r["queued"] for r in results)
+    print(f"  {elapsed:6.2f} s  {applied / elapsed:6.0f} users/s applied  {queued} backlogged  "
+          f"{limits['throttled']} busy replies  {limits['decreases']} slow-downs")
+    print(f"  settled at {limits['rate']:.0f} users/s, {limits['concurrency']} concurrent, "
+          f"{limits['batch_size']} per request")
+    ivms.close()
+    db.close()
+
+
+def bench_startup(args):
+    """Time cold imports in fresh interpreters; fails if a module exceeds the budget.
+
+    The cost of starting a bare interpreter is measured separately and
+    subtracted. The fastest of the runs is compared, as other load on the
+    machine only ever makes a run slower. Importing must not create files
+    either.
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=src_dir, PYTHONDONTWRITEBYTECODE="1")
+
+    def fastest_run(code, workdir):
+        times = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=workdir, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            times.append(time.perf_counter() - started)
+        return min(times) * 1000
+
+    baseline = fastest_run("pass", tempfile.mkdtemp(prefix="bench_startup_"))
+    print(f"Interpreter startup {baseline:.1f} ms (fastest of {args.runs}), budget {args.budget_ms:.0f} ms per import")
+
+    failed = False
+    for module in args.modules:
+        workdir = tempfile.mkdtemp(prefix="bench_startup_")
+        try:
+            elapsed = fastest_run(f"import {module}", workdir) - baseline
+        except subprocess.CalledProcessError as e:
+            print(f"  {module:<16} could not be imported: {e.stderr.decode().strip().splitlines()[-1]}")
+            failed = True
+            continue
+
+        created = os.listdir(workdir)
+        over_budget = elapsed > args.budget_ms
+        failed = failed or over_budget or bool(created)
+        status = "OVER BUDGET" if over_budget else "ok"
+        print(f"  {module:<16} {elapsed:7.1f} ms  {status}")
+        if created:
+            print(f"  {module:<16} created files on import: {', '.join(sorted(created))}")
+
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sharding = subparsers.add_parser("sharding", help="sharded change planning throughput")
+    sharding.add_argument("--members", type=int, default=200000)
+    sharding.add_argument("--changed", type=float, default=0.05, help="share of members renewed")
+    sharding.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    sharding.set_defaults(func=bench_sharding)
+
+    loading = subparsers.add_parser("loading", help="time and peak memory of loading member exports")
+    loading.add_argument("--members", type=int, default=200000)
+    loading.set_defaults(func=bench_loading)
+
+    storage = subparsers.add_parser("storage", help="JSON and SQLite mock storage backends")
+    storage.add_argument("--users", type=int, default=100000)
+    storage.add_argument("--updates", type=int, default=100)
+    storage.set_defaults(func=bench_storage)
+
+    cardskipper = subparsers.add_parser("cardskipper", help="API client fetch throughput against a local stand-in")
+    cardskipper.add_argument("--members", type=int, default=100000)
+    cardskipper.add_argument("--page-size", type=int, default=1000)
+    cardskipper.add_argument("--runs", type=int, default=3)
+    cardskipper.set_defaults(func=bench_cardskipper)
+
+    pacing = subparsers.add_parser("pacing", help="adaptive pacing of bulk IVMS writes")
+    pacing.add_argument("--updates", type=int, default=5000)
+    pacing.add_argument("--device-capacity", type=float, default=800.0, help="users/s before the device answers busy")
+    pacing.add_argument("--request-ms", type=float, default=20.0)
+    pacing.add_argument("--user-ms", type=float, default=0.2)
+    pacing.set_defaults(func=bench_pacing)
+
+    startup = subparsers.add_parser("startup", help="cold import time against a budget")
+    startup.add_argument("--modules", nargs="+", default=["integration"])
+    startup.add_argument("--budget-ms", type=float, default=100.0)
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
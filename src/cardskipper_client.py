@@ -0,0 +1,246 @@
+"""
+Client for the Cardskipper API.
+Active members are requested page by page from /Member/Export/ with the
+OnlyActive filter, so the server does the filtering. Every request goes
+through one requests.Session: the TLS connection is reused and the
+credentials are encoded once. Responses are gzip-compressed and parsed
+while they stream in, so a page is never held in memory as a whole.
+
+Members are returned in the simplified format of
+MockCardskipper.get_active_members.
+"""
+
+import base64
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from access_index import merge_intervals
+from expiry import parse_date
+
+logger = logging.getLogger("MockIntegrationFinal.cardskipper")
+
+PRODUCTION_URL = "https://api.cardskipper.se"
+TEST_URL = "https://api-test.cardskipper.se"
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_TIMEOUT = (5, 60)
+# Organisation info (roles) changes rarely; re-read it after this long
+ORGANISATION_INFO_TTL_SECONDS = 3600
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+SEARCH_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<SearchCriteriaMember xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+    <OrganisationId>{organisation_id}</OrganisationId>
+    <OnlyActive>true</OnlyActive>
+    <Page>{page}</Page>
+    <PageSize>{page_size}</PageSize>
+</SearchCriteriaMember>"""
+
+
+class CardskipperError(Exception):
+    """Raised when the Cardskipper API rejects a request."""
+
+
+def _local(tag):
+    # Drop the namespace, if any
+    return tag.rpartition("}")[2]
+
+
+def _child_text(element, name):
+    for child in element:
+        if _local(child.tag) == name:
+            return (child.text or "").strip()
+    return ""
+
+
+def _find(element, *path):
+    for name in path:
+        if element is None:
+            return None
+        element = next((child for child in element if _local(child.tag) == name), None)
+    return element
+
+
+def _member_from_xml(element, now, organisation_id=None):
+    """Convert a <Member> element to the simplified member format.
+
+    As in MockCardskipper, a member's validity is the union of its role
+    intervals: the merged interval that is current, or else the next one,
+    gives the start and end dates, and the role that closes it names the
+    membership. Returns None if the member has no role that is still active.
+    """
+    contact = _find(element, "ContactInfo")
+    roles = []
+    organisations = _find(element, "Organisations")
+    for organisation in organisations if organisations is not None else ():
+        if organisation_id is not None and _child_text(organisation, "Id") != str(organisation_id):
+            continue
+        organisation_roles = _find(organisation, "Roles")
+        for role in organisation_roles if organisation_roles is not None else ():
+            start_date = parse_date(_child_text(role, "StartDate"))
+            end_date = parse_date(_child_text(role, "EndDate"))
+            roles.append((organisation, role, start_date, end_date))
+
+    now = parse_date(now)
+    window = next(
+        (interval for interval in merge_intervals((start, end) for _, _, start, end in roles) if interval[1] > now),
+        None
+    )
+    if window is None:
+        return None
+
+    organisation, role = next((o, r) for o, r, _, end_date in roles if end_date == window[1])
+    return {
+        "organization_member_id": _child_text(element, "OrganisationMemberId"),
+        "first_name": _child_text(element, "Firstname"),
+        "last_name": _child_text(element, "Lastname"),
+        "email": _child_text(contact, "EMail") if contact is not None else "",
+        "phone": _child_text(contact, "CellPhone1") if contact is not None else "",
+        "member_code": _child_text(element, "MemberCode"),
+        "start_date": window[0].strftime(DATE_FORMAT),
+        "end_date": window[1].strftime(DATE_FORMAT),
+        "role_id": _child_text(role, "Id"),
+        "role_name": _child_text(role, "Name"),
+        "organisation_id": _child_text(organisation, "Id"),
+    }
+
+
+def iter_members_xml(stream, now=None, stats=None, organisation_id=None):
+    """Yield active members from an XML member export as it is read from stream.
+
+    With organisation_id, only the roles held in that organisation count.
+
+    Each <Member> element is discarded once converted, so memory use does
+    not grow with the size of the response. If stats is a dict, the number
+    of <Member> elements read, active or not, is stored in it as "members".
+    """
+    now = now or datetime.now().strftime(DATE_FORMAT)
+    if stats is not None:
+        stats["members"] = 0
+    parser = ET.iterparse(stream, events=("start", "end"))
+    root = None
+    for event, element in parser:
+        if root is None:
+            root = element
+        if event == "end" and _local(element.tag) == "Member":
+            if stats is not None:
+                stats["members"] += 1
+            member = _member_from_xml(element, now, organisation_id)
+            if member is not None:
+                yield member
+            # Members are direct children of the root
+            root.remove(element)
+
+
+class CardskipperClient:
+    """Cardskipper API client with a persistent session."""
+    def __init__(self, base_url=None, username=None, password=None, organisation_id=None,
+                 page_size=DEFAULT_PAGE_SIZE, timeout=DEFAULT_TIMEOUT, verify=True):
+        self.base_url = (base_url or os.environ.get("CARDSKIPPER_API_URL", TEST_URL)).rstrip("/")
+        self.username = username or os.environ.get("CARDSKIPPER_USERNAME", "")
+        self.password = password or os.environ.get("CARDSKIPPER_PASSWORD", "")
+        self.organisation_id = organisation_id or os.environ.get("CARDSKIPPER_ORGANIZATION_ID")
+        self.page_size = page_size
+        self.timeout = timeout
+        self.verify = verify
+        self._session = None
+        self._organisation_info = None
+        self._organisation_info_at = 0.0
+        self.requests_sent = 0
+
+    @property
+    def session(self):
+        """The shared session, created on first use."""
+        if self._session is None:
+            # Imported here so the mocks can be used without requests installed
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=2))
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=2))
+            credentials = base64.b64encode(f"{self.username}:{self.password}".encode("utf-8")).decode("ascii")
+            session.headers.update({
+                "Authorization": f"Basic {credentials}",
+                "Accept": "application/xml",
+                "Accept-Encoding": "gzip",
+            })
+            session.verify = self.verify
+            self._session = session
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        self.requests_sent += 1
+        if response.status_code == 401:
+            response.close()
+            raise CardskipperError("Cardskipper rejected the credentials (401)")
+        if response.status_code >= 400:
+            response.close()
+            raise CardskipperError(f"Cardskipper returned {response.status_code} for {method} {path}")
+        return response
+
+    def get_organisation_info(self, refresh=False):
+        """Return the organisation info XML as an element, cached for a while."""
+        expired = time.monotonic() - self._organisation_info_at > ORGANISATION_INFO_TTL_SECONDS
+        if self._organisation_info is None or expired or refresh:
+            response = self._request("GET", "/Organisation/Info/")
+            self._organisation_info = ET.fromstring(response.content)
+            self._organisation_info_at = time.monotonic()
+        return self._organisation_info
+
+    def iter_active_members(self, organisation_id=None, modified_since=None):
+        """Yield active members in the simplified format, page by page.
+
+        The member export cannot filter on when a member changed, so
+        modified_since is ignored and every active member is yielded; a
+        superset of the changed members, as the sync expects.
+        """
+        organisation_id = organisation_id or self.organisation_id
+        if organisation_id is None:
+            raise CardskipperError("No Cardskipper organisation id configured")
+
+        now = datetime.now().strftime(DATE_FORMAT)
+        page = 1
+        # The server may cap the page size below the one asked for
+        served_page_size = 0
+        while True:
+            body = SEARCH_TEMPLATE.format(
+                organisation_id=escape(str(organisation_id)), page=page, page_size=self.page_size
+            )
+            response = self._request(
+                "POST", "/Member/Export/",
+                data=body.encode("utf-8"),
+                headers={"Content-Type": "application/xml; charset=utf-8"},
+                stream=True
+            )
+            stats = {}
+            try:
+                # raw is read undecoded by default; let urllib3 gunzip it
+                response.raw.decode_content = True
+                yield from iter_members_xml(response.raw, now, stats, organisation_id)
+            finally:
+                response.close()
+
+            # An empty page, or one shorter than the pages before it, is the last one
+            if stats["members"] == 0 or stats["members"] < served_page_size:
+                return
+            served_page_size = max(served_page_size, stats["members"])
+            page += 1
+
+    def get_active_members(self, organisation_id=None, modified_since=None):
+        """Return all active members in the simplified format; see iter_active_members."""
+        sent = self.requests_sent
+        members = list(self.iter_active_members(organisation_id, modified_since))
+        logger.info("Fetched %s active members from Cardskipper in %s requests",
+                    len(members), self.requests_sent - sent)
+        return members
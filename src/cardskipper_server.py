@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Cardskipper API.
+Serves /Organisation/Info/ and a paged, gzip-compressed XML /Member/Export/
+for a configurable number of synthetic members, so CardskipperClient can be
+run and benchmarked offline. Members are generated from a seed, so the same
+settings always serve the same data.
+
+Usage:
+    python cardskipper_server.py --members 100000 --port 8088
+"""
+
+import argparse
+import base64
+import gzip
+import logging
+import random
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger("MockIntegrationFinal.cardskipper_server")
+
+DEFAULT_PAGE_SIZE = 1000
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+ROLES = ((456, "Dijak 16-17"), (457, "24/7"), (458, "Jutranji"))
+
+
+def generate_members(count, organisation_id=123, expired_share=0.2, seed=42):
+    """Generate (end_date, xml) pairs, one per member.
+
+    Every member has one role; about a fifth also holds an older, expired one.
+    """
+    rng = random.Random(seed)
+    now = datetime.now()
+    members = []
+    for i in range(count):
+        if rng.random() < expired_share:
+            end_date = now - timedelta(days=rng.randint(1, 365))
+        else:
+            end_date = now + timedelta(days=rng.randint(1, 365))
+        start_date = end_date - timedelta(days=rng.choice((30, 90, 365)))
+
+        roles = [(rng.choice(ROLES), start_date, end_date)]
+        if rng.random() < 0.2:
+            roles.append((ROLES[0], start_date - timedelta(days=400), start_date - timedelta(days=35)))
+
+        role_xml = "".join(
+            f"<Role><Id>{role_id}</Id><Name>{escape(name)}</Name>"
+            f"<StartDate>{start.strftime(DATE_FORMAT)}</StartDate>"
+            f"<EndDate>{end.strftime(DATE_FORMAT)}</EndDate></Role>"
+            for (role_id, name), start, end in roles
+        )
+        members.append((end_date.strftime(DATE_FORMAT), (
+            f"<Member><OrganisationMemberId>{100000 + i}</OrganisationMemberId>"
+            f"<Firstname>First{i}</Firstname><Lastname>Last{i}</Lastname>"
+            f"<MemberCode>{i:06x}</MemberCode>"
+            f"<ContactInfo><EMail>member{i}@example.com</EMail><CellPhone1>+3867{i:07d}</CellPhone1></ContactInfo>"
+            f"<Organisations><Organisation><Id>{organisation_id}</Id><Roles>{role_xml}</Roles>"
+            f"</Organisation></Organisations></Member>"
+        )))
+    return members
+
+
+class CardskipperStandIn(ThreadingHTTPServer):
+    """HTTP server holding the synthetic members; counts connections and requests."""
+    daemon_threads = True
+
+    def __init__(self, address, members, organisation_id=123, username="admin", password="admin",
+                 max_page_size=DEFAULT_PAGE_SIZE):
+        super().__init__(address, StandInHandler)
+        self.members = members
+        self.organisation_id = str(organisation_id)
+        self.max_page_size = max_page_size
+        self.authorization = "Basic " + base64.b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._active = None
+        self._active_at = 0.0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def page(self, only_active, page, page_size):
+        """Return the member XML snippets of one page."""
+        members = self.members
+        if only_active:
+            # Filtered once a minute rather than for every page
+            with self.lock:
+                if self._active is None or time.monotonic() - self._active_at > 60:
+                    now = datetime.now().strftime(DATE_FORMAT)
+                    self._active = [m for m in self.members if m[0] > now]
+                    self._active_at = time.monotonic()
+                members = self._active
+        start = (page - 1) * page_size
+        return [xml for _, xml in members[start:start + page_size]]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients that reuse a session reuse the connection
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path.split("?")[0].rstrip("/") != "/Organisation/Info":
+            self._send(404, b"")
+            return
+
+        roles = "".join(f"<Role><Id>{role_id}</Id><Name>{escape(name)}</Name></Role>" for role_id, name in ROLES)
+        body = f"<Organisation><Id>{self.server.organisation_id}</Id><Roles>{roles}</Roles></Organisation>"
+        self._send(200, body.encode("utf-8"))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._authorized():
+            return
+        if self.path.split("?")[0].rstrip("/") != "/Member/Export":
+            self._send(404, b"")
+            return
+
+        try:
+            criteria = {_local(child.tag): (child.text or "").strip() for child in ET.fromstring(body)}
+        except ET.ParseError:
+            self._send(400, b"<Error>Invalid search criteria</Error>")
+            return
+        if criteria.get("OrganisationId") != self.server.organisation_id:
+            self._send(200, b"<ArrayOfMember />")
+            return
+
+        page = max(1, int(criteria.get("Page") or 1))
+        page_size = min(int(criteria.get("PageSize") or self.server.max_page_size), self.server.max_page_size)
+        members = self.server.page(criteria.get("OnlyActive") == "true", page, page_size)
+        xml = '<?xml version="1.0" encoding="utf-8"?><ArrayOfMember>' + "".join(members) + "</ArrayOfMember>"
+        self._send(200, xml.encode("utf-8"))
+
+    def _authorized(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.headers.get("Authorization") != self.server.authorization:
+            self._send(401, b"")
+            return False
+        return True
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        if body and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _local(tag):
+    return tag.rpartition("}")[2]
+
+
+def start_server(members=10000, port=0, host="127.0.0.1", **kwargs):
+    """Start a stand-in with generated members in a background thread and return it."""
+    members_xml = generate_members(members, kwargs.get("organisation_id", 123))
+    server = CardskipperStandIn((host, port), members_xml, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, name="cardskipper-standin", daemon=True)
+    thread.start()
+    logger.info("Cardskipper stand-in with %s members at %s", members, server.url)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--organisation-id", default="123")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="largest page served")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    server = CardskipperStandIn(
+        (args.host, args.port), generate_members(args.members, args.organisation_id),
+        organisation_id=args.organisation_id, max_page_size=args.page_size
+    )
+    logger.info("Serving %s members at %s (user admin, password admin)", args.members, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
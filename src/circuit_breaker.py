@@ -0,0 +1,362 @@
+"""
+Per-device circuit breakers and health-aware routing for IVMS controllers.
+A controller that stops responding is taken out of rotation so that one dead
+device cannot stall a whole synchronization cycle; its updates are parked in
+a backlog and replayed once a probe request shows the device is back.
+Bulk pushes are paced per device by an adaptive limiter (see rate_limit).
+"""
+
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ivms_paging import DEFAULT_MAX_IN_FLIGHT, DEFAULT_PAGE_SIZE, iter_user_pages
+from metrics import DEVICE_CIRCUIT_OPEN, DEVICE_REQUEST_ERRORS, DEVICE_REQUEST_SECONDS
+from rate_limit import ERROR, OK, THROTTLED, AdaptiveLimiter
+
+logger = logging.getLogger("MockIntegrationFinal.breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Errors that indicate the device itself is unhealthy (as opposed to a
+# request the device answered but rejected, e.g. an unknown employeeNo)
+DEVICE_ERRORS = (ConnectionError, TimeoutError, OSError)
+
+# Times a write the device refused as busy is retried before it is backlogged
+BUSY_RETRIES = 5
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is refused because the device circuit is open."""
+
+
+class DeviceBusyError(Exception):
+    """Raised when a device answers but refuses a request because it is overloaded."""
+
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker guarding a single IVMS device."""
+    def __init__(self, device_id, failure_threshold=3, reset_timeout=30.0,
+                 half_open_max_probes=1, clock=time.monotonic):
+        self.device_id = device_id
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_probes = half_open_max_probes
+        self.clock = clock
+
+        self.state = CLOSED
+        self.failure_count = 0
+        self.trip_count = 0
+        self.opened_at = None
+        self.last_error = None
+        self.probes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def restore(self, state, failure_count=0, trip_count=0, last_error=None):
+        """Restore persisted breaker state (e.g. after a restart)."""
+        with self._lock:
+            self.trip_count = trip_count or 0
+            self.failure_count = failure_count or 0
+            self.last_error = last_error
+            if state in (OPEN, HALF_OPEN):
+                # Wait a full reset timeout before probing again
+                self.state = OPEN
+                self.opened_at = self.clock()
+                DEVICE_CIRCUIT_OPEN.labels(self.device_id).set(1)
+
+    def allow_request(self):
+        """Return True if a request may be sent to the device right now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                # Reset timeout elapsed, let a limited number of probes through
+                self.state = HALF_OPEN
+                self.probes_in_flight = 0
+                logger.info("Circuit for device %s is half-open, probing", self.device_id)
+
+            if self.probes_in_flight < self.half_open_max_probes:
+                self.probes_in_flight += 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("Circuit for device %s closed", self.device_id)
+            self.state = CLOSED
+            self.failure_count = 0
+            self.probes_in_flight = 0
+            self.opened_at = None
+            DEVICE_CIRCUIT_OPEN.labels(self.device_id).set(0)
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failure_count += 1
+            self.last_error = str(error) if error else None
+
+            if self.state == HALF_OPEN or self.failure_count >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trip_count += 1
+                    logger.warning(
+                        "Circuit for device %s opened after %d failures: %s",
+                        self.device_id, self.failure_count, self.last_error
+                    )
+                self.state = OPEN
+                self.opened_at = self.clock()
+                self.probes_in_flight = 0
+                DEVICE_CIRCUIT_OPEN.labels(self.device_id).set(1)
+
+    def call(self, func, *args, **kwargs):
+        """Call func through the breaker, recording device failures."""
+        if not self.allow_request():
+            raise CircuitOpenError(f"Circuit for device {self.device_id} is open")
+
+        operation = getattr(func, "__name__", "call")
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except DEVICE_ERRORS as e:
+            DEVICE_REQUEST_ERRORS.labels(self.device_id, operation).inc()
+            self.record_failure(e)
+            raise
+        except DeviceBusyError:
+            # A busy device is still a healthy one; slowing down is up to the caller
+            self.record_success()
+            raise
+        finally:
+            DEVICE_REQUEST_SECONDS.labels(self.device_id, operation).observe(time.perf_counter() - started)
+
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        """Return the breaker state as a plain dict."""
+        with self._lock:
+            return {
+                "device_id": self.device_id,
+                "state": self.state,
+                "failure_count": self.failure_count,
+                "trip_count": self.trip_count,
+                "last_error": self.last_error
+            }
+
+
+class DeviceRouter:
+    """Routes IVMS requests across devices according to their breaker state.
+
+    The backlog object must provide enqueue_backlog(device_id, update),
+    get_backlog(device_id) and remove_backlog(device_id, employee_no).
+    """
+    def __init__(self, devices, backlog, failure_threshold=3, reset_timeout=30.0,
+                 saved_health=None, pacing=None):
+        self.devices = list(devices)
+        self.backlog = backlog
+        # pacing holds AdaptiveLimiter settings shared by every device
+        self.limiters = {
+            device.device_id: AdaptiveLimiter(device.device_id, **(pacing or {}))
+            for device in self.devices
+        }
+        self.breakers = {
+            device.device_id: CircuitBreaker(
+                device.device_id,
+                failure_threshold=failure_threshold,
+                reset_timeout=reset_timeout
+            )
+            for device in self.devices
+        }
+
+        # Carry trip counts and open circuits over from a previous run
+        for row in saved_health or []:
+            breaker = self.breakers.get(row["device_id"])
+            if breaker:
+                breaker.restore(row["state"], row["failure_count"], row["trip_count"], row["last_error"])
+
+    def iter_users(self, page_size=DEFAULT_PAGE_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """Stream users page by page from the first healthy device.
+
+        Raises ConnectionError if no device responds. A device that fails
+        after the first page raises too, since switching devices mid-search
+        would repeat users.
+        """
+        for device in self.devices:
+            breaker = self.breakers[device.device_id]
+            search = functools.partial(breaker.call, device.search_users)
+            pages = iter_user_pages(search, page_size, max_in_flight)
+            try:
+                first_page = next(pages)
+            except CircuitOpenError:
+                continue
+            except DEVICE_ERRORS as e:
+                logger.warning("Could not fetch users from device %s: %s", device.device_id, e)
+                continue
+
+            yield from first_page
+            for page in pages:
+                yield from page
+            return
+
+        raise ConnectionError("No IVMS device reachable")
+
+    def push_update(self, update):
+        """Push a validity update to every device, diverting it to the backlog where needed.
+
+        Returns a dict with the number of devices the update was applied to,
+        queued for, or rejected by.
+        """
+        return self.push_updates([update])[0]
+
+    def push_updates(self, updates):
+        """Push validity updates to every device in paced batches.
+
+        Returns one dict per update, in order, with the number of devices
+        it was applied to, queued for, or rejected by.
+        """
+        results = [{"applied": 0, "queued": 0, "failed": 0} for _ in updates]
+
+        for device in self.devices:
+            for index, outcome in self._push_paced(device, updates):
+                results[index][outcome] += 1
+
+        return results
+
+    def _push_paced(self, device, updates, replay=False):
+        """Write updates to one device as fast as its limiter allows; returns (index, outcome) pairs.
+
+        With replay set, the updates are the device's own backlog: they are
+        not queued again, and replay stops at the first batch the device
+        refuses as busy or fails, leaving the rest for the next attempt.
+        Updates that were not sent have no outcome.
+        """
+        limiter = self.limiters[device.device_id]
+        pending = deque(range(len(updates)))
+        busy_count = {}
+        outcomes = []
+
+        with ThreadPoolExecutor(max_workers=limiter.max_concurrency,
+                                thread_name_prefix=f"push-{device.device_id}") as pool:
+            running = set()
+            while pending or running:
+                # The limiter holds batches back beyond its current concurrency
+                while pending and len(running) < limiter.max_concurrency:
+                    batch = [pending.popleft() for _ in range(min(limiter.batch_size, len(pending)))]
+                    running.add(pool.submit(self._send_batch, device, limiter, updates, batch, replay))
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished, busy = future.result()
+                    outcomes.extend(finished)
+                    if replay and (busy or any(outcome == "queued" for _, outcome in finished)):
+                        # The device is busy or went away again
+                        pending.clear()
+                        continue
+                    for index in busy:
+                        busy_count[index] = busy_count.get(index, 0) + 1
+                        if busy_count[index] > BUSY_RETRIES:
+                            self.backlog.enqueue_backlog(device.device_id, updates[index])
+                            outcomes.append((index, "queued"))
+                        else:
+                            pending.append(index)
+
+        return outcomes
+
+    def _send_batch(self, device, limiter, updates, batch, replay=False):
+        """Write one batch; returns ((index, outcome) pairs, indices refused as busy)."""
+        breaker = self.breakers[device.device_id]
+        if breaker.state == OPEN:
+            # No point pacing writes that go straight to the backlog
+            self._park(device, updates, batch, replay)
+            return [(index, "queued") for index in batch], []
+
+        started_at = limiter.acquire(len(batch))
+        try:
+            applied = breaker.call(device.update_users_validity, [
+                (updates[i]["ivms_employee_no"], updates[i]["start_date"], updates[i]["end_date"]) for i in batch
+            ])
+        except DeviceBusyError:
+            limiter.release(started_at, THROTTLED)
+            return [], batch
+        except (CircuitOpenError,) + DEVICE_ERRORS as e:
+            limiter.release(started_at, ERROR)
+            logger.warning("Device %s failed a batch of %s updates: %s", device.device_id, len(batch), e)
+            self._park(device, updates, batch, replay)
+            return [(index, "queued") for index in batch], []
+        except BaseException:
+            # Also on interrupts, so the request slot is never lost
+            limiter.release(started_at, ERROR)
+            raise
+
+        limiter.release(started_at, OK)
+        applied = set(applied)
+        return [(i, "applied" if updates[i]["ivms_employee_no"] in applied else "failed") for i in batch], []
+
+    def _park(self, device, updates, batch, replay):
+        # Replayed updates never left the backlog
+        if not replay:
+            for index in batch:
+                self.backlog.enqueue_backlog(device.device_id, updates[index])
+
+    def disable_user(self, employee_no):
+        """Disable a user on every device.
+
+        Devices with an open circuit are reported as queued so the caller can
+        retry later; the backlog only holds validity updates.
+        """
+        result = {"applied": 0, "queued": 0, "failed": 0}
+
+        for device in self.devices:
+            breaker = self.breakers[device.device_id]
+            try:
+                success = breaker.call(device.disable_user, employee_no)
+            except (CircuitOpenError,) + DEVICE_ERRORS:
+                result["queued"] += 1
+                continue
+            result["applied" if success else "failed"] += 1
+
+        return result
+
+    def recover(self):
+        """Probe devices with open circuits and replay their backlog once they recover.
+
+        The backlog is replayed in paced batches like any other push; a
+        device that is busy keeps the rest of its backlog until the next
+        call. Returns the number of backlog entries applied.
+        """
+        drained = 0
+
+        for device in self.devices:
+            breaker = self.breakers[device.device_id]
+
+            if breaker.state != CLOSED:
+                try:
+                    breaker.call(device.get_device_info)
+                except (CircuitOpenError,) + DEVICE_ERRORS:
+                    continue
+
+            backlog = self.backlog.get_backlog(device.device_id)
+            for index, outcome in self._push_paced(device, backlog, replay=True):
+                # Users the device does not know are dropped as well
+                if outcome != "queued":
+                    self.backlog.remove_backlog(device.device_id, backlog[index]["ivms_employee_no"])
+                    drained += 1
+
+        if drained:
+            logger.info("Replayed %s backlogged IVMS updates", drained)
+
+        return drained
+
+    def pacing(self):
+        """Return the current write limits of every device."""
+        return [self.limiters[device.device_id].snapshot() for device in self.devices]
+
+    def snapshot(self):
+        """Return the state of every device breaker."""
+        return [self.breakers[device.device_id].snapshot() for device in self.devices]
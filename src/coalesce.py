@@ -0,0 +1,67 @@
+"""
+Write coalescing for IVMS validity updates.
+Staff often change a membership several times in a few minutes (extend,
+correct the days, extend again). Updates wait here for a short window
+after the first change to an employee number; later changes within the
+window replace the waiting one, so the device gets a single write with the
+latest validity. The window is counted from the first change, so a member
+who keeps changing is still written at least once per window. The
+coalescer only holds updates in memory; the sync service records them in
+its database as well, so a restart within the window does not lose them.
+"""
+
+import heapq
+import threading
+import time
+
+
+class WriteCoalescer:
+    """Latest pending update per IVMS employee number, released when its window expires."""
+    def __init__(self, window_seconds, clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        # (due, employee_no); the due time of an entry never changes
+        self._due = []
+        self.offered = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def offer(self, update):
+        """Hold an update, replacing one still waiting for the same employee number."""
+        employee_no = update["ivms_employee_no"]
+        with self._lock:
+            self.offered += 1
+            if employee_no in self._pending:
+                self.coalesced += 1
+            else:
+                heapq.heappush(self._due, (self.clock() + self.window_seconds, employee_no))
+            self._pending[employee_no] = update
+
+    def take_due(self):
+        """Remove and return the updates whose window has expired, oldest first."""
+        now = self.clock()
+        due = []
+        with self._lock:
+            while self._due and self._due[0][0] <= now:
+                _, employee_no = heapq.heappop(self._due)
+                due.append(self._pending.pop(employee_no))
+        return due
+
+    def drain(self):
+        """Remove and return every waiting update, e.g. on shutdown."""
+        with self._lock:
+            due = [self._pending[employee_no] for _, employee_no in sorted(self._due)]
+            self._pending.clear()
+            self._due.clear()
+        return due
+
+    def seconds_until_due(self):
+        """Seconds until the next window expires; None if nothing is waiting."""
+        with self._lock:
+            if not self._due:
+                return None
+            return max(0.0, self._due[0][0] - self.clock())
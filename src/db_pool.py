@@ -0,0 +1,188 @@
+"""
+Thread-safe SQLite access for the integration databases.
+Every thread reads through its own connection from a ConnectionPool, and all
+writes go through one WriteQueue thread that applies whatever has been queued
+in a single transaction (a group commit). Each queued write runs in its own
+savepoint, so one failing write does not undo the others in its group.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger("MockIntegrationFinal.db")
+
+BUSY_TIMEOUT_MS = 5000
+# Upper bound on writes per group commit, and how long the writer waits for
+# more writes to join a group that has already started
+MAX_GROUP_SIZE = 256
+GROUP_WINDOW_SECONDS = 0.002
+
+_STOP = object()
+
+
+class ConnectionPool:
+    """Hands out one SQLite connection per thread.
+
+    A private :memory: database cannot be opened twice, so for it every
+    thread shares a single connection and its transactions are not isolated.
+    """
+    def __init__(self, db_path, read_only=False, busy_timeout_ms=BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._shared = None
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def _open(self):
+        with self._lock:
+            if self.db_path == ":memory:":
+                if self._shared is None:
+                    self._shared = self._connect(self.db_path)
+                return self._shared
+
+            if self.read_only:
+                conn = self._connect(f"file:{self.db_path}?mode=ro", uri=True)
+                conn.execute("PRAGMA query_only = ON")
+            else:
+                conn = self._connect(self.db_path)
+                # Readers see committed snapshots while the writer works
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+            self._connections.append(conn)
+            return conn
+
+    def _connect(self, database, uri=False):
+        # Transactions are managed explicitly (see WriteQueue); the pool makes
+        # sure a connection is only used by the thread that opened it
+        conn = sqlite3.connect(
+            database,
+            uri=uri,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            if self._shared is not None:
+                self._shared.close()
+                self._shared = None
+        self._local = threading.local()
+
+
+class WriteQueue:
+    """Single writer thread that applies queued writes in group commits."""
+    def __init__(self, pool, max_group_size=MAX_GROUP_SIZE, group_window=GROUP_WINDOW_SECONDS):
+        self.pool = pool
+        self.max_group_size = max_group_size
+        self.group_window = group_window
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args):
+        """Queue func(conn, *args) to run in the writer thread; returns a Future."""
+        future = Future()
+        if threading.current_thread() is self._thread:
+            # Called from inside another write; run it in the same transaction
+            future.set_result(func(self.pool.connection(), *args))
+            return future
+
+        self._queue.put((future, func, args))
+        return future
+
+    def run(self, func, *args):
+        """Run func(conn, *args) in the writer thread and wait for the commit."""
+        return self.submit(func, *args).result()
+
+    def execute(self, sql, params=()):
+        """Run one statement and wait for the commit; returns the row count."""
+        return self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    def executemany(self, sql, seq_of_params):
+        return self.run(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def flush(self):
+        """Wait until everything queued so far has been committed."""
+        self.run(lambda conn: None)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        conn = self.pool.connection()
+        stopping = False
+
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            group = [item]
+            deadline = time.monotonic() + self.group_window
+            while len(group) < self.max_group_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                group.append(item)
+
+            self._commit(conn, group)
+
+    def _commit(self, conn, group):
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args in group:
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    outcomes.append((future, None, e))
+                    continue
+                conn.execute("RELEASE write")
+                outcomes.append((future, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            logger.error("Error committing %s queued writes: %s", len(group), e)
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, func, args in group:
+                future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.writes += len(group)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Drift audit between Cardskipper and IVMS.
+Linked members are hashed into buckets by email on both sides. Each bucket
+gets a digest of the validity Cardskipper says the member should have and
+one of the validity the device actually holds; only buckets whose digests
+differ are compared record by record. Every difference found is written to
+the drift_report table, with one drift_audits row per device and run.
+
+Usage:
+    python drift_audit.py --buckets 256
+"""
+
+import argparse
+import hashlib
+import logging
+import sys
+from datetime import datetime
+
+from circuit_breaker import DEVICE_ERRORS
+from ivms_paging import iter_user_pages
+from sync_plan import shard_for
+
+logger = logging.getLogger("MockIntegrationFinal.drift")
+
+DEFAULT_BUCKETS = 256
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Bucket digests are sums of record digests, so records can arrive in any order
+_DIGEST_MODULUS = 1 << 128
+
+# A member without access is only expected to be disabled; dates don't matter
+_NO_ACCESS = ("", "", False)
+
+
+def ensure_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS drift_audits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            buckets INTEGER,
+            mismatched_buckets INTEGER,
+            records_compared INTEGER,
+            drift_count INTEGER,
+            error TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS drift_report (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            audit_id INTEGER NOT NULL,
+            device_id TEXT NOT NULL,
+            email TEXT,
+            employee_no TEXT,
+            kind TEXT NOT NULL,
+            intended_begin TEXT,
+            intended_end TEXT,
+            intended_enable INTEGER,
+            actual_begin TEXT,
+            actual_end TEXT,
+            actual_enable INTEGER,
+            sync_pending INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drift_report_audit ON drift_report (audit_id)")
+
+
+def record_digest(email, employee_no, validity):
+    begin, end, enable = validity
+    key = "\x1f".join((email, employee_no, begin or "", end or "", "1" if enable else "0"))
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest(), "big")
+
+
+def device_validity(user):
+    """The (begin, end, enable) a device user has, with disabled users reduced to no access."""
+    if user is None:
+        return None
+    valid = user.get("Valid", {})
+    if not valid.get("enable"):
+        return _NO_ACCESS
+    return (valid.get("beginTime", ""), valid.get("endTime", ""), True)
+
+
+def _validity_columns(validity):
+    if validity is None:
+        return None, None, None
+    begin, end, enable = validity
+    return begin or None, end or None, int(enable)
+
+
+def classify(intended, actual):
+    """Name the kind of drift between an intended and an actual validity, or None if they agree."""
+    if intended == actual:
+        return None
+    if actual is None:
+        return "missing"
+    if not intended[2]:
+        return "not_disabled"
+    if not actual[2]:
+        return "disabled"
+    return "validity"
+
+
+class DriftAudit:
+    """Compares the validity every linked member should have with what each device holds.
+
+    cardskipper is anything with get_active_members(); devices are MockIVMS
+    instances or anything with the same search_users and get_user methods.
+    """
+    def __init__(self, cardskipper, devices, db, buckets=DEFAULT_BUCKETS, page_size=100):
+        self.cardskipper = cardskipper
+        self.devices = list(devices) if isinstance(devices, (list, tuple)) else [devices]
+        self.db = db
+        self.buckets = buckets
+        self.page_size = page_size
+
+    def _links(self):
+        """Return {email: (employee_no, end date last synced)} for every linked member."""
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT email, ivms_employee_no, end_date FROM members WHERE ivms_employee_no IS NOT NULL")
+        return {email: (employee_no, end_date) for email, employee_no, end_date in cursor.fetchall()}
+
+    def _intended(self, links, now):
+        """Return ({email: intended validity}, bucket digests) for the linked members."""
+        intended = dict.fromkeys(links, _NO_ACCESS)
+        for member in self.cardskipper.get_active_members():
+            if member["email"] in intended and member["end_date"] > now:
+                intended[member["email"]] = (member["start_date"], member["end_date"], True)
+
+        digests = [0] * self.buckets
+        for email, validity in intended.items():
+            bucket = shard_for(email, self.buckets)
+            digests[bucket] = (digests[bucket] + record_digest(email, links[email][0], validity)) % _DIGEST_MODULUS
+        return intended, digests
+
+    def _actual_digests(self, device, by_employee_no):
+        digests = [0] * self.buckets
+        for page in iter_user_pages(device.search_users, self.page_size):
+            for user in page:
+                email = by_employee_no.get(user.get("employeeNo"))
+                # Users that no member is linked to are not ours to audit
+                if email is None:
+                    continue
+                bucket = shard_for(email, self.buckets)
+                digest = record_digest(email, user["employeeNo"], device_validity(user))
+                digests[bucket] = (digests[bucket] + digest) % _DIGEST_MODULUS
+        return digests
+
+    def audit_device(self, device, links, intended, intended_digests):
+        """Return (mismatched buckets, records compared, findings) for one device."""
+        by_employee_no = {employee_no: email for email, (employee_no, _) in links.items()}
+        actual_digests = self._actual_digests(device, by_employee_no)
+        mismatched = {b for b in range(self.buckets) if intended_digests[b] != actual_digests[b]}
+
+        compared = 0
+        findings = []
+        for email, (employee_no, synced_end_date) in links.items():
+            if shard_for(email, self.buckets) not in mismatched:
+                continue
+            compared += 1
+            actual = device_validity(device.get_user(employee_no))
+            kind = classify(intended[email], actual)
+            if kind is None:
+                continue
+            # The sync has not caught up with Cardskipper yet if its own record differs
+            sync_pending = intended[email][2] and intended[email][1] != synced_end_date
+            findings.append((email, employee_no, kind, intended[email], actual, sync_pending))
+        return len(mismatched), compared, findings
+
+    def run(self, now=None):
+        """Audit every device and record the results; returns one summary dict per device."""
+        now = (now or datetime.now()).strftime(DATE_FORMAT)
+        links = self._links()
+        intended, intended_digests = self._intended(links, now)
+
+        summaries = []
+        for device in self.devices:
+            started_at = datetime.now().isoformat(timespec="seconds")
+            summary = {
+                "device_id": device.device_id, "buckets": self.buckets, "mismatched_buckets": 0,
+                "records_compared": 0, "drift_count": 0, "error": None,
+            }
+            findings = []
+            try:
+                mismatched, compared, findings = self.audit_device(device, links, intended, intended_digests)
+                summary.update(mismatched_buckets=mismatched, records_compared=compared, drift_count=len(findings))
+            except DEVICE_ERRORS as e:
+                logger.warning("Drift audit of device %s failed: %s", device.device_id, e)
+                summary["error"] = str(e)
+
+            self.db.writer.run(self._record, started_at, summary, findings)
+            logger.info(
+                "Drift audit of %s: %s of %s buckets differ, %s records compared, %s drifted",
+                device.device_id, summary["mismatched_buckets"], self.buckets,
+                summary["records_compared"], summary["drift_count"]
+            )
+            summaries.append(summary)
+        return summaries
+
+    def _record(self, conn, started_at, summary, findings):
+        ensure_schema(conn)
+        audit_id = conn.execute("""
+            INSERT INTO drift_audits (
+                device_id, started_at, finished_at, buckets, mismatched_buckets,
+                records_compared, drift_count, error
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            summary["device_id"], started_at, datetime.now().isoformat(timespec="seconds"),
+            summary["buckets"], summary["mismatched_buckets"], summary["records_compared"],
+            summary["drift_count"], summary["error"]
+        )).lastrowid
+
+        conn.executemany("""
+            INSERT INTO drift_report (
+                audit_id, device_id, email, employee_no, kind,
+                intended_begin, intended_end, intended_enable,
+                actual_begin, actual_end, actual_enable, sync_pending
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (audit_id, summary["device_id"], email, employee_no, kind,
+             *_validity_columns(intended), *_validity_columns(actual), int(sync_pending))
+            for email, employee_no, kind, intended, actual, sync_pending in findings
+        ])
+        summary["audit_id"] = audit_id
+
+
+def latest_report(db, device_id=None):
+    """Return the findings of the most recent audit (of one device, if given) as dicts."""
+    cursor = db.conn.cursor()
+    cursor.execute(
+        "SELECT MAX(id) FROM drift_audits" + (" WHERE device_id = ?" if device_id else ""),
+        (device_id,) if device_id else ()
+    )
+    audit_id = cursor.fetchone()[0]
+    if audit_id is None:
+        return []
+    cursor.execute("""
+        SELECT email, employee_no, kind, intended_begin, intended_end, intended_enable,
+               actual_begin, actual_end, actual_enable, sync_pending
+        FROM drift_report WHERE audit_id = ? ORDER BY kind, email
+    """, (audit_id,))
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buckets", type=int, default=DEFAULT_BUCKETS)
+    args = parser.parse_args(argv)
+
+    # Imported here so the module can be used without the mocks' setup
+    import integration
+
+    integration.init()
+    cardskipper = integration.MockCardskipper(integration.CARDSKIPPER_MEMBERS_FILE)
+    ivms = integration.MockIVMS(integration.IVMS_USERS_FILE)
+    db = integration.MockDatabase(integration.DB_FILE)
+    try:
+        audit = DriftAudit(cardskipper, ivms, db, args.buckets)
+        for summary in audit.run():
+            print(f"{summary['device_id']}: {summary['mismatched_buckets']}/{summary['buckets']} buckets differ, "
+                  f"{summary['records_compared']} records compared, {summary['drift_count']} drifted")
+            if summary["error"]:
+                print(f"  audit failed: {summary['error']}")
+        for finding in latest_report(db):
+            pending = " (sync pending)" if finding["sync_pending"] else ""
+            print(f"  {finding['kind']:12} {finding['email']} [{finding['employee_no']}]{pending}")
+    finally:
+        cardskipper.close()
+        ivms.close()
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
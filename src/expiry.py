@@ -0,0 +1,96 @@
+"""
+In-memory index of membership expiry times.
+Keeps members ordered by end date so the sync service can act on each
+expiry exactly when it happens instead of rescanning every member.
+"""
+
+import heapq
+import itertools
+from datetime import datetime
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class ExpiryIndex:
+    """Min-heap of membership expiry times keyed by email.
+
+    Rescheduling a member leaves the old heap entry in place; stale entries
+    are skipped when they reach the top of the heap. Heap entries carry a
+    sequence number after the email, so entries of one member at the same
+    time never compare their employee numbers, which may be None.
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build an index from (email, end_date, ivms_employee_no) rows."""
+        index = cls()
+        entries = []
+        for email, end_date, employee_no in rows:
+            expires_at = parse_date(end_date)
+            if expires_at is None:
+                continue
+            index._entries[email] = (expires_at, employee_no)
+            entries.append((expires_at, email, next(index._sequence), employee_no))
+
+        heapq.heapify(entries)
+        index._heap = entries
+        return index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, email, end_date, employee_no=None):
+        """Add or move a member's expiry; end_date may be a string or datetime."""
+        expires_at = end_date if isinstance(end_date, datetime) else parse_date(end_date)
+        if expires_at is None:
+            self.remove(email)
+            return
+
+        if self._entries.get(email) == (expires_at, employee_no):
+            return
+
+        self._entries[email] = (expires_at, employee_no)
+        heapq.heappush(self._heap, (expires_at, email, next(self._sequence), employee_no))
+
+    def remove(self, email):
+        self._entries.pop(email, None)
+
+    def next_expiry(self):
+        """Return the earliest pending expiry time, or None if the index is empty."""
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Remove and return (email, expires_at, employee_no) for every expiry up to now."""
+        now = now or datetime.now()
+        due = []
+
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            expires_at, email, _, employee_no = heapq.heappop(self._heap)
+            del self._entries[email]
+            due.append((email, expires_at, employee_no))
+
+        return due
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap:
+            expires_at, email, _, employee_no = heap[0]
+            if self._entries.get(email) == (expires_at, employee_no):
+                return
+            heapq.heappop(heap)
+
+
+def parse_date(value):
+    """Parse a Cardskipper/IVMS timestamp, returning None if it is missing or invalid."""
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
@@ -4,32 +4,88 @@ Final mock implementation of Cardskipper to IVMS integration.
 This script uses the exact data structure from both Cardskipper and IVMS examples.
 """
 
-import json
-import xml.etree.ElementTree as ET
-import sqlite3
 import logging
+import queue
+import atexit
+import threading
 import time
 from datetime import datetime, timedelta
 import os
+import argparse
 import random
 import string
-import re
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("mock_integration_final.log"),
-        logging.StreamHandler()
-    ]
-)
+from access_index import AccessIndex, latest_role, member_intervals, member_roles
+from circuit_breaker import CircuitOpenError, DeviceBusyError, DeviceRouter
+from coalesce import WriteCoalescer
+from db_pool import ConnectionPool, WriteQueue
+from expiry import ExpiryIndex, parse_date
+from matching import IdentityMatcher, ensure_review_schema, save_reviews
+import metrics
+from rate_limit import TokenBucket
+from sync_plan import plan_changes, plan_sharded, suppress_redundant_updates
+
+LOG_FILE = "mock_integration_final.log"
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
 logger = logging.getLogger("MockIntegrationFinal")
+log_listener = None
+
+
+def configure_logging(level=logging.INFO, log_file=LOG_FILE):
+    """Send log records through a queue so that formatting and file/console
+    I/O happen on a background thread instead of in the sync loop."""
+    global log_listener
+    if log_listener:
+        return log_listener
+    
+    # Imported here: logging.handlers pulls in socket and pickle, which
+    # importing this module should not pay for
+    import logging.handlers
+    
+    class DeferredQueueHandler(logging.handlers.QueueHandler):
+        """Queue handler that leaves message formatting to the listener thread."""
+        def prepare(self, record):
+            # The stock handler formats the message in the calling thread; the
+            # queue never leaves this process, so the record can be passed as-is
+            return record
+    
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    
+    log_listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(log_listener.stop)
+    return log_listener
+
+
+# Settings from the environment that could not be parsed; init() logs them
+_config_errors = []
+
+
+def _env_number(name, default, convert=float):
+    """Read a numeric setting from the environment; a bad value falls back to default."""
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        _config_errors.append((name, value, default))
+        return default
+
 
 # Path for mock data
 MOCK_DATA_DIR = "mock_data"
-if not os.path.exists(MOCK_DATA_DIR):
-    os.makedirs(MOCK_DATA_DIR)
 
 # Mock Cardskipper data
 CARDSKIPPER_MEMBERS_FILE = os.path.join(MOCK_DATA_DIR, "cardskipper_members_final.json")
@@ -38,59 +94,185 @@ IVMS_USERS_FILE = os.path.join(MOCK_DATA_DIR, "ivms_users_final.json")
 # SQLite database for integration
 DB_FILE = os.path.join(MOCK_DATA_DIR, "integration_final.db")
 
+# Circuit breaker settings for IVMS devices
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 30
+
+# Paging of IVMS user searches
+IVMS_PAGE_SIZE = 100
+IVMS_MAX_IN_FLIGHT = 4
+
+# Full refresh of the local IVMS mirror; a refresh is brought forward (but
+# not more often than the minimum interval) while members are still unmatched
+MIRROR_REFRESH_SECONDS = 3600
+MIRROR_MIN_REFRESH_SECONDS = 300
+
+# Number of worker processes used to plan a sync cycle (1 = in-process)
+SYNC_SHARDS = _env_number("INTEGRATION_SYNC_SHARDS", 1, int)
+
+# Delay before retrying an expiry that could not reach every device
+EXPIRY_RETRY_SECONDS = 60
+
+# IVMS updates wait this long after a member's first change, so that quick
+# successive changes reach the device as one write (0 = write immediately)
+COALESCE_WINDOW_SECONDS = _env_number("INTEGRATION_COALESCE_WINDOW", 0.0)
+
+# Read mock/export JSON through a memory map instead of buffered reads
+JSON_USE_MMAP = os.environ.get("INTEGRATION_JSON_MMAP", "").lower() in ("1", "true", "yes")
+
+# Backend the mocks keep their data in: "json" rewrites the data files on
+# every change, "sqlite" keeps indexed rows and imports the files once
+MOCK_STORAGE = os.environ.get("INTEGRATION_MOCK_STORAGE", "json")
+
+# Port for the Prometheus /metrics endpoint (unset = disabled)
+METRICS_PORT = _env_number("INTEGRATION_METRICS_PORT", 0, int) or None
+
+# Profiling of sync cycles (INTEGRATION_PROFILE=1 or --profile); every Nth
+# cycle is profiled to keep the overhead on the others at zero
+PROFILE = os.environ.get("INTEGRATION_PROFILE", "").lower() in ("1", "true", "yes")
+PROFILE_EVERY = _env_number("INTEGRATION_PROFILE_EVERY", 1, int)
+PROFILE_DIR = os.environ.get("INTEGRATION_PROFILE_DIR", "profiles")
+
+
+def init(log_level=logging.INFO):
+    """Set up logging and the mock data directory.
+    
+    Importing this module has no side effects; entry points call this first.
+    """
+    configure_logging(log_level)
+    for name, value, default in _config_errors:
+        logger.warning("Ignoring %s=%r, not a number; using %s", name, value, default)
+    os.makedirs(MOCK_DATA_DIR, exist_ok=True)
+
 class MockDatabase:
-    """Database manager for the integration."""
+    """Database manager for the integration.
+    
+    Safe to share between threads: reads use a connection per thread and
+    writes are funnelled through a single writer thread.
+    """
     def __init__(self, db_path):
         self.db_path = db_path
-        self.conn = None
-        self.cursor = None
+        self.pool = ConnectionPool(db_path)
+        self.writer = WriteQueue(self.pool)
         self.initialize_db()
     
+    @property
+    def conn(self):
+        """The calling thread's read connection."""
+        return self.pool.connection()
+    
     def initialize_db(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
-            self.cursor = self.conn.cursor()
-            
-            # Create members table if it doesn't exist
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS members (
-                    email TEXT PRIMARY KEY,
-                    organization_member_id TEXT,
-                    start_date TEXT,
-                    end_date TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    ivms_employee_no TEXT,
-                    member_code TEXT,
-                    role_id TEXT,
-                    role_name TEXT,
-                    phone TEXT
-                )
-            ''')
-            self.conn.commit()
-            
+            self.writer.run(self._create_schema)
             logger.info("Database initialized successfully")
         except Exception as e:
-            logger.error(f"Error initializing database: {e}")
+            logger.error("Error initializing database: %s", e)
             raise
     
+    def _create_schema(self, conn):
+        # Create members table if it doesn't exist
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS members (
+                email TEXT PRIMARY KEY,
+                organization_member_id TEXT,
+                start_date TEXT,
+                end_date TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                ivms_employee_no TEXT,
+                member_code TEXT,
+                role_id TEXT,
+                role_name TEXT,
+                phone TEXT
+            )
+        ''')
+        
+        # Add match columns to databases created before fuzzy matching
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(members)")}
+        if "match_method" not in columns:
+            conn.execute("ALTER TABLE members ADD COLUMN match_method TEXT")
+        if "match_confidence" not in columns:
+            conn.execute("ALTER TABLE members ADD COLUMN match_confidence REAL")
+        
+        # Updates that could not be delivered to an IVMS device
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ivms_backlog (
+                device_id TEXT NOT NULL,
+                employee_no TEXT NOT NULL,
+                email TEXT,
+                begin_time TEXT,
+                end_time TEXT,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (device_id, employee_no)
+            )
+        ''')
+        
+        # Weak identity matches waiting for a person to confirm them
+        ensure_review_schema(conn)
+        
+        # Updates held by the write coalescer, so they survive a restart
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS pending_writes (
+                employee_no TEXT PRIMARY KEY,
+                email TEXT,
+                begin_time TEXT,
+                end_time TEXT,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Last known circuit breaker state per IVMS device
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS device_health (
+                device_id TEXT PRIMARY KEY,
+                state TEXT,
+                failure_count INTEGER DEFAULT 0,
+                trip_count INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Last known state of every IVMS user, so cycles don't re-download them
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ivms_mirror (
+                employee_no TEXT PRIMARY KEY,
+                name TEXT,
+                email TEXT,
+                phone TEXT,
+                begin_time TEXT,
+                end_time TEXT,
+                enable INTEGER,
+                last_seen TEXT
+            )
+        ''')
+        
+        # Small key/value store for sync bookkeeping (refresh times etc.)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+    
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.writer.close()
+        self.pool.close()
     
     def get_all_members(self):
         try:
-            self.cursor.execute("""
+            cursor = self.conn.cursor()
+            cursor.execute("""
                 SELECT email, organization_member_id, start_date, end_date, 
                        first_name, last_name, ivms_employee_no, member_code, 
-                       role_id, role_name, phone 
+                       role_id, role_name, phone, match_method, match_confidence 
                 FROM members
             """)
-            rows = self.cursor.fetchall()
+            rows = cursor.fetchall()
             
             members = {}
             for row in rows:
-                email, org_member_id, start_date, end_date, first_name, last_name, ivms_employee_no, member_code, role_id, role_name, phone = row
+                email, org_member_id, start_date, end_date, first_name, last_name, ivms_employee_no, member_code, role_id, role_name, phone, match_method, match_confidence = row
                 members[email] = {
                     "email": email,
                     "organization_member_id": org_member_id,
@@ -102,84 +284,73 @@ class MockDatabase:
                     "member_code": member_code,
                     "role_id": role_id,
                     "role_name": role_name,
-                    "phone": phone
+                    "phone": phone,
+                    "match_method": match_method,
+                    "match_confidence": match_confidence
                 }
             
             return members
         except Exception as e:
-            logger.error(f"Error getting members from database: {e}")
+            logger.error("Error getting members from database: %s", e)
             return {}
     
-    def update_member(self, member, ivms_employee_no=None):
+    def update_member(self, member, ivms_employee_no=None, match=None):
         try:
-            # Extract values from the member dict
-            email = member["email"]
-            org_member_id = member["organization_member_id"]
-            start_date = member["start_date"]
-            end_date = member["end_date"]
-            first_name = member["first_name"]
-            last_name = member["last_name"]
-            member_code = member.get("member_code", "")
-            role_id = member.get("role_id", "")
-            role_name = member.get("role_name", "")
-            phone = member.get("phone", "")
-            
-            # Check if the member exists
-            self.cursor.execute("SELECT email FROM members WHERE email = ?", (email,))
-            existing_member = self.cursor.fetchone()
-            
-            if existing_member:
-                # Update existing member
-                if ivms_employee_no:
-                    self.cursor.execute("""
-                        UPDATE members 
-                        SET organization_member_id = ?, start_date = ?, end_date = ?, 
-                            first_name = ?, last_name = ?, ivms_employee_no = ?,
-                            member_code = ?, role_id = ?, role_name = ?, phone = ?
-                        WHERE email = ?
-                    """, (
-                        org_member_id, 
-                        start_date, 
-                        end_date,
-                        first_name,
-                        last_name,
-                        ivms_employee_no,
-                        member_code,
-                        role_id,
-                        role_name,
-                        phone,
-                        email
-                    ))
-                else:
-                    self.cursor.execute("""
-                        UPDATE members 
-                        SET organization_member_id = ?, start_date = ?, end_date = ?, 
-                            first_name = ?, last_name = ?,
-                            member_code = ?, role_id = ?, role_name = ?, phone = ?
-                        WHERE email = ?
-                    """, (
-                        org_member_id, 
-                        start_date, 
-                        end_date,
-                        first_name,
-                        last_name,
-                        member_code,
-                        role_id,
-                        role_name,
-                        phone,
-                        email
-                    ))
-            else:
-                # Insert new member
-                self.cursor.execute("""
-                    INSERT INTO members (
-                        email, organization_member_id, start_date, end_date,
-                        first_name, last_name, ivms_employee_no, member_code, 
-                        role_id, role_name, phone
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            self.writer.run(self._write_member, member, ivms_employee_no, match)
+            logger.debug("Updated member in database: %s", member['email'])
+        except Exception as e:
+            logger.error("Error updating member in database: %s", e)
+    
+    def update_members(self, entries, then=None):
+        """Write (member, ivms_employee_no, match) entries in a single transaction.
+        
+        then(conn), if given, runs in the same transaction, so other
+        bookkeeping commits together with the members. Returns True if the
+        transaction was committed.
+        """
+        def write_all(conn):
+            for member, ivms_employee_no, match in entries:
+                self._write_member(conn, member, ivms_employee_no, match)
+            if then is not None:
+                then(conn)
+        
+        try:
+            self.writer.run(write_all)
+            logger.info("Updated %s members in database", len(entries))
+            return True
+        except Exception as e:
+            logger.error("Error updating members in database: %s", e)
+            return False
+    
+    def _write_member(self, conn, member, ivms_employee_no=None, match=None):
+        # Extract values from the member dict
+        email = member["email"]
+        org_member_id = member["organization_member_id"]
+        start_date = member["start_date"]
+        end_date = member["end_date"]
+        first_name = member["first_name"]
+        last_name = member["last_name"]
+        member_code = member.get("member_code", "")
+        role_id = member.get("role_id", "")
+        role_name = member.get("role_name", "")
+        phone = member.get("phone", "")
+        match_method = match.method if match else None
+        match_confidence = match.confidence if match else None
+        
+        # Check if the member exists
+        existing_member = conn.execute("SELECT email FROM members WHERE email = ?", (email,)).fetchone()
+        
+        if existing_member:
+            # Update existing member
+            if match:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?, ivms_employee_no = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?,
+                        match_method = ?, match_confidence = ?
+                    WHERE email = ?
                 """, (
-                    email, 
                     org_member_id, 
                     start_date, 
                     end_date,
@@ -189,45 +360,442 @@ class MockDatabase:
                     member_code,
                     role_id,
                     role_name,
-                    phone
+                    phone,
+                    match_method,
+                    match_confidence,
+                    email
                 ))
-            
-            self.conn.commit()
-            logger.info(f"Updated member in database: {email}")
-        except Exception as e:
-            logger.error(f"Error updating member in database: {e}")
-            self.conn.rollback()
+            elif ivms_employee_no:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?, ivms_employee_no = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?
+                    WHERE email = ?
+                """, (
+                    org_member_id, 
+                    start_date, 
+                    end_date,
+                    first_name,
+                    last_name,
+                    ivms_employee_no,
+                    member_code,
+                    role_id,
+                    role_name,
+                    phone,
+                    email
+                ))
+            else:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?
+                    WHERE email = ?
+                """, (
+                    org_member_id, 
+                    start_date, 
+                    end_date,
+                    first_name,
+                    last_name,
+                    member_code,
+                    role_id,
+                    role_name,
+                    phone,
+                    email
+                ))
+        else:
+            # Insert new member
+            conn.execute("""
+                INSERT INTO members (
+                    email, organization_member_id, start_date, end_date,
+                    first_name, last_name, ivms_employee_no, member_code, 
+                    role_id, role_name, phone, match_method, match_confidence
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                email, 
+                org_member_id, 
+                start_date, 
+                end_date,
+                first_name,
+                last_name,
+                ivms_employee_no,
+                member_code,
+                role_id,
+                role_name,
+                phone,
+                match_method,
+                match_confidence
+            ))
+    
+    def get_unmatched_members(self, ending_after):
+        """Return stored members without an IVMS employee number whose membership ends after ending_after."""
+        return [
+            member for member in self.get_all_members().values()
+            if not member["ivms_employee_no"] and (member["end_date"] or "") > ending_after
+        ]
     
     def get_ivms_employee_no(self, email):
         try:
-            self.cursor.execute("SELECT ivms_employee_no FROM members WHERE email = ?", (email,))
-            result = self.cursor.fetchone()
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT ivms_employee_no FROM members WHERE email = ?", (email,))
+            result = cursor.fetchone()
             return result[0] if result and result[0] else None
         except Exception as e:
-            logger.error(f"Error getting IVMS employee number for {email}: {e}")
+            logger.error("Error getting IVMS employee number for %s: %s", email, e)
             return None
+    
+    def get_linked_employee_nos(self):
+        """Return the IVMS employee numbers already linked to a member."""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT ivms_employee_no FROM members WHERE ivms_employee_no IS NOT NULL")
+            return {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error("Error getting linked employee numbers from database: %s", e)
+            return set()
+    
+    def get_member_expiries(self):
+        """Return (email, end_date, ivms_employee_no) for every member."""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT email, end_date, ivms_employee_no FROM members")
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error("Error getting member expiries from database: %s", e)
+            return []
+    
+    def enqueue_backlog(self, device_id, update):
+        """Park an IVMS update for a device that is currently unreachable."""
+        try:
+            # Only the latest intended validity per employee is kept
+            self.writer.execute("""
+                INSERT OR REPLACE INTO ivms_backlog (device_id, employee_no, email, begin_time, end_time)
+                VALUES (?, ?, ?, ?, ?)
+            """, (
+                device_id,
+                update["ivms_employee_no"],
+                update["email"],
+                update["start_date"],
+                update["end_date"]
+            ))
+        except Exception as e:
+            logger.error("Error adding backlog entry for %s: %s", update['email'], e)
+    
+    def get_backlog(self, device_id):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT employee_no, email, begin_time, end_time
+                FROM ivms_backlog
+                WHERE device_id = ?
+                ORDER BY queued_at
+            """, (device_id,))
+            return [
+                {
+                    "ivms_employee_no": employee_no,
+                    "email": email,
+                    "start_date": begin_time,
+                    "end_date": end_time
+                }
+                for employee_no, email, begin_time, end_time in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error("Error getting backlog for device %s: %s", device_id, e)
+            return []
+    
+    def get_backlog_depths(self):
+        """Return the number of backlogged updates per device."""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT device_id, COUNT(*) FROM ivms_backlog GROUP BY device_id")
+            return dict(cursor.fetchall())
+        except Exception as e:
+            logger.error("Error counting backlog entries: %s", e)
+            return {}
+    
+    def remove_backlog(self, device_id, employee_no):
+        try:
+            self.writer.execute(
+                "DELETE FROM ivms_backlog WHERE device_id = ? AND employee_no = ?",
+                (device_id, employee_no)
+            )
+        except Exception as e:
+            logger.error("Error removing backlog entry for %s: %s", employee_no, e)
+    
+    def save_match_reviews(self, conn, reviews):
+        """Queue (member, match) pairs for review; runs inside a writer transaction."""
+        save_reviews(conn, reviews)
+    
+    def get_match_reviews(self, status="pending"):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT r.email, r.employee_no, r.method, r.confidence, m.first_name, m.last_name, m.phone
+                FROM match_review r LEFT JOIN members m ON m.email = r.email
+                WHERE r.status = ?
+                ORDER BY r.first_seen
+            """, (status,))
+            columns = ("email", "employee_no", "method", "confidence", "first_name", "last_name", "phone")
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error("Error getting match reviews: %s", e)
+            return []
+    
+    def approve_match(self, email):
+        """Link a member to its reviewed candidate; returns False if that is no longer possible."""
+        def approve(conn):
+            row = conn.execute(
+                "SELECT employee_no, method, confidence FROM match_review WHERE email = ? AND status = 'pending'",
+                (email,)
+            ).fetchone()
+            if row is None:
+                return False
+            employee_no, method, confidence = row
+            if conn.execute("SELECT 1 FROM members WHERE ivms_employee_no = ?", (employee_no,)).fetchone():
+                logger.warning("IVMS user %s is already linked to another member", employee_no)
+                return False
+            # Clearing the end date makes the next cycle push the validity
+            conn.execute("""
+                UPDATE members
+                SET ivms_employee_no = ?, match_method = ?, match_confidence = ?, end_date = NULL
+                WHERE email = ?
+            """, (employee_no, f"{method}+review", confidence, email))
+            conn.execute("UPDATE match_review SET status = 'approved' WHERE email = ?", (email,))
+            return True
+        
+        try:
+            return self.writer.run(approve)
+        except Exception as e:
+            logger.error("Error approving match for %s: %s", email, e)
+            return False
+    
+    def reject_match(self, email):
+        """Keep a member from being linked to its reviewed candidate."""
+        try:
+            return self.writer.execute(
+                "UPDATE match_review SET status = 'rejected' WHERE email = ? AND status = 'pending'", (email,)
+            ) > 0
+        except Exception as e:
+            logger.error("Error rejecting match for %s: %s", email, e)
+            return False
+    
+    def save_pending_writes(self, conn, updates):
+        """Record updates handed to the write coalescer; runs inside a writer transaction."""
+        # Only the latest intended validity per employee is kept, as in the coalescer
+        conn.executemany("""
+            INSERT OR REPLACE INTO pending_writes (employee_no, email, begin_time, end_time)
+            VALUES (?, ?, ?, ?)
+        """, [(u["ivms_employee_no"], u["email"], u["start_date"], u["end_date"]) for u in updates])
+    
+    def get_pending_writes(self):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT employee_no, email, begin_time, end_time FROM pending_writes ORDER BY queued_at")
+            return [
+                {
+                    "ivms_employee_no": employee_no,
+                    "email": email,
+                    "start_date": begin_time,
+                    "end_date": end_time
+                }
+                for employee_no, email, begin_time, end_time in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error("Error getting pending writes: %s", e)
+            return []
+    
+    def remove_pending_writes(self, updates):
+        """Forget pending updates that were pushed; a newer validity queued since is kept."""
+        try:
+            self.writer.executemany(
+                "DELETE FROM pending_writes WHERE employee_no = ? AND begin_time = ? AND end_time = ?",
+                [(u["ivms_employee_no"], u["start_date"], u["end_date"]) for u in updates]
+            )
+        except Exception as e:
+            logger.error("Error removing pending writes: %s", e)
+    
+    def save_device_health(self, snapshots):
+        """Persist circuit breaker snapshots so the dashboard can show them."""
+        try:
+            self.writer.executemany("""
+                INSERT OR REPLACE INTO device_health (
+                    device_id, state, failure_count, trip_count, last_error, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, [
+                (s["device_id"], s["state"], s["failure_count"], s["trip_count"], s["last_error"])
+                for s in snapshots
+            ])
+        except Exception as e:
+            logger.error("Error saving device health: %s", e)
+    
+    def get_device_health(self):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT device_id, state, failure_count, trip_count, last_error
+                FROM device_health
+            """)
+            return [
+                {
+                    "device_id": device_id,
+                    "state": state,
+                    "failure_count": failure_count,
+                    "trip_count": trip_count,
+                    "last_error": last_error
+                }
+                for device_id, state, failure_count, trip_count, last_error in cursor.fetchall()
+            ]
+        except Exception as e:
+            logger.error("Error getting device health: %s", e)
+            return []
+    
+    def get_state(self, key, default=None):
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+            result = cursor.fetchone()
+            return result[0] if result else default
+        except Exception as e:
+            logger.error("Error getting sync state %s: %s", key, e)
+            return default
+    
+    def set_state(self, key, value):
+        try:
+            self.writer.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+        except Exception as e:
+            logger.error("Error saving sync state %s: %s", key, e)
+    
+    def refresh_ivms_mirror(self, users, batch_size=500):
+        """Replace the IVMS mirror with the users streamed from a device.
+        
+        Rows are written in batches as they arrive; users that were not seen
+        in this refresh are removed once the stream has been read completely.
+        """
+        refreshed_at = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        count = 0
+        batch = []
+        
+        for user in users:
+            valid = user.get("Valid", {})
+            batch.append((
+                user["employeeNo"],
+                user.get("name"),
+                user.get("email"),
+                user.get("phoneNo"),
+                valid.get("beginTime"),
+                valid.get("endTime"),
+                1 if valid.get("enable") else 0,
+                refreshed_at
+            ))
+            if len(batch) >= batch_size:
+                count += self._write_mirror_batch(batch)
+                batch = []
+        
+        if batch:
+            count += self._write_mirror_batch(batch)
+        
+        self.writer.execute("DELETE FROM ivms_mirror WHERE last_seen < ?", (refreshed_at,))
+        return count
+    
+    def _write_mirror_batch(self, batch):
+        self.writer.executemany("""
+            INSERT OR REPLACE INTO ivms_mirror (
+                employee_no, name, email, phone, begin_time, end_time, enable, last_seen
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, batch)
+        return len(batch)
+    
+    def get_mirror_users(self):
+        """Yield mirrored IVMS users in the same shape as the device returns them."""
+        try:
+            rows = self.conn.execute("""
+                SELECT employee_no, name, email, phone, begin_time, end_time, enable
+                FROM ivms_mirror
+            """)
+            for employee_no, name, email, phone, begin_time, end_time, enable in rows:
+                yield {
+                    "employeeNo": employee_no,
+                    "name": name,
+                    "email": email,
+                    "phoneNo": phone,
+                    "Valid": {
+                        "enable": bool(enable),
+                        "beginTime": begin_time,
+                        "endTime": end_time
+                    }
+                }
+        except Exception as e:
+            logger.error("Error reading IVMS mirror: %s", e)
+    
+    def get_mirror_validity(self, employee_nos):
+        """Return {employee_no: (begin_time, end_time, enable)} from the mirror."""
+        employee_nos = list(employee_nos)
+        validity = {}
+        try:
+            cursor = self.conn.cursor()
+            # Stay well below SQLite's limit on bound parameters
+            for i in range(0, len(employee_nos), 500):
+                chunk = employee_nos[i:i + 500]
+                cursor.execute(f"""
+                    SELECT employee_no, begin_time, end_time, enable
+                    FROM ivms_mirror
+                    WHERE employee_no IN ({", ".join("?" * len(chunk))})
+                """, chunk)
+                for employee_no, begin_time, end_time, enable in cursor.fetchall():
+                    validity[employee_no] = (begin_time, end_time, bool(enable))
+        except Exception as e:
+            logger.error("Error reading validity from IVMS mirror: %s", e)
+        return validity
+    
+    def update_mirror_validity(self, employee_no, begin_time=None, end_time=None, enable=True):
+        """Record a validity change we made on the device."""
+        try:
+            if begin_time is None:
+                self.writer.execute(
+                    "UPDATE ivms_mirror SET enable = ? WHERE employee_no = ?",
+                    (1 if enable else 0, employee_no)
+                )
+            else:
+                self.writer.execute(
+                    "UPDATE ivms_mirror SET begin_time = ?, end_time = ?, enable = ? WHERE employee_no = ?",
+                    (begin_time, end_time, 1 if enable else 0, employee_no)
+                )
+        except Exception as e:
+            logger.error("Error updating IVMS mirror for %s: %s", employee_no, e)
 
 
 class MockCardskipper:
-    """Mock Cardskipper API with sample data."""
-    def __init__(self, data_file):
+    """Mock Cardskipper API with sample data.
+    
+    Members are kept in a storage backend (see mock_storage); with the JSON
+    backend they are streamed from the data file on every read.
+    """
+    def __init__(self, data_file, use_mmap=JSON_USE_MMAP, storage=MOCK_STORAGE):
+        # Imported here so importing this module stays cheap
+        from mock_storage import open_member_store
+        
         self.data_file = data_file
+        self.store = open_member_store(data_file, storage, use_mmap)
         self.load_or_create_data()
     
     def load_or_create_data(self):
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-                self.members = data.get("members", [])
-        else:
+        if not self.store.exists():
             # Create mock data
-            self.members = self.generate_mock_members()
-            with open(self.data_file, 'w') as f:
-                json.dump({"members": self.members}, f, indent=2)
+            self.store.replace(self.generate_mock_members())
+    
+    def iter_members(self):
+        """Yield raw members one at a time."""
+        return self.store.iter_members()
     
-    def save_data(self):
-        with open(self.data_file, 'w') as f:
-            json.dump({"members": self.members}, f, indent=2)
+    def count_members(self):
+        return self.store.count()
+    
+    def close(self):
+        self.store.close()
     
     def generate_mock_member_code(self, length=6):
         """Generate a random member code."""
@@ -532,25 +1100,53 @@ class MockCardskipper:
                     "Extra2": "",
                     "Extra3": ""
                 }
-            
+
+            # Some members came back for a month after their membership ran out
+            if i % 4 == 0:
+                roles_entry = member["Organisations"]["Organisation"]["Roles"]
+                roles_entry["Role"] = [roles_entry["Role"], {
+                    "Id": 459,
+                    "Name": "Mesečna",
+                    "StartDate": "2025-09-01T00:00:00",
+                    "EndDate": "2025-09-30T23:59:59",
+                    "Type": "Regular",
+                    "OrganisationUnit": "Adult"
+                }]
+
             members.append(member)
-        
+
         return members
-    
-    def get_active_members(self):
+
+    def get_active_members(self, organisation_id=None, modified_since=None):
         """Return only active members in a simplified format."""
-        active_members = []
+        return list(self.iter_active_members(organisation_id, modified_since))
+    
+    def iter_active_members(self, organisation_id=None, modified_since=None):
+        """Yield active members in a simplified format as they are read.
+        
+        With organisation_id set, only members of that organisation are
+        returned. With modified_since set, members the store knows to be
+        unchanged since then are left out.
+        """
         today = datetime.now()
         
-        for member in self.members:
+        # The store skips members that ended already where it can tell cheaply
+        members = self.store.iter_members(today.strftime("%Y-%m-%dT%H:%M:%S"), organisation_id, modified_since)
+        for member in members:
             try:
-                # Extract key information
-                role = member["Organisations"]["Organisation"]["Roles"]["Role"]
-                end_date_str = role["EndDate"]
-                end_date = datetime.strptime(end_date_str, "%Y-%m-%dT%H:%M:%S")
-                
-                # Check if membership is active (end date is in the future)
-                if end_date > today:
+                # Stacked renewals, overlapping roles and pauses: validity is
+                # the union of the role intervals, and the member is active if
+                # one of its merged intervals has not ended yet
+                window = next(
+                    (interval for interval in member_intervals(member, organisation_id) if interval[1] > today),
+                    None
+                )
+                if window is not None:
+                    # The role that closes the window names the membership
+                    organisation, role = next(
+                        pair for pair in member_roles(member, organisation_id)
+                        if parse_date(pair[1]["EndDate"]) == window[1]
+                    )
                     # Create a simplified member object for internal use
                     simplified_member = {
                         "organization_member_id": member["OrganisationMemberId"],
@@ -559,79 +1155,84 @@ class MockCardskipper:
                         "email": member["ContactInfo"]["EMail"],
                         "phone": member["ContactInfo"]["CellPhone1"],
                         "member_code": member["MemberCode"],
-                        "start_date": role["StartDate"],
-                        "end_date": role["EndDate"],
+                        "start_date": window[0].strftime("%Y-%m-%dT%H:%M:%S"),
+                        "end_date": window[1].strftime("%Y-%m-%dT%H:%M:%S"),
                         "role_id": str(role["Id"]),
-                        "role_name": role["Name"]
+                        "role_name": role["Name"],
+                        "organisation_id": str(organisation["Id"])
                     }
-                    active_members.append(simplified_member)
+                    yield simplified_member
             except (KeyError, ValueError) as e:
-                logger.error(f"Error processing member {member.get('OrganisationMemberId', 'unknown')}: {e}")
-        
-        return active_members
+                logger.error("Error processing member %s: %s", member.get('OrganisationMemberId', 'unknown'), e)
+    
+    def access_index(self, organisation_id=None):
+        """Build a point-in-time access index over the members' role intervals."""
+        return AccessIndex.from_members(self.store.iter_members(organisation_id=organisation_id), organisation_id)
     
     def extend_membership(self, email, days=30):
         """Extend a member's membership by the specified number of days."""
-        for member in self.members:
-            try:
-                if member["ContactInfo"]["EMail"] == email:
-                    # Get the role
-                    role = member["Organisations"]["Organisation"]["Roles"]["Role"]
-                    
-                    # Parse the current end date
-                    current_end_str = role["EndDate"]
-                    current_end = datetime.strptime(current_end_str, "%Y-%m-%dT%H:%M:%S")
-                    
-                    # Add days
-                    new_end = current_end + timedelta(days=days)
-                    
-                    # Update the member
-                    role["EndDate"] = new_end.strftime("%Y-%m-%dT%H:%M:%S")
-                    
-                    # Save changes
-                    self.save_data()
-                    
-                    logger.info(f"Extended membership for {email} by {days} days")
-                    return True
-            except (KeyError, ValueError) as e:
-                logger.error(f"Error extending membership for {email}: {e}")
+        member = self.store.find_by_email(email)
+        if member is None:
+            logger.warning("Member with email %s not found", email)
+            return False
         
-        logger.warning(f"Member with email {email} not found")
-        return False
+        try:
+            # Get the role that ends last
+            _, role = latest_role(member)
+            
+            # Parse the current end date
+            current_end_str = role["EndDate"]
+            current_end = datetime.strptime(current_end_str, "%Y-%m-%dT%H:%M:%S")
+            
+            # Add days
+            new_end = current_end + timedelta(days=days)
+            
+            # Update and save the member
+            self.store.set_end_date(email, new_end.strftime("%Y-%m-%dT%H:%M:%S"))
+            
+            logger.info("Extended membership for %s by %s days", email, days)
+            return True
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Error extending membership for %s: %s", email, e)
+            return False
 
 
 class MockIVMS:
     """Mock IVMS API with sample data based on the provided example."""
-    def __init__(self, data_file):
+    def __init__(self, data_file, device_id="ivms-1", use_mmap=JSON_USE_MMAP, storage=MOCK_STORAGE):
+        # Imported here so importing this module stays cheap
+        from mock_storage import open_user_store
+        
         self.data_file = data_file
+        self.device_id = device_id
+        self.store = open_user_store(data_file, storage, use_mmap)
+        # Set to False to simulate a controller that stopped responding
+        self.online = True
+        # Simulated controller capacity: users written per second before it
+        # answers busy (None = unlimited), and time spent per write request
+        # and per user; requests are served one at a time
+        self.max_users_per_second = None
+        self.request_seconds = 0.0
+        self.user_seconds = 0.0
+        self._capacity = None
+        self._serving = threading.Lock()
         self.load_or_create_data()
     
     def load_or_create_data(self):
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-                self.user_info = data.get("UserInfoSearchResult", {}).get("UserInfo", [])
-                self.search_id = data.get("UserInfoSearchResult", {}).get("searchID", "1")
-                self.total_matches = len(self.user_info)
-        else:
+        if not self.store.exists():
             # Create mock data
-            self.user_info = self.generate_mock_users()
-            self.search_id = "1"
-            self.total_matches = len(self.user_info)
-            self.save_data()
-    
-    def save_data(self):
-        data = {
-            "UserInfoSearchResult": {
-                "searchID": self.search_id,
-                "responseStatusStrg": "OK",
-                "numOfMatches": self.total_matches,
-                "totalMatches": self.total_matches,
-                "UserInfo": self.user_info
-            }
-        }
-        with open(self.data_file, 'w') as f:
-            json.dump(data, f, indent=2)
+            self.store.replace(self.generate_mock_users())
+    
+    @property
+    def user_info(self):
+        return self.store.all_users()
+    
+    @property
+    def total_matches(self):
+        return self.store.count()
+    
+    def close(self):
+        self.store.close()
     
     def generate_mock_users(self):
         """Generate mock IVMS user data based on the example."""
@@ -770,127 +1371,499 @@ class MockIVMS:
         
         return users
     
+    def check_available(self):
+        """Raise TimeoutError if the simulated device is offline."""
+        if not self.online:
+            raise TimeoutError(f"IVMS device {self.device_id} did not respond")
+    
+    def get_device_info(self):
+        """Return basic device information (used as a health probe)."""
+        self.check_available()
+        return {"deviceID": self.device_id, "model": "MockIVMS"}
+    
     def get_all_users(self):
         """Return all IVMS users."""
-        return self.user_info
+        self.check_available()
+        return self.store.all_users()
+    
+    def search_users(self, search_id, position, max_results):
+        """Return one page of users, shaped like an ISAPI UserInfo/search response."""
+        self.check_available()
+        page = self.store.page(position, max_results, search_id)
+        total_matches = self.store.count()
+        
+        if not page:
+            status = "NO MATCH"
+        elif position + len(page) < total_matches:
+            status = "MORE"
+        else:
+            status = "OK"
+        
+        return {
+            "searchID": search_id,
+            "responseStatusStrg": status,
+            "numOfMatches": len(page),
+            "totalMatches": total_matches,
+            "UserInfo": page
+        }
     
     def get_user_by_email(self, email):
         """Find a user by email."""
-        for user in self.user_info:
-            if user.get("email") == email:
-                return user
-        return None
+        return self.store.find_by_email(email)
+
+    def get_user(self, employee_no):
+        """Return one user by employee number, or None."""
+        self.check_available()
+        return self.store.get(employee_no)
+
+    def _serve_write(self, users):
+        """Simulate the controller's write capacity and latency."""
+        if self.max_users_per_second:
+            if self._capacity is None or self._capacity.rate != self.max_users_per_second:
+                self._capacity = TokenBucket(self.max_users_per_second)
+            if not self._capacity.try_acquire(users):
+                raise DeviceBusyError(f"IVMS device {self.device_id} is busy")
+        if self.request_seconds or self.user_seconds:
+            with self._serving:
+                time.sleep(self.request_seconds + self.user_seconds * users)
     
     def update_user_validity(self, employee_no, begin_time, end_time):
         """Update a user's validity period."""
-        for user in self.user_info:
-            if user["employeeNo"] == employee_no:
-                user["Valid"]["beginTime"] = begin_time
-                user["Valid"]["endTime"] = end_time
-                user["Valid"]["enable"] = True
-                self.save_data()
-                logger.info(f"Updated validity for user {employee_no}")
-                return True
-        
-        logger.warning(f"User with employee number {employee_no} not found")
+        self.check_available()
+        self._serve_write(1)
+        if self.store.update_validity(employee_no, begin_time, end_time, enable=True):
+            logger.debug("Updated validity for user %s", employee_no)
+            return True
+        
+        logger.warning("User with employee number %s not found", employee_no)
         return False
+    
+    def update_users_validity(self, validities):
+        """Update the validity of several users in one request.
+        
+        validities holds (employee_no, begin_time, end_time) tuples; returns
+        the employee numbers that were found and updated.
+        """
+        self.check_available()
+        self._serve_write(len(validities))
+        updated = self.store.set_validities(validities)
+        if len(updated) < len(validities):
+            missing = {employee_no for employee_no, _, _ in validities} - set(updated)
+            logger.warning("Users with employee numbers %s not found", ", ".join(sorted(missing)))
+        return updated
+    
+    def disable_user(self, employee_no):
+        """Disable a user's access without touching the validity period."""
+        self.check_available()
+        user = self.store.get(employee_no)
+        if user is None:
+            logger.warning("User with employee number %s not found", employee_no)
+            return False
+        
+        if user["Valid"]["enable"]:
+            self.store.update_validity(employee_no, enable=False)
+            logger.debug("Disabled user %s", employee_no)
+        return True
 
 
 class MockSyncService:
     """Mock service to synchronize Cardskipper and IVMS data."""
-    def __init__(self, cardskipper, ivms, db):
+    def __init__(self, cardskipper, ivms, db,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_TIMEOUT,
+                 shards=SYNC_SHARDS,
+                 mirror_refresh_seconds=MIRROR_REFRESH_SECONDS,
+                 coalesce_window_seconds=COALESCE_WINDOW_SECONDS,
+                 pacing=None):
         self.cardskipper = cardskipper
-        self.ivms = ivms
+        # A site may have several controllers that all hold the same users
+        self.devices = list(ivms) if isinstance(ivms, (list, tuple)) else [ivms]
+        self.ivms = self.devices[0]
         self.db = db
+        self.router = DeviceRouter(
+            self.devices,
+            db,
+            failure_threshold=failure_threshold,
+            reset_timeout=reset_timeout,
+            saved_health=db.get_device_health(),
+            pacing=pacing
+        )
+        # Rebuild the expiry index from the last known state
+        self.expiry = ExpiryIndex.from_rows(db.get_member_expiries())
+        logger.info("Expiry index loaded with %s members", len(self.expiry))
+        
+        # Sharded planning needs a database file the workers can open
+        self.shards = shards if db.db_path != ":memory:" else 1
+        self.executor = None
+        
+        self.mirror_refresh_seconds = mirror_refresh_seconds
+        self.unmatched_count = 0
+        # Device writes skipped because IVMS already had the intended validity
+        self.suppressed_total = 0
+        self.coalescer = WriteCoalescer(coalesce_window_seconds)
+        
+        # Updates a previous run had coalesced but not pushed yet
+        pending = db.get_pending_writes()
+        for update in pending:
+            self.coalescer.offer(update)
+        if pending:
+            logger.info("Restored %s pending IVMS updates", len(pending))
+    
+    def close(self):
+        """Write out updates still waiting to be coalesced and shut down the shard workers."""
+        self.flush_pending(drain=True)
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
     
-    def sync(self):
-        """Synchronize membership data between systems."""
+    def refresh_mirror(self, force=False):
+        """Re-download all IVMS users into the local mirror when it is due.
+        
+        Returns True if the mirror was refreshed.
+        """
+        refreshed_at = self.db.get_state("ivms_mirror_refreshed_at")
+        if refreshed_at and not force:
+            age = (datetime.now() - datetime.strptime(refreshed_at, "%Y-%m-%dT%H:%M:%S")).total_seconds()
+            # Bring the refresh forward while new members are waiting for a match
+            interval = MIRROR_MIN_REFRESH_SECONDS if self.unmatched_count else self.mirror_refresh_seconds
+            if age < min(interval, self.mirror_refresh_seconds):
+                return False
+        
+        try:
+            # Stream IVMS users page by page from the first device that responds
+            count = self.db.refresh_ivms_mirror(self.router.iter_users(IVMS_PAGE_SIZE, IVMS_MAX_IN_FLIGHT))
+        except (OSError, CircuitOpenError) as e:
+            logger.warning("Could not refresh IVMS mirror, using last known state: %s", e)
+            return False
+        
+        self.db.set_state("ivms_mirror_refreshed_at", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+        logger.info("IVMS mirror refreshed with %s users", count)
+        return True
+    
+    def build_matcher(self, claimed, ivms_users=None):
+        """Index IVMS users for matching, skipping users already linked to a member."""
+        if ivms_users is None:
+            ivms_users = self.db.get_mirror_users()
+        
+        return IdentityMatcher(ivms_users, claimed=claimed)
+    
+    def plan(self, cardskipper_members):
+        """Work out the database writes and IVMS updates for this cycle in-process."""
+        # Get all members from database
+        db_members = self.db.get_all_members()
+        
+        # IVMS users are only fetched if some member still needs matching.
+        # Matched members keep their employee number, so this runs once per
+        # new member rather than every cycle.
+        matcher = None
+        
+        def match_member(member):
+            nonlocal matcher
+            if matcher is None:
+                claimed = {m["ivms_employee_no"] for m in db_members.values() if m["ivms_employee_no"]}
+                matcher = self.build_matcher(claimed)
+            match = matcher.match(member)
+            if match and not match.needs_review:
+                matcher.claim(match.employee_no)
+            return match
+        
+        return plan_changes(cardskipper_members, db_members, match_member)
+    
+    def plan_in_shards(self, cardskipper_members):
+        """Work out this cycle's changes across a pool of worker processes.
+        
+        Members and IVMS users are partitioned by a hash of their email; each
+        worker diffs its slice against its slice of the database and makes the
+        email matches. Members still unmatched afterwards are matched here by
+        phone or name against all IVMS users.
+        """
+        if self.executor is None:
+            # multiprocessing is only imported once sharding is actually used
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=self.shards)
+        
+        ivms_users = list(self.db.get_mirror_users())
+        # Every shard must know the users linked to members of the others
+        claimed = self.db.get_linked_employee_nos()
+        changes = plan_sharded(
+            self.executor, self.db.db_path, cardskipper_members, ivms_users, self.shards, claimed
+        )
+        
+        if not changes["unmatched"] or not ivms_users:
+            return changes
+        
+        claimed.update(employee_no for member, employee_no, match in changes["writes"] if employee_no)
+        matcher = self.build_matcher(claimed, ivms_users)
+        
+        def match_member(member):
+            match = matcher.match(member)
+            if match and not match.needs_review:
+                matcher.claim(match.employee_no)
+            return match
+        
+        fallback = plan_changes(changes["unmatched"], changes["db_members"], match_member)
+        
+        # Writes without an employee number all belong to unmatched members,
+        # which the fallback pass has planned again
+        changes["writes"] = [w for w in changes["writes"] if w[1]] + fallback["writes"]
+        changes["updates"].extend(fallback["updates"])
+        changes["unmatched"] = fallback["unmatched"]
+        changes["review"] = fallback["review"]
+        return changes
+    
+    def process_expirations(self, now=None):
+        """Disable IVMS access for every membership that has expired by now."""
+        now = now or datetime.now()
+        expired_count = 0
+        
+        for email, expires_at, employee_no in self.expiry.pop_due(now):
+            if not employee_no:
+                continue
+            
+            result = self.router.disable_user(employee_no)
+            if result["applied"]:
+                self.db.update_mirror_validity(employee_no, enable=False)
+            if result["queued"]:
+                # A device is unhealthy, try again later
+                self.expiry.schedule(email, now + timedelta(seconds=EXPIRY_RETRY_SECONDS), employee_no)
+                logger.warning("Could not disable %s on every device, retrying in %s seconds", email, EXPIRY_RETRY_SECONDS)
+            else:
+                logger.info("Membership for %s expired at %s, IVMS access disabled", email, expires_at)
+            expired_count += 1
+        
+        return expired_count
+    
+    def seconds_until_due(self):
+        """Seconds until the next expiry or coalesced write falls due; None if nothing is waiting."""
+        waits = []
+        next_expiry = self.expiry.next_expiry()
+        if next_expiry:
+            waits.append(max(0.0, (next_expiry - datetime.now()).total_seconds()))
+        pending_due = self.coalescer.seconds_until_due()
+        if pending_due is not None:
+            waits.append(pending_due)
+        return min(waits) if waits else None
+    
+    def run_due(self):
+        """Fire the expirations and coalesced writes that have fallen due."""
+        self.process_expirations()
+        self.flush_pending()
+    
+    def wait(self, seconds):
+        """Sleep until the next sync, firing expirations and coalesced writes as they fall due."""
+        deadline = time.monotonic() + seconds
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            
+            due = self.seconds_until_due()
+            time.sleep(remaining if due is None else min(remaining, due))
+            self.run_due()
+    
+    def sync(self, changed_since=None):
+        """Synchronize membership data between systems.
+        
+        With changed_since set, only members changed in Cardskipper since
+        then are compared, plus members still waiting for an IVMS match when
+        the mirror was just refreshed; expiries are kept by the expiry index
+        either way. Returns a summary of the cycle.
+        """
+        started = time.perf_counter()
+        phase = metrics.SYNC_PHASE_SECONDS.labels
+        summary = {
+            "members": 0,
+            "updates_needed": 0,
+            "updates_pushed": 0,
+            "updates_queued": 0,
+            "writes_suppressed": 0,
+            "writes_coalesced": 0,
+            "updates_pending": 0,
+            "matches_to_review": 0,
+            "duration_seconds": 0.0,
+            "succeeded": False
+        }
+        succeeded = False
         try:
             logger.info("Starting synchronization")
             
+            # Replay updates for devices that have come back online
+            with phase("recover").time():
+                self.router.recover()
+            
+            # Act on memberships that expired since the last cycle
+            with phase("expirations").time():
+                self.process_expirations()
+            
+            # Re-download IVMS users only on the slower mirror cadence
+            with phase("mirror_refresh").time():
+                mirror_refreshed = self.refresh_mirror()
+            
             # Get active members from Cardskipper
-            cardskipper_members = self.cardskipper.get_active_members()
+            with phase("fetch_members").time():
+                if changed_since is None:
+                    cardskipper_members = self.cardskipper.get_active_members()
+                else:
+                    cardskipper_members = self.cardskipper.get_active_members(modified_since=changed_since)
+            
+            # Only a fresh mirror can hold a match for members still unmatched,
+            # so those are retried by themselves rather than by a full scan.
+            # Their stored record stands in for the Cardskipper one: a change
+            # to the member would have put it among the changed members.
+            retried_unmatched = changed_since is not None and mirror_refreshed
+            if retried_unmatched:
+                changed = {member["email"] for member in cardskipper_members}
+                cardskipper_members = list(cardskipper_members) + [
+                    member for member in self.db.get_unmatched_members(datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+                    if member["email"] not in changed
+                ]
             
-            if not cardskipper_members:
+            # A cycle with nothing changed still pushes coalesced writes that fell due
+            if not cardskipper_members and changed_since is None:
                 logger.warning("No active members found in Cardskipper")
-                return
+                succeeded = True
+                return summary
+            summary["members"] = len(cardskipper_members)
+            metrics.MEMBERS_SCANNED.inc(len(cardskipper_members))
             
-            # Get all members from database
-            db_members = self.db.get_all_members()
+            # Compare with the stored state to find what changed
+            with phase("plan").time():
+                if self.shards > 1:
+                    changes = self.plan_in_shards(cardskipper_members)
+                else:
+                    changes = self.plan(cardskipper_members)
             
-            # Get all IVMS users
-            ivms_users = self.ivms.get_all_users()
+            # Update members in our database
+            # Updates are recorded with the members: the stored end dates no
+            # longer show them as needed, so they must survive a restart
+            def save_pending(conn):
+                self.db.save_pending_writes(conn, changes["updates"])
+                self.db.save_match_reviews(conn, changes["review"])
             
-            # Create email to user ID mapping
-            email_to_user_id = {}
-            for user in ivms_users:
-                if "email" in user and user["email"]:
-                    email_to_user_id[user["email"]] = user["employeeNo"]
+            with phase("db_write").time():
+                self.db.update_members(changes["writes"], then=save_pending)
+                for member, ivms_employee_no, match in changes["writes"]:
+                    self.expiry.schedule(member["email"], member["end_date"], ivms_employee_no)
+            metrics.MEMBERS_CHANGED.inc(len(changes["writes"]))
             
-            # Process each member from Cardskipper
-            updates_needed = []
-            for member in cardskipper_members:
-                try:
-                    email = member["email"]
-                    
-                    # Check if we need to update this member
-                    needs_update = False
-                    ivms_employee_no = None
-                    
-                    # Check if member exists in our database
-                    if email in db_members:
-                        db_member = db_members[email]
-                        db_end_date = db_member["end_date"]
-                        
-                        # If end date has changed, we need to update
-                        if db_end_date != member["end_date"]:
-                            needs_update = True
-                            logger.info(f"Member {email} needs update: end date changed from {db_end_date} to {member['end_date']}")
-                        
-                        # Get IVMS employee number from database
-                        ivms_employee_no = db_member["ivms_employee_no"]
-                    else:
-                        # New member, needs update
-                        needs_update = True
-                        logger.info(f"New member found: {email}")
-                    
-                    # If we don't have an IVMS employee number yet, try to find one
-                    if not ivms_employee_no and email in email_to_user_id:
-                        ivms_employee_no = email_to_user_id[email]
-                        logger.info(f"Found IVMS employee number for {email}: {ivms_employee_no}")
-                    
-                    # Update member in our database
-                    self.db.update_member(member, ivms_employee_no)
-                    
-                    # If member needs update and we have an IVMS employee number, update IVMS
-                    if needs_update and ivms_employee_no:
-                        updates_needed.append({
-                            "email": email,
-                            "ivms_employee_no": ivms_employee_no,
-                            "start_date": member["start_date"],
-                            "end_date": member["end_date"]
-                        })
-                
-                except Exception as e:
-                    logger.error(f"Error processing member {member.get('email', 'unknown')}: {e}")
+            if changed_since is None or retried_unmatched:
+                self.unmatched_count = len(changes["unmatched"])
+            else:
+                # Members still unmatched were not compared this time
+                self.unmatched_count = max(self.unmatched_count, len(changes["unmatched"]))
             
-            # Perform IVMS updates
-            for update in updates_needed:
-                success = self.ivms.update_user_validity(
-                    update["ivms_employee_no"],
-                    update["start_date"],
-                    update["end_date"]
-                )
-                
-                if success:
-                    logger.info(f"Successfully updated IVMS for member {update['email']}")
-                else:
-                    logger.error(f"Failed to update IVMS for member {update['email']}")
+            summary["updates_needed"] = len(changes["updates"])
+            summary["matches_to_review"] = len(changes["review"])
+            if changes["review"]:
+                logger.warning("%d members have an IVMS match that needs review", len(changes["review"]))
+            
+            # Hold updates for the coalescing window; a later change to the
+            # same member within the window replaces the waiting one
+            coalesced_before = self.coalescer.coalesced
+            for update in changes["updates"]:
+                self.coalescer.offer(update)
+            summary["writes_coalesced"] = self.coalescer.coalesced - coalesced_before
             
-            logger.info(f"Synchronization completed: {len(updates_needed)} updates performed")
+            # Perform IVMS updates on every device, backlogging them for unhealthy ones
+            with phase("push").time():
+                self.push_updates(self.coalescer.take_due(), summary)
+            summary["updates_pending"] = len(self.coalescer)
+            
+            succeeded = True
             
         except Exception as e:
-            logger.error(f"Error during synchronization: {e}")
+            logger.error("Error during synchronization: %s", e)
+        finally:
+            summary["succeeded"] = succeeded
+            self.db.save_device_health(self.router.snapshot())
+            self.record_metrics(summary, succeeded, time.perf_counter() - started)
+        
+        # One structured record per cycle instead of a line per member
+        summary["duration_seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(
+            "Synchronization completed in %.2f s: %d members, %d updates needed, "
+            "%d pushed, %d queued, %d redundant writes suppressed (%d in total), "
+            "%d coalesced (%d in total), %d waiting",
+            summary["duration_seconds"], summary["members"], summary["updates_needed"],
+            summary["updates_pushed"], summary["updates_queued"], summary["writes_suppressed"],
+            self.suppressed_total, summary["writes_coalesced"], self.coalescer.coalesced,
+            summary["updates_pending"],
+            extra={"sync_summary": summary}
+        )
+        
+        return summary
+    
+    def push_updates(self, updates, summary):
+        """Write validity updates to every device and count the outcome in summary."""
+        # Skip writes the device already reflects (e.g. after a DB reset, or
+        # a change that was undone within the coalescing window)
+        device_state = self.db.get_mirror_validity(u["ivms_employee_no"] for u in updates)
+        updates_needed, suppressed = suppress_redundant_updates(updates, device_state)
+        self.suppressed_total += len(suppressed)
+        summary["writes_suppressed"] += len(suppressed)
+        for update in suppressed:
+            logger.debug("IVMS already up to date for member %s, write suppressed", update['email'])
+        
+        # Bulk pushes are batched and paced to what each device sustains
+        for update, result in zip(updates_needed, self.router.push_updates(updates_needed)):
+            # Keep the mirror in step with our own writes; queued updates
+            # will reach the device when its backlog is replayed
+            if result["applied"] or result["queued"]:
+                self.db.update_mirror_validity(
+                    update["ivms_employee_no"], update["start_date"], update["end_date"]
+                )
+            
+            if result["failed"]:
+                logger.error("Failed to update IVMS for member %s", update['email'])
+            elif result["queued"]:
+                summary["updates_queued"] += 1
+                logger.debug("IVMS update for member %s queued for %s offline device(s)", update['email'], result['queued'])
+            else:
+                summary["updates_pushed"] += 1
+                logger.debug("Successfully updated IVMS for member %s", update['email'])
+        
+        # Queued updates are kept in the device backlog from here on
+        if updates:
+            self.db.remove_pending_writes(updates)
+    
+    def flush_pending(self, drain=False):
+        """Push coalesced updates whose window has expired, or all of them if drain is set.
+        
+        Returns the number of updates taken from the coalescer.
+        """
+        updates = self.coalescer.drain() if drain else self.coalescer.take_due()
+        if not updates:
+            return 0
+        
+        summary = {"updates_pushed": 0, "updates_queued": 0, "writes_suppressed": 0}
+        self.push_updates(updates, summary)
+        metrics.UPDATES_PUSHED.inc(summary["updates_pushed"])
+        metrics.UPDATES_QUEUED.inc(summary["updates_queued"])
+        metrics.WRITES_SUPPRESSED.inc(summary["writes_suppressed"])
+        logger.info(
+            "Flushed %d coalesced updates: %d pushed, %d queued, %d suppressed",
+            len(updates), summary["updates_pushed"], summary["updates_queued"], summary["writes_suppressed"]
+        )
+        return len(updates)
+    
+    def record_metrics(self, summary, succeeded, duration):
+        """Publish the outcome of a cycle to the metrics registry."""
+        metrics.SYNC_CYCLE_SECONDS.observe(duration)
+        metrics.UPDATES_PUSHED.inc(summary["updates_pushed"])
+        metrics.UPDATES_QUEUED.inc(summary["updates_queued"])
+        metrics.WRITES_SUPPRESSED.inc(summary["writes_suppressed"])
+        metrics.WRITES_COALESCED.inc(summary["writes_coalesced"])
+        metrics.UPDATES_PENDING.set(len(self.coalescer))
+        
+        depths = self.db.get_backlog_depths()
+        for device in self.devices:
+            metrics.OUTBOX_DEPTH.labels(device.device_id).set(depths.get(device.device_id, 0))
+        
+        if succeeded:
+            metrics.LAST_SUCCESS.set(time.time())
+        else:
+            metrics.SYNC_ERRORS.inc()
 
 
 def simulate_membership_extension():
@@ -907,17 +1880,12 @@ def simulate_membership_extension():
     member_to_extend = random.choice(active_members)
     email = member_to_extend["email"]
     
-    # Find the original member to get current end date
-    old_end_date = None
-    for member in cardskipper.members:
-        if member["ContactInfo"]["EMail"] == email:
-            role = member["Organisations"]["Organisation"]["Roles"]["Role"]
-            old_end_date = role["EndDate"]
-            break
-    
-    if not old_end_date:
-        logger.error(f"Could not find original member record for {email}")
+    # Look up the current end date through the store's email lookup
+    member = cardskipper.store.find_by_email(email)
+    if member is None:
+        logger.error("Could not find original member record for %s", email)
         return False
+    old_end_date = latest_role(member)[1]["EndDate"]
     
     # Extend membership by a random number of days (30, 60, or 90)
     days_to_extend = random.choice([30, 60, 90])
@@ -925,33 +1893,44 @@ def simulate_membership_extension():
     success = cardskipper.extend_membership(email, days_to_extend)
     
     if success:
-        # Reload to get updated data
-        cardskipper = MockCardskipper(CARDSKIPPER_MEMBERS_FILE)
+        member = cardskipper.store.find_by_email(email)
+        _, role = latest_role(member)
         
-        # Find the updated member
-        for member in cardskipper.members:
-            if member["ContactInfo"]["EMail"] == email:
-                role = member["Organisations"]["Organisation"]["Roles"]["Role"]
-                new_end_date = role["EndDate"]
-                
-                logger.info("=" * 50)
-                logger.info("MEMBERSHIP EXTENSION SIMULATION")
-                logger.info("=" * 50)
-                logger.info(f"Extended membership for: {member['Firstname']} {member['Lastname']}")
-                logger.info(f"Email: {email}")
-                logger.info(f"Membership: {role['Name']}")
-                logger.info(f"Old end date: {old_end_date}")
-                logger.info(f"New end date: {new_end_date}")
-                logger.info(f"Extended by: {days_to_extend} days")
-                logger.info("=" * 50)
-                return True
+        logger.info("=" * 50)
+        logger.info("MEMBERSHIP EXTENSION SIMULATION")
+        logger.info("=" * 50)
+        logger.info("Extended membership for: %s %s", member['Firstname'], member['Lastname'])
+        logger.info("Email: %s", email)
+        logger.info("Membership: %s", role['Name'])
+        logger.info("Old end date: %s", old_end_date)
+        logger.info("New end date: %s", role['EndDate'])
+        logger.info("Extended by: %s days", days_to_extend)
+        logger.info("=" * 50)
+        return True
     
     return False
 
 
-def run_simulation(num_cycles=3, interval_seconds=5):
+def run_simulation(num_cycles=3, interval_seconds=5, metrics_port=METRICS_PORT,
+                   profile=PROFILE, profile_every=PROFILE_EVERY, profile_dir=PROFILE_DIR,
+                   shards=SYNC_SHARDS):
     """Run a simulation of the integration."""
+    init()
     try:
+        if metrics_port:
+            metrics_server = metrics.start_metrics_server(metrics_port)
+        
+        profiler = None
+        if profile:
+            from profiling import CycleProfiler
+            profiler = CycleProfiler(profile_dir, every=profile_every)
+        
+        def sync_cycle(cycle):
+            if profiler is None:
+                return sync_service.sync()
+            with profiler.cycle(cycle):
+                return sync_service.sync()
+        
         logger.info("\n" + "=" * 80)
         logger.info("STARTING CARDSKIPPER TO IVMS INTEGRATION SIMULATION")
         logger.info("=" * 80 + "\n")
@@ -963,21 +1942,21 @@ def run_simulation(num_cycles=3, interval_seconds=5):
         
         # Print initial status
         logger.info("Initial system status:")
-        logger.info(f"- Cardskipper members: {len(cardskipper.members)}")
+        logger.info("- Cardskipper members: %s", cardskipper.count_members())
         active_members = cardskipper.get_active_members()
-        logger.info(f"- Cardskipper active members: {len(active_members)}")
-        logger.info(f"- IVMS users: {len(ivms.user_info)}")
+        logger.info("- Cardskipper active members: %s", len(active_members))
+        logger.info("- IVMS users: %s", ivms.total_matches)
         
         # Create sync service
-        sync_service = MockSyncService(cardskipper, ivms, db)
+        sync_service = MockSyncService(cardskipper, ivms, db, shards=shards)
         
         # Initial sync
         logger.info("\nPerforming initial synchronization...")
-        sync_service.sync()
+        sync_cycle(0)
         
         # Run simulation cycles
         for cycle in range(1, num_cycles + 1):
-            logger.info(f"\nStarting simulation cycle {cycle}...")
+            logger.info("\nStarting simulation cycle %s...", cycle)
             
             # Simulate a membership extension
             if simulate_membership_extension():
@@ -985,13 +1964,13 @@ def run_simulation(num_cycles=3, interval_seconds=5):
             else:
                 logger.warning("Failed to simulate membership extension")
             
-            # Wait for the specified interval
-            logger.info(f"Waiting {interval_seconds} seconds before next sync...")
-            time.sleep(interval_seconds)
+            # Wait for the specified interval, disabling expired members on time
+            logger.info("Waiting %s seconds before next sync...", interval_seconds)
+            sync_service.wait(interval_seconds)
             
             # Perform synchronization
-            logger.info(f"Performing synchronization cycle {cycle}...")
-            sync_service.sync()
+            logger.info("Performing synchronization cycle %s...", cycle)
+            sync_cycle(cycle)
         
         logger.info("\nSimulation completed successfully")
         
@@ -1000,37 +1979,67 @@ def run_simulation(num_cycles=3, interval_seconds=5):
         logger.info("FINAL STATUS REPORT")
         logger.info("=" * 50)
         active_members = cardskipper.get_active_members()
-        logger.info(f"Cardskipper active members: {len(active_members)}")
+        logger.info("Cardskipper active members: %s", len(active_members))
         ivms_users = ivms.get_all_users()
-        logger.info(f"IVMS users: {len(ivms_users)}")
+        logger.info("IVMS users: %s", len(ivms_users))
         db_members = db.get_all_members()
-        logger.info(f"Database members: {len(db_members)}")
+        logger.info("Database members: %s", len(db_members))
         
         # Count members with IVMS IDs
         synced_count = sum(1 for member in db_members.values() if member["ivms_employee_no"])
-        logger.info(f"Members synced with IVMS: {synced_count}")
+        logger.info("Members synced with IVMS: %s", synced_count)
         
         # Sample of synced members
         logger.info("\nSample of members synced with IVMS:")
         synced_members = [m for m in db_members.values() if m["ivms_employee_no"]]
         
         for i, member in enumerate(synced_members[:5]):
-            logger.info(f"\n{i+1}. {member['first_name']} {member['last_name']}")
-            logger.info(f"   Email: {member['email']}")
-            logger.info(f"   Cardskipper ID: {member['organization_member_id']}")
-            logger.info(f"   IVMS Employee No: {member['ivms_employee_no']}")
-            logger.info(f"   Role: {member['role_name']}")
-            logger.info(f"   Valid until: {member['end_date']}")
+            logger.info("\n%s. %s %s", i+1, member['first_name'], member['last_name'])
+            logger.info("   Email: %s", member['email'])
+            logger.info("   Cardskipper ID: %s", member['organization_member_id'])
+            logger.info("   IVMS Employee No: %s", member['ivms_employee_no'])
+            logger.info("   Role: %s", member['role_name'])
+            logger.info("   Valid until: %s", member['end_date'])
         
         return True
         
     except Exception as e:
-        logger.error(f"Error during simulation: {e}")
+        logger.error("Error during simulation: %s", e)
         return False
     finally:
+        if 'sync_service' in locals():
+            sync_service.close()
         if 'db' in locals():
             db.close()
+        if 'metrics_server' in locals():
+            metrics_server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Cardskipper to IVMS integration simulation.")
+    parser.add_argument("--cycles", type=int, default=3, help="number of sync cycles after the initial sync")
+    parser.add_argument("--interval", type=float, default=3, help="seconds between sync cycles")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve /metrics on this port")
+    parser.add_argument("--profile", action="store_true", default=PROFILE,
+                        help="profile sync cycles with cProfile and tracemalloc")
+    parser.add_argument("--profile-every", type=int, default=PROFILE_EVERY, metavar="N",
+                        help="profile only every Nth cycle (the initial sync is cycle 0)")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="directory for profile output")
+    parser.add_argument("--shards", type=int, default=SYNC_SHARDS,
+                        help="worker processes used to plan a sync cycle (1 = in-process)")
+    args = parser.parse_args(argv)
+    
+    success = run_simulation(
+        num_cycles=args.cycles,
+        interval_seconds=args.interval,
+        metrics_port=args.metrics_port,
+        profile=args.profile,
+        profile_every=args.profile_every,
+        profile_dir=args.profile_dir,
+        shards=args.shards
+    )
+    return 0 if success else 1
 
 
 if __name__ == "__main__":
-    run_simulation(num_cycles=3, interval_seconds=3)
\ No newline at end of file
+    main()
\ No newline at end of file
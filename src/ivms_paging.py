@@ -0,0 +1,62 @@
+"""
+Paged retrieval of IVMS users through the ISAPI UserInfo/search interface.
+Pages are requested concurrently but handed out in order, so consumers can
+process users as they arrive while memory stays bounded by the page size
+times the number of requests in flight.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+def iter_user_pages(search, page_size=DEFAULT_PAGE_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Yield lists of UserInfo records, one list per page.
+
+    search is called as search(search_id, position, max_results) and must
+    return a dict shaped like the ISAPI UserInfoSearch response.
+
+    Controllers may serve fewer users than max_results (many cap it at 30),
+    so positions advance by the size of the pages actually served, and a
+    page that comes back short has the rest of its range fetched before
+    the next one is handed out.
+    """
+    # Random like a uuid4, without importing uuid (and platform with it)
+    search_id = os.urandom(16).hex()
+
+    # The first page tells us how many users there are in total, and how
+    # many the controller serves per page
+    first = search(search_id, 0, page_size)
+    total = first.get("totalMatches", 0)
+    users = first.get("UserInfo", [])
+    yield users
+    if not users or len(users) >= total or first.get("responseStatusStrg", "MORE") != "MORE":
+        return
+    step = len(users)
+
+    def fill(position, response):
+        # Fetch what a short page left out of [position, position + step)
+        users = list(response.get("UserInfo", []))
+        end = min(position + step, total)
+        while position + len(users) < end:
+            rest = search(search_id, position + len(users), end - position - len(users)).get("UserInfo", [])
+            if not rest:
+                break
+            users.extend(rest)
+        return users
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = deque()
+
+        for position in range(step, total, step):
+            pending.append((position, pool.submit(search, search_id, position, step)))
+            if len(pending) >= max_in_flight:
+                start, future = pending.popleft()
+                yield fill(start, future.result())
+
+        while pending:
+            start, future = pending.popleft()
+            yield fill(start, future.result())
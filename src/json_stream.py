@@ -0,0 +1,150 @@
+"""
+Incremental reading of large JSON exports.
+The array at a given key path (e.g. members, or UserInfoSearchResult >
+UserInfo) is yielded item by item, so only one item and a small read buffer
+are held in memory instead of the whole document and its parsed copy.
+"""
+
+import codecs
+import json
+import mmap
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    """Sliding text window over a file or a memory map."""
+    def __init__(self, f, use_mmap, chunk_size):
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        if use_mmap:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.offset = 0
+            self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        else:
+            self.map = None
+            self.file = f
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def fill(self):
+        """Read another chunk; returns False at end of input."""
+        if self.eof:
+            return False
+
+        if self.map is not None:
+            data = self.map[self.offset:self.offset + self.chunk_size]
+            self.offset += len(data)
+            chunk = self.decoder.decode(data, final=not data)
+        else:
+            chunk = self.file.read(self.chunk_size)
+
+        if not chunk and (self.map is None or not data):
+            self.eof = True
+            return False
+
+        # Drop what has been consumed so the window stays small
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found or 'end of file'!r}")
+        self.pos += 1
+
+    def value(self, decoder):
+        """Decode one complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the window may continue in the next chunk
+            if end == len(self.text) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(path, keys, siblings=None, use_mmap=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the items of the array found under keys in the JSON file at path.
+
+    Values passed on the way to the array are decoded and, if siblings is a
+    dict, stored in it by key. Yields nothing if a key is missing.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, "rb" if use_mmap else "r", encoding=None if use_mmap else "utf-8-sig") as f:
+        if use_mmap and f.seek(0, 2) == 0:
+            # An empty file cannot be mapped
+            return
+        buffer = _Buffer(f, use_mmap, chunk_size)
+        try:
+            yield from _walk(buffer, decoder, list(keys), siblings)
+        finally:
+            buffer.close()
+
+
+def _walk(buffer, decoder, keys, siblings):
+    if not keys:
+        yield from _items(buffer, decoder)
+        return
+
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        return
+
+    while True:
+        key = buffer.value(decoder)
+        buffer.expect(":")
+
+        if key == keys[0]:
+            yield from _walk(buffer, decoder, keys[1:], siblings)
+            # Anything after the array is of no interest
+            return
+
+        value = buffer.value(decoder)
+        if siblings is not None:
+            siblings[key] = value
+
+        if buffer.peek() == ",":
+            buffer.pos += 1
+            continue
+        buffer.expect("}")
+        return
+
+
+def _items(buffer, decoder):
+    buffer.expect("[")
+    if buffer.peek() == "]":
+        buffer.pos += 1
+        return
+
+    while True:
+        yield buffer.value(decoder)
+        if buffer.peek() == ",":
+            buffer.pos += 1
+            continue
+        buffer.expect("]")
+        return
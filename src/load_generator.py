@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+End-to-end load generator for renewal-to-access propagation.
+Writer threads extend memberships in the Cardskipper mock at a fixed rate
+while the sync service runs in a loop. For every extension, the time until
+the IVMS mock receives the new validity is measured. The offered rate is
+raised step by step; each step reports p50/p95/p99 propagation latency,
+the rate at which changes reached IVMS, and whether the backlog of
+unpropagated extensions kept growing.
+
+Usage:
+    python load_generator.py --members 10000 --rates 1200 2400 4800 --step-seconds 30
+"""
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from benchmark import generate_ivms_users, generate_members, generate_raw_members
+from integration import MockCardskipper, MockDatabase, MockIVMS, MockSyncService, init
+
+logger = logging.getLogger("MockIntegrationFinal.load")
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+DEFAULT_RATES = (1200, 2400, 4800)
+
+
+class PropagationTracker:
+    """Pending extensions per IVMS employee number and the latency of those that arrived."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latencies = []
+        self.applied = 0
+
+    def submitted(self, employee_no, end_date):
+        with self.lock:
+            self.pending[employee_no] = (end_date, time.perf_counter())
+
+    def is_pending(self, employee_no):
+        with self.lock:
+            return employee_no in self.pending
+
+    def arrived(self, employee_no, end_time):
+        now = time.perf_counter()
+        with self.lock:
+            entry = self.pending.get(employee_no)
+            if entry and entry[0] == end_time:
+                del self.pending[employee_no]
+                self.latencies.append(now - entry[1])
+                self.applied += 1
+
+    def take_latencies(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            return latencies
+
+    def backlog(self):
+        with self.lock:
+            return len(self.pending)
+
+
+class ObservedIVMS(MockIVMS):
+    """IVMS mock that reports every validity it applies to a tracker."""
+    def __init__(self, data_file, tracker, **kwargs):
+        super().__init__(data_file, **kwargs)
+        self.tracker = tracker
+
+    def update_user_validity(self, employee_no, begin_time, end_time):
+        applied = super().update_user_validity(employee_no, begin_time, end_time)
+        if applied:
+            self.tracker.arrived(employee_no, end_time)
+        return applied
+
+    def update_users_validity(self, validities):
+        updated = set(super().update_users_validity(validities))
+        for employee_no, _, end_time in validities:
+            if employee_no in updated:
+                self.tracker.arrived(employee_no, end_time)
+        return list(updated)
+
+
+class LoadGenerator:
+    """Drives extensions into Cardskipper from several threads at a given rate."""
+    def __init__(self, cardskipper, members, tracker, threads=4, seed=1):
+        self.cardskipper = cardskipper
+        self.tracker = tracker
+        self.threads = threads
+        # (email, IVMS employee number, current end date) per member
+        self.members = [
+            [m["email"], f"{i:08d}", m["end_date"]] for i, m in enumerate(members)
+        ]
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.submitted = 0
+
+    def _pick(self):
+        with self.rng_lock:
+            # Members with an extension still on its way are left alone, so
+            # every pending extension has one well-defined target value
+            for _ in range(100):
+                member = self.rng.choice(self.members)
+                if not self.tracker.is_pending(member[1]):
+                    return member
+        return None
+
+    def extend(self):
+        member = self._pick()
+        if member is None:
+            return False
+        email, employee_no, end_date = member
+        new_end = (datetime.strptime(end_date, DATE_FORMAT) + timedelta(days=1)).strftime(DATE_FORMAT)
+        self.tracker.submitted(employee_no, new_end)
+        self.cardskipper.store.set_end_date(email, new_end)
+        member[2] = new_end
+        return True
+
+    def run(self, rate_per_minute, seconds):
+        """Submit extensions at rate_per_minute for the given time; returns how many were submitted."""
+        deadline = time.perf_counter() + seconds
+        interval = 60.0 * self.threads / rate_per_minute
+        counts = [0] * self.threads
+
+        def worker(index):
+            # Threads start staggered and keep to their own schedule
+            next_at = time.perf_counter() + interval * index / self.threads
+            while True:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if time.perf_counter() >= deadline:
+                    return
+                if self.extend():
+                    counts[index] += 1
+                next_at += interval
+
+        workers = [threading.Thread(target=worker, args=(i,), name=f"load-{i}") for i in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return sum(counts)
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else float("nan")
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def build_environment(workdir, member_count):
+    """Create Cardskipper and IVMS mocks holding member_count matching members."""
+    members = generate_members(member_count)
+    tracker = PropagationTracker()
+
+    cardskipper = MockCardskipper(os.path.join(workdir, "cardskipper.json"), storage="sqlite")
+    cardskipper.store.replace(generate_raw_members(member_count))
+    ivms = ObservedIVMS(os.path.join(workdir, "ivms.json"), tracker, storage="sqlite")
+    ivms.store.replace(generate_ivms_users(members))
+    db = MockDatabase(os.path.join(workdir, "integration.db"))
+    return members, tracker, cardskipper, ivms, db
+
+
+def run_load(member_count, rates, step_seconds, threads, sync_interval=0.0, workdir=None):
+    """Run every rate step and return one result dict per step."""
+    workdir = workdir or tempfile.mkdtemp(prefix="load_")
+    members, tracker, cardskipper, ivms, db = build_environment(workdir, member_count)
+    service = MockSyncService(cardskipper, ivms, db)
+
+    # The first cycle links every member to its IVMS user
+    started = time.perf_counter()
+    service.sync()
+    print(f"{member_count} members linked in {time.perf_counter() - started:.1f} s; "
+          f"{threads} writer threads, sync interval {sync_interval:g} s")
+
+    stop = threading.Event()
+    cycles = []
+
+    def sync_loop():
+        while not stop.is_set():
+            summary = service.sync()
+            cycles.append(summary["duration_seconds"])
+            stop.wait(sync_interval)
+
+    syncer = threading.Thread(target=sync_loop, name="sync-loop")
+    syncer.start()
+
+    generator = LoadGenerator(cardskipper, members, tracker, threads)
+    results = []
+    try:
+        for rate in rates:
+            tracker.take_latencies()
+            applied_before = tracker.applied
+            cycles_before = len(cycles)
+
+            half = generator.run(rate, step_seconds / 2)
+            backlog_mid = tracker.backlog()
+            submitted = half + generator.run(rate, step_seconds / 2)
+            backlog_end = tracker.backlog()
+            applied = tracker.applied - applied_before
+            step_cycles = cycles[cycles_before:]
+
+            # Let the step's stragglers arrive so the next step starts clean
+            drain_deadline = time.perf_counter() + step_seconds
+            while tracker.backlog() and time.perf_counter() < drain_deadline:
+                time.sleep(0.05)
+
+            latencies = tracker.take_latencies()
+            results.append({
+                "offered_per_minute": rate,
+                "submitted": submitted,
+                "applied_per_minute": applied * 60 / step_seconds,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "backlog": backlog_end,
+                # More than a second's worth of extensions piled up over half a step
+                "growing": backlog_end - backlog_mid > rate / 60,
+                "cycle_seconds": statistics.mean(step_cycles) if step_cycles else float("nan"),
+                "unarrived": tracker.backlog(),
+            })
+            print_step(results[-1])
+    finally:
+        stop.set()
+        syncer.join()
+        service.close()
+        cardskipper.close()
+        ivms.close()
+        db.close()
+
+    return results
+
+
+def print_step(result):
+    print(
+        f"  offered {result['offered_per_minute']:6.0f}/min  applied {result['applied_per_minute']:7.0f}/min  "
+        f"p50 {result['p50'] * 1000:7.0f} ms  p95 {result['p95'] * 1000:7.0f} ms  p99 {result['p99'] * 1000:7.0f} ms  "
+        f"cycle {result['cycle_seconds']:5.2f} s  backlog {result['backlog']:5d} "
+        f"{'GROWING' if result['growing'] else 'stable'}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--rates", type=float, nargs="+", default=list(DEFAULT_RATES),
+                        help="extensions per minute, one step each")
+    parser.add_argument("--step-seconds", type=float, default=30.0)
+    parser.add_argument("--threads", type=int, default=4, help="concurrent writer threads")
+    parser.add_argument("--sync-interval", type=float, default=0.0, help="pause between sync cycles")
+    args = parser.parse_args(argv)
+
+    # Per-member log lines would dominate the measurement
+    init(logging.WARNING)
+    results = run_load(args.members, args.rates, args.step_seconds, args.threads, args.sync_interval)
+
+    sustained = [r["offered_per_minute"] for r in results if not r["growing"]]
+    if sustained:
+        print(f"Sustained throughput: {max(sustained):.0f} extensions/min without a growing backlog")
+    else:
+        print("The backlog grew at every rate tried")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
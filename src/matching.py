@@ -0,0 +1,256 @@
+"""
+Identity matching between Cardskipper members and IVMS users.
+Emails are compared after normalization, with phone number and
+transliterated name as fallbacks. Candidates are looked up through blocking
+indexes so that matching stays close to linear in the number of members.
+Only an email match, or a phone match whose name agrees, is confident
+enough to link a member automatically; weaker matches need a review, since
+a wrong link grants door access on another person's IVMS account.
+
+Usage (review queue in the integration database):
+    python matching.py review
+    python matching.py approve ana.novak@example.com
+    python matching.py reject ana.novak@example.com
+"""
+
+import argparse
+import re
+import sys
+import unicodedata
+from difflib import SequenceMatcher
+
+# Confidence assigned to each kind of match
+EMAIL_CONFIDENCE = 1.0
+PHONE_AND_NAME_CONFIDENCE = 0.95
+PHONE_CONFIDENCE = 0.85
+NAME_CONFIDENCE = 0.75
+
+# Minimum similarity for a fuzzy name match
+FUZZY_NAME_THRESHOLD = 0.9
+
+# Matches below this confidence are queued for review instead of linked
+MIN_LINK_CONFIDENCE = 0.9
+
+# Number of trailing digits used to compare phone numbers, so that
+# "+386 70 123 456" and "070123456" end up with the same key
+PHONE_KEY_DIGITS = 8
+
+# Letters that do not decompose into ASCII under NFKD
+EXTRA_TRANSLITERATIONS = str.maketrans({
+    "đ": "d", "Đ": "D", "ø": "o", "Ø": "O", "ł": "l", "Ł": "L", "ß": "ss", "æ": "ae", "Æ": "AE"
+})
+
+
+def normalize_email(email):
+    """Lowercase and strip an email address; returns '' for missing values."""
+    if not email:
+        return ""
+    return unicodedata.normalize("NFKC", email).strip().lower()
+
+
+def phone_key(phone):
+    """Return the trailing digits of a phone number, or '' if too short to compare."""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) < PHONE_KEY_DIGITS:
+        return ""
+    return digits[-PHONE_KEY_DIGITS:]
+
+
+def transliterate(text):
+    """Strip diacritics so that 'Starčević' and 'Starcevic' compare equal."""
+    text = (text or "").translate(EXTRA_TRANSLITERATIONS)
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def name_key(*parts):
+    """Return a normalized, order-independent name key."""
+    tokens = re.findall(r"[a-z0-9]+", transliterate(" ".join(p for p in parts if p)).lower())
+    return " ".join(sorted(tokens))
+
+
+class Match:
+    """Result of matching a member against IVMS users."""
+    __slots__ = ("employee_no", "method", "confidence")
+
+    def __init__(self, employee_no, method, confidence):
+        self.employee_no = employee_no
+        self.method = method
+        self.confidence = confidence
+
+    @property
+    def needs_review(self):
+        return self.confidence < MIN_LINK_CONFIDENCE
+
+    def __repr__(self):
+        return f"Match({self.employee_no!r}, {self.method!r}, {self.confidence:.2f})"
+
+
+class IdentityMatcher:
+    """Matches Cardskipper members to IVMS users using blocking indexes."""
+    def __init__(self, users=None, claimed=None):
+        self.by_email = {}
+        self.by_phone = {}
+        self.by_name = {}
+        self.by_token = {}
+        self.names = {}
+        # Employee numbers already linked to a member are never matched again
+        self.claimed = set(claimed or ())
+        if users:
+            self.add_users(users)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_users(self, users):
+        for user in users:
+            self.add_user(user)
+
+    def add_user(self, user):
+        employee_no = user["employeeNo"]
+        key = name_key(user.get("name"))
+        self.names[employee_no] = key
+
+        email = normalize_email(user.get("email"))
+        if email:
+            self.by_email.setdefault(email, employee_no)
+
+        phone = phone_key(user.get("phoneNo"))
+        if phone:
+            self.by_phone.setdefault(phone, []).append(employee_no)
+
+        if key:
+            self.by_name.setdefault(key, []).append(employee_no)
+            for token in key.split():
+                self.by_token.setdefault(token[:4], set()).add(employee_no)
+
+    def claim(self, employee_no):
+        self.claimed.add(employee_no)
+
+    def match(self, member):
+        """Return the best Match for a member, or None if nothing is good enough.
+
+        A Match that needs_review must not be linked without a person
+        confirming it.
+        """
+        email = normalize_email(member.get("email"))
+        employee_no = self.by_email.get(email)
+        if employee_no and employee_no not in self.claimed:
+            return Match(employee_no, "email", EMAIL_CONFIDENCE)
+
+        key = name_key(member.get("first_name"), member.get("last_name"))
+
+        phone_candidates = self._unclaimed(self.by_phone.get(phone_key(member.get("phone")), ()))
+        if len(phone_candidates) == 1:
+            employee_no = phone_candidates[0]
+            if key and self._names_agree(key, self.names.get(employee_no)):
+                return Match(employee_no, "phone+name", PHONE_AND_NAME_CONFIDENCE)
+            # A shared family phone, or a reused number
+            return Match(employee_no, "phone", PHONE_CONFIDENCE)
+
+        if not key:
+            return None
+
+        name_candidates = self._unclaimed(self.by_name.get(key, ()))
+        if len(name_candidates) == 1:
+            return Match(name_candidates[0], "name", NAME_CONFIDENCE)
+        if name_candidates:
+            # Several people share this name, refuse to guess
+            return None
+
+        return self._fuzzy_name_match(key)
+
+    def _fuzzy_name_match(self, key):
+        # Only compare against users sharing a name-token prefix
+        candidates = set()
+        for token in key.split():
+            candidates.update(self.by_token.get(token[:4], ()))
+        candidates.difference_update(self.claimed)
+
+        best = None
+        best_ratio = 0.0
+        ambiguous = False
+        for employee_no in candidates:
+            ratio = SequenceMatcher(None, key, self.names[employee_no]).ratio()
+            if ratio > best_ratio:
+                best, best_ratio, ambiguous = employee_no, ratio, False
+            elif ratio == best_ratio:
+                ambiguous = True
+
+        if best is None or ambiguous or best_ratio < FUZZY_NAME_THRESHOLD:
+            return None
+        return Match(best, "fuzzy_name", round(NAME_CONFIDENCE * best_ratio, 3))
+
+    def _names_agree(self, key, other):
+        return bool(other) and (key == other or SequenceMatcher(None, key, other).ratio() >= FUZZY_NAME_THRESHOLD)
+
+    def _unclaimed(self, employee_nos):
+        return [e for e in employee_nos if e not in self.claimed]
+
+
+def ensure_review_schema(conn):
+    """Create the queue of weak matches waiting for a person to confirm them."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS match_review (
+            email TEXT PRIMARY KEY,
+            employee_no TEXT NOT NULL,
+            method TEXT,
+            confidence REAL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def save_reviews(conn, reviews):
+    """Queue (member, match) pairs for review.
+
+    A decision on a candidate is kept while the candidate stays the same.
+    """
+    conn.executemany("""
+        INSERT INTO match_review (email, employee_no, method, confidence)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (email) DO UPDATE SET
+            status = CASE WHEN employee_no = excluded.employee_no THEN status ELSE 'pending' END,
+            employee_no = excluded.employee_no,
+            method = excluded.method,
+            confidence = excluded.confidence,
+            last_seen = CURRENT_TIMESTAMP
+    """, [(member["email"], match.employee_no, match.method, match.confidence) for member, match in reviews])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-file", help="integration database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("review", help="list matches waiting for review")
+    for command in ("approve", "reject"):
+        commands.add_parser(command, help=f"{command} the match of a member").add_argument("email")
+    args = parser.parse_args(argv)
+
+    # Imported here so integration can import this module
+    import integration
+
+    integration.init()
+    db = integration.MockDatabase(args.db_file or integration.DB_FILE)
+    try:
+        if args.command == "review":
+            reviews = db.get_match_reviews()
+            for r in reviews:
+                print(f"{r['email']} ({r['first_name']} {r['last_name']}, {r['phone']}) -> "
+                      f"IVMS {r['employee_no']} by {r['method']}, confidence {r['confidence']:.2f}")
+            print(f"{len(reviews)} matches waiting for review")
+            return 0
+        decide = db.approve_match if args.command == "approve" else db.reject_match
+        if not decide(args.email):
+            print(f"No pending match for {args.email} could be {args.command}d")
+            return 1
+        print(f"Match for {args.email} {args.command}d")
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
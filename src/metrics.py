@@ -0,0 +1,281 @@
+"""
+Minimal Prometheus-style metrics for the sync service.
+Counters, gauges and histograms are plain Python numbers, each guarded by
+a lock of its own: they are updated from worker threads, where an unlocked
+"+=" can lose increments and leave a histogram's sum, count and buckets
+disagreeing. The registry is rendered in the Prometheus text format by a
+small HTTP server.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+logger = logging.getLogger("MockIntegrationFinal.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, *values, **kwargs):
+        """Return the child metric for one combination of label values."""
+        key = tuple(str(kwargs[name]) for name in self.labelnames) if kwargs else tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _label_string(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def __getattr__(self, name):
+        # Unlabelled metrics forward inc()/set()/observe() to their only child
+        if name.startswith("_") or self.labelnames:
+            raise AttributeError(name)
+        return getattr(self._children[()], name)
+
+
+class _CounterChild:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield f"{self.name}{self._label_string(key)} {_format(child.value)}"
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set_function(self, function):
+        """Compute the value when the metrics are scraped."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield f"{self.name}{self._label_string(key)} {_format(child.get())}"
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return (counts, sum, count) as of one moment."""
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def time(self):
+        """Context manager observing the duration of its block."""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "started")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format(bound)
+                yield f"{self.name}_bucket{self._label_string(key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{self._label_string(key)} {_format(total)}"
+            yield f"{self.name}_count{self._label_string(key)} {count}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics of the sync service
+SYNC_CYCLE_SECONDS = Histogram(
+    "ivms_sync_cycle_duration_seconds", "Duration of a full synchronization cycle"
+)
+SYNC_PHASE_SECONDS = Histogram(
+    "ivms_sync_phase_duration_seconds", "Duration of each phase of a synchronization cycle", ["phase"]
+)
+MEMBERS_SCANNED = Counter("ivms_sync_members_scanned_total", "Active Cardskipper members compared")
+MEMBERS_CHANGED = Counter("ivms_sync_members_changed_total", "Members written to the database")
+UPDATES_PUSHED = Counter("ivms_sync_updates_pushed_total", "Validity updates applied on IVMS")
+UPDATES_QUEUED = Counter("ivms_sync_updates_queued_total", "Validity updates diverted to a device backlog")
+WRITES_SUPPRESSED = Counter(
+    "ivms_sync_writes_suppressed_total", "Validity updates skipped because IVMS was already up to date"
+)
+WRITES_COALESCED = Counter(
+    "ivms_sync_writes_coalesced_total", "Validity updates replaced by a later change within the coalescing window"
+)
+UPDATES_PENDING = Gauge("ivms_sync_updates_pending", "Validity updates waiting for their coalescing window")
+SYNC_ERRORS = Counter("ivms_sync_cycle_errors_total", "Synchronization cycles that failed")
+LAST_SUCCESS = Gauge(
+    "ivms_sync_last_success_timestamp_seconds", "Unix time of the last successful synchronization"
+)
+SECONDS_SINCE_SUCCESS = Gauge(
+    "ivms_sync_seconds_since_last_success", "Seconds since the last successful synchronization"
+)
+SECONDS_SINCE_SUCCESS.set_function(
+    lambda: time.time() - LAST_SUCCESS.value if LAST_SUCCESS.value else float("inf")
+)
+DEVICE_REQUEST_SECONDS = Histogram(
+    "ivms_device_request_duration_seconds", "Latency of IVMS device requests", ["device", "operation"]
+)
+DEVICE_REQUEST_ERRORS = Counter(
+    "ivms_device_request_errors_total", "IVMS device requests that failed", ["device", "operation"]
+)
+DEVICE_CIRCUIT_OPEN = Gauge(
+    "ivms_device_circuit_open", "1 if the device circuit breaker is not closed", ["device"]
+)
+OUTBOX_DEPTH = Gauge("ivms_outbox_depth", "Updates waiting in a device backlog", ["device"])
+DEVICE_WRITE_RATE = Gauge("ivms_device_write_rate", "Users per second the device is currently written at", ["device"])
+DEVICE_WRITE_CONCURRENCY = Gauge(
+    "ivms_device_write_concurrency", "Concurrent write requests currently allowed to the device", ["device"]
+)
+DEVICE_BATCH_SIZE = Gauge("ivms_device_batch_size", "Users currently sent per write request", ["device"])
+DEVICE_THROTTLED = Counter("ivms_device_throttled_total", "Write requests the device refused as busy", ["device"])
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve /metrics from a background thread and return the server."""
+    # Imported here so that processes without a metrics port don't pay for it
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would otherwise be written to stderr on every request
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("Metrics available at http://%s:%d/metrics", host, server.server_address[1])
+    return server
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+"""
+Storage backends for the Cardskipper and IVMS mocks.
+The JSON backend keeps everything in a list and rewrites the pretty-printed
+file on every change, as the mocks always did. The SQLite backend keeps one
+row per member or user, indexed on the fields the mocks look up, so loading
+is a query and a single-field update is a single-row write. The JSON files
+remain the import and export format: a SQLite store that is still empty
+imports the JSON file next to it.
+
+Usage:
+    python mock_storage.py export mock_data/ivms_users_final.db ivms_users.json
+    python mock_storage.py import mock_data/cardskipper_members_final.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime
+
+from access_index import latest_role
+from db_pool import ConnectionPool, WriteQueue
+from json_stream import iter_json_array
+
+logger = logging.getLogger("MockIntegrationFinal.storage")
+
+STORAGE_BACKENDS = ("json", "sqlite")
+# Rows inserted per statement when importing a JSON file
+IMPORT_BATCH_SIZE = 1000
+# Searches whose next page is remembered by SqliteUserStore.page
+MAX_OPEN_SEARCHES = 64
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def sqlite_path(data_file):
+    """The SQLite database that goes with a JSON data file."""
+    return os.path.splitext(data_file)[0] + ".db"
+
+
+def _member_fields(member):
+    # A member with several roles is stored under the one that ends last
+    organisation, role = latest_role(member)
+    organisation_id = organisation.get("Id") if organisation else None
+    return (
+        member.get("OrganisationMemberId"),
+        member.get("ContactInfo", {}).get("EMail"),
+        str(organisation_id) if organisation_id is not None else None,
+        role.get("EndDate") if role else None
+    )
+
+
+def _member_matches(member, ending_after, organisation_id):
+    _, _, member_organisation, end_date = _member_fields(member)
+    if organisation_id is not None and member_organisation != str(organisation_id):
+        return False
+    # Members without an end date are passed on so the caller can report them
+    return ending_after is None or end_date is None or end_date > ending_after
+
+
+class JsonMemberStore:
+    """Cardskipper members in a JSON file, streamed on read and rewritten on change."""
+    def __init__(self, data_file, use_mmap=False):
+        self.data_file = data_file
+        self.use_mmap = use_mmap
+        self._members = None
+
+    def exists(self):
+        return os.path.exists(self.data_file)
+
+    @property
+    def members(self):
+        """All raw members, loaded for a modification; save() drops them again."""
+        if self._members is None:
+            self._members = list(iter_json_array(self.data_file, ["members"], use_mmap=self.use_mmap))
+        return self._members
+
+    def replace(self, members):
+        self._members = list(members)
+        self.save()
+
+    def save(self):
+        with open(self.data_file, 'w') as f:
+            json.dump({"members": self.members}, f, indent=2)
+        # Reads go back to streaming the file, which also sees changes made
+        # to it by anything else
+        self._members = None
+
+    def iter_members(self, ending_after=None, organisation_id=None, modified_since=None):
+        """Yield raw members, optionally only those ending after a date or in one organisation.
+
+        The file does not record when a member changed, so modified_since is
+        ignored and every member is yielded.
+        """
+        members = self._members if self._members is not None else iter_json_array(
+            self.data_file, ["members"], use_mmap=self.use_mmap
+        )
+        for member in members:
+            if _member_matches(member, ending_after, organisation_id):
+                yield member
+
+    def count(self):
+        return sum(1 for _ in self.iter_members())
+
+    def find_by_email(self, email):
+        return next(
+            (member for member in self.iter_members() if member.get("ContactInfo", {}).get("EMail") == email),
+            None
+        )
+
+    def set_end_date(self, email, end_date):
+        """Set the role end date of the member with this email; returns False if there is none."""
+        member = next(
+            (member for member in self.members if member.get("ContactInfo", {}).get("EMail") == email),
+            None
+        )
+        if member is None:
+            return False
+        _, role = latest_role(member)
+        if role is None:
+            return False
+        role["EndDate"] = end_date
+        self.save()
+        return True
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({"members": list(self.iter_members())}, f, indent=2)
+
+    def close(self):
+        pass
+
+
+class JsonUserStore:
+    """IVMS users held in a list and rewritten to the JSON file on every change."""
+    def __init__(self, data_file, use_mmap=False):
+        self.data_file = data_file
+        self.search_id = "1"
+        self.users = []
+        if self.exists():
+            # Parse users one by one rather than holding the file text and
+            # the parsed document at the same time
+            header = {}
+            self.users = list(iter_json_array(
+                data_file, ["UserInfoSearchResult", "UserInfo"], header, use_mmap=use_mmap
+            ))
+            self.search_id = header.get("searchID", "1")
+
+    def exists(self):
+        return os.path.exists(self.data_file)
+
+    def replace(self, users):
+        self.users = list(users)
+        self.save()
+
+    def save(self, path=None):
+        data = {
+            "UserInfoSearchResult": {
+                "searchID": self.search_id,
+                "responseStatusStrg": "OK",
+                "numOfMatches": len(self.users),
+                "totalMatches": len(self.users),
+                "UserInfo": self.users
+            }
+        }
+        with open(path or self.data_file, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def all_users(self):
+        return self.users
+
+    def count(self):
+        return len(self.users)
+
+    def page(self, position, limit, search_id=None):
+        return self.users[position:position + limit]
+
+    def get(self, employee_no):
+        for user in self.users:
+            if user["employeeNo"] == employee_no:
+                return user
+        return None
+
+    def find_by_email(self, email):
+        for user in self.users:
+            if user.get("email") == email:
+                return user
+        return None
+
+    def update_validity(self, employee_no, begin_time=None, end_time=None, enable=None):
+        """Change the given validity fields of a user; returns False if there is no such user."""
+        user = self.get(employee_no)
+        if user is None:
+            return False
+        if begin_time is not None:
+            user["Valid"]["beginTime"] = begin_time
+        if end_time is not None:
+            user["Valid"]["endTime"] = end_time
+        if enable is not None:
+            user["Valid"]["enable"] = enable
+        self.save()
+        return True
+
+    def set_validities(self, validities):
+        """Set (employee_no, begin_time, end_time) on several users and enable them; saves once.
+
+        Returns the employee numbers that were found.
+        """
+        users = {user.get("employeeNo"): user for user in self.users}
+        updated = []
+        for employee_no, begin_time, end_time in validities:
+            user = users.get(employee_no)
+            if user is not None:
+                user["Valid"].update(beginTime=begin_time, endTime=end_time, enable=True)
+                updated.append(employee_no)
+        if updated:
+            self.save()
+        return updated
+
+    def export_json(self, path):
+        self.save(path)
+
+    def close(self):
+        pass
+
+
+class SqliteMemberStore:
+    """Cardskipper members in SQLite, one row per member.
+
+    The document is stored as JSON; the end date lives in its own column so
+    it can be indexed and updated in place. modified_at records the last
+    change to a row, so readers can ask for members changed since a time.
+    """
+    def __init__(self, db_path, data_file=None, use_mmap=False):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        self.writer = WriteQueue(self.pool)
+        self.writer.run(self._create_schema)
+        if data_file and not self.exists() and os.path.exists(data_file):
+            self.import_json(data_file, use_mmap)
+
+    def _create_schema(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS members (
+                id INTEGER PRIMARY KEY,
+                organisation_member_id TEXT,
+                email TEXT,
+                organisation_id TEXT,
+                end_date TEXT,
+                data TEXT NOT NULL,
+                modified_at TEXT
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(members)")}
+        if "modified_at" not in columns:
+            # Stores created before changes were tracked
+            conn.execute("ALTER TABLE members ADD COLUMN modified_at TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_members_member_id ON members (organisation_member_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_members_email ON members (email)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_members_end_date ON members (end_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_members_organisation ON members (organisation_id, end_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_members_modified_at ON members (modified_at)")
+
+    def exists(self):
+        return self.pool.connection().execute("SELECT 1 FROM members LIMIT 1").fetchone() is not None
+
+    def import_json(self, data_file, use_mmap=False):
+        """Replace the stored members with those of a JSON export."""
+        self.replace(iter_json_array(data_file, ["members"], use_mmap=use_mmap))
+        logger.info("Imported %s members from %s", self.count(), data_file)
+
+    def replace(self, members):
+        def write_all(conn):
+            conn.execute("DELETE FROM members")
+            modified_at = datetime.now().strftime(DATE_FORMAT)
+            batch = []
+            for member in members:
+                batch.append(_member_fields(member) + (json.dumps(member), modified_at))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    self._insert(conn, batch)
+                    batch = []
+            self._insert(conn, batch)
+
+        self.writer.run(write_all)
+
+    def _insert(self, conn, rows):
+        conn.executemany(
+            "INSERT INTO members (organisation_member_id, email, organisation_id, end_date, data, modified_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    def _load(self, end_date, data):
+        member = json.loads(data)
+        _, role = latest_role(member)
+        if end_date is not None and role is not None:
+            role["EndDate"] = end_date
+        return member
+
+    def iter_members(self, ending_after=None, organisation_id=None, modified_since=None):
+        """Yield raw members, optionally only those ending after a date, in one
+        organisation or changed at or after modified_since.
+        """
+        query = "SELECT end_date, data FROM members"
+        conditions, params = [], []
+        if modified_since is not None:
+            # Rows without a timestamp predate change tracking and always count
+            conditions.append("(modified_at IS NULL OR modified_at >= ?)")
+            params.append(modified_since)
+        if ending_after is not None:
+            conditions.append("(end_date IS NULL OR end_date > ?)")
+            params.append(ending_after)
+        if organisation_id is not None:
+            conditions.append("organisation_id = ?")
+            params.append(str(organisation_id))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        for end_date, data in self.pool.connection().execute(query + " ORDER BY id", params):
+            yield self._load(end_date, data)
+
+    def count(self):
+        return self.pool.connection().execute("SELECT COUNT(*) FROM members").fetchone()[0]
+
+    def find_by_email(self, email):
+        row = self.pool.connection().execute(
+            "SELECT end_date, data FROM members WHERE email = ? ORDER BY id LIMIT 1", (email,)
+        ).fetchone()
+        return self._load(*row) if row else None
+
+    def set_end_date(self, email, end_date):
+        """Set the role end date of the member with this email; returns False if there is none."""
+        return self.writer.execute(
+            "UPDATE members SET end_date = ?, modified_at = ? "
+            "WHERE id = (SELECT id FROM members WHERE email = ? ORDER BY id LIMIT 1)",
+            (end_date, datetime.now().strftime(DATE_FORMAT), email)
+        ) > 0
+
+    def export_json(self, path):
+        JsonMemberStore(path).replace(self.iter_members())
+
+    def close(self):
+        self.writer.close()
+        self.pool.close()
+
+
+class SqliteUserStore:
+    """IVMS users in SQLite, one row per user.
+
+    The validity period is kept in columns, so enabling, disabling or
+    renewing a user rewrites only that row.
+    """
+    def __init__(self, db_path, data_file=None, use_mmap=False):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        self.writer = WriteQueue(self.pool)
+        # (search_id, position of its next page) -> last id served before
+        # it; pages of one search may be requested from several threads
+        self._continuations = {}
+        self._continuations_lock = threading.Lock()
+        # Bumped by replace(), so no page continues across a rewrite
+        self._generation = 0
+        self.writer.run(self._create_schema)
+        if data_file and not self.exists() and os.path.exists(data_file):
+            self.import_json(data_file, use_mmap)
+
+    def _create_schema(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                employee_no TEXT UNIQUE NOT NULL,
+                email TEXT,
+                enable INTEGER NOT NULL DEFAULT 1,
+                begin_time TEXT,
+                end_time TEXT,
+                data TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+
+    def exists(self):
+        return self.pool.connection().execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+
+    @property
+    def search_id(self):
+        row = self.pool.connection().execute("SELECT value FROM store_meta WHERE key = 'searchID'").fetchone()
+        return row[0] if row else "1"
+
+    def import_json(self, data_file, use_mmap=False):
+        """Replace the stored users with those of a JSON export."""
+        header = {}
+        self.replace(iter_json_array(data_file, ["UserInfoSearchResult", "UserInfo"], header, use_mmap=use_mmap))
+        self.writer.execute(
+            "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('searchID', ?)",
+            (str(header.get("searchID", "1")),)
+        )
+        logger.info("Imported %s users from %s", self.count(), data_file)
+
+    def replace(self, users):
+        def write_all(conn):
+            conn.execute("DELETE FROM users")
+            batch = []
+            for user in users:
+                valid = user.get("Valid", {})
+                batch.append((
+                    user["employeeNo"], user.get("email"), int(valid.get("enable", True)),
+                    valid.get("beginTime"), valid.get("endTime"), json.dumps(user)
+                ))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    self._insert(conn, batch)
+                    batch = []
+            self._insert(conn, batch)
+
+        self.writer.run(write_all)
+        with self._continuations_lock:
+            self._generation += 1
+            self._continuations.clear()
+
+    def _insert(self, conn, rows):
+        conn.executemany(
+            "INSERT INTO users (employee_no, email, enable, begin_time, end_time, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    def _load(self, id, enable, begin_time, end_time, data):
+        user = json.loads(data)
+        user["Valid"] = {"enable": bool(enable), "beginTime": begin_time, "endTime": end_time}
+        return user
+
+    def _select(self, where="", params=(), suffix=""):
+        return self.pool.connection().execute(
+            f"SELECT id, enable, begin_time, end_time, data FROM users {where} ORDER BY id {suffix}", params
+        )
+
+    def all_users(self):
+        return [self._load(*row) for row in self._select()]
+
+    def count(self):
+        return self.pool.connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def page(self, position, limit, search_id=None):
+        # A page that follows an earlier page of the same search continues
+        # after its last id instead of counting past every earlier row with OFFSET
+        with self._continuations_lock:
+            generation = self._generation
+            last_id = self._continuations.pop((search_id, position), None) if search_id is not None else None
+        if position and last_id is not None:
+            rows = self._select("WHERE id > ?", (last_id, limit), "LIMIT ?").fetchall()
+        else:
+            rows = self._select(params=(limit, position), suffix="LIMIT ? OFFSET ?").fetchall()
+
+        if rows and search_id is not None:
+            with self._continuations_lock:
+                if generation == self._generation:
+                    if len(self._continuations) >= MAX_OPEN_SEARCHES:
+                        # Forget the oldest; that search falls back to OFFSET
+                        del self._continuations[next(iter(self._continuations))]
+                    self._continuations[(search_id, position + len(rows))] = rows[-1][0]
+        return [self._load(*row) for row in rows]
+
+    def get(self, employee_no):
+        row = self._select("WHERE employee_no = ?", (employee_no,)).fetchone()
+        return self._load(*row) if row else None
+
+    def find_by_email(self, email):
+        row = self._select("WHERE email = ?", (email,), "LIMIT 1").fetchone()
+        return self._load(*row) if row else None
+
+    def update_validity(self, employee_no, begin_time=None, end_time=None, enable=None):
+        """Change the given validity fields of a user; returns False if there is no such user."""
+        return self.writer.execute(
+            "UPDATE users SET begin_time = COALESCE(?, begin_time), end_time = COALESCE(?, end_time), "
+            "enable = COALESCE(?, enable) WHERE employee_no = ?",
+            (begin_time, end_time, None if enable is None else int(enable), employee_no)
+        ) > 0
+
+    def set_validities(self, validities):
+        """Set (employee_no, begin_time, end_time) on several users and enable them in one transaction.
+
+        Returns the employee numbers that were found.
+        """
+        def write_all(conn):
+            return [
+                employee_no for employee_no, begin_time, end_time in validities
+                if conn.execute(
+                    "UPDATE users SET begin_time = ?, end_time = ?, enable = 1 WHERE employee_no = ?",
+                    (begin_time, end_time, employee_no)
+                ).rowcount
+            ]
+        return self.writer.run(write_all)
+
+    def export_json(self, path):
+        store = JsonUserStore(path)
+        store.search_id = self.search_id
+        store.replace(self.all_users())
+
+    def close(self):
+        self.writer.close()
+        self.pool.close()
+
+
+def open_member_store(data_file, storage="json", use_mmap=False):
+    """Open the member store of the given backend for a JSON data file."""
+    if storage == "sqlite":
+        return SqliteMemberStore(sqlite_path(data_file), data_file, use_mmap)
+    if storage == "json":
+        return JsonMemberStore(data_file, use_mmap)
+    raise ValueError(f"Unknown storage backend {storage!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+
+
+def open_user_store(data_file, storage="json", use_mmap=False):
+    """Open the IVMS user store of the given backend for a JSON data file."""
+    if storage == "sqlite":
+        return SqliteUserStore(sqlite_path(data_file), data_file, use_mmap)
+    if storage == "json":
+        return JsonUserStore(data_file, use_mmap)
+    raise ValueError(f"Unknown storage backend {storage!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+
+
+def _open_sqlite(db_path):
+    """Open whichever store the database at db_path holds."""
+    pool = ConnectionPool(db_path, read_only=True)
+    try:
+        tables = {row[0] for row in pool.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        pool.close()
+    return SqliteUserStore(db_path) if "users" in tables else SqliteMemberStore(db_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="load a JSON export into its SQLite store")
+    import_parser.add_argument("json_file")
+    import_parser.add_argument("--kind", choices=("members", "users"),
+                               help="default: members if the file name mentions cardskipper, otherwise users")
+
+    export_parser = subparsers.add_parser("export", help="write a SQLite store out as JSON")
+    export_parser.add_argument("db_path")
+    export_parser.add_argument("json_file")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if args.command == "import":
+        kind = args.kind or ("members" if "cardskipper" in os.path.basename(args.json_file) else "users")
+        store_class = SqliteMemberStore if kind == "members" else SqliteUserStore
+        store = store_class(sqlite_path(args.json_file))
+        try:
+            store.import_json(args.json_file)
+        finally:
+            store.close()
+        print(f"Imported {args.json_file} into {sqlite_path(args.json_file)}")
+    else:
+        store = _open_sqlite(args.db_path)
+        try:
+            store.export_json(args.json_file)
+        finally:
+            store.close()
+        print(f"Exported {args.db_path} to {args.json_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
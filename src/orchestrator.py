@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Concurrent sync of several organisations and sites.
+Every (organisation, site) pair is an independent pipeline with its own
+database, IVMS devices and watermark: the start of its last successful
+cycle, after which a cycle only compares members changed since then.
+Pipelines share a pool of worker threads; a pipeline never runs two cycles
+at once, and when more pipelines are due than there are workers the one
+that has used the least sync time so far goes first, so one large site
+cannot starve the small ones. Between cycles, expiries and coalesced writes
+of a pipeline are fired on the same pool as they fall due.
+
+Usage:
+    python orchestrator.py --config sites.json --cycles 3
+
+The config file lists the sites:
+    {"sites": [{"organisation_id": "123", "site_id": "center",
+                "interval_seconds": 60, "devices": ["mock_data/ivms_center.json"]}]}
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from access_index import member_roles
+from integration import (
+    CARDSKIPPER_MEMBERS_FILE, MOCK_DATA_DIR,
+    MockCardskipper, MockDatabase, MockIVMS, MockSyncService, init
+)
+
+logger = logging.getLogger("MockIntegrationFinal.orchestrator")
+
+DEFAULT_INTERVAL_SECONDS = 60
+DEFAULT_MAX_WORKERS = 4
+# Cycles after which every member is compared again, not just changed ones
+FULL_SYNC_EVERY = 10
+# Pause before timers that failed are fired again
+TIMER_RETRY_SECONDS = 5
+
+# Kinds of work a pipeline runs on the pool
+CYCLE = "cycle"
+TIMERS = "timers"
+
+
+class OrganisationView:
+    """Cardskipper client restricted to the members of one organisation."""
+    def __init__(self, cardskipper, organisation_id):
+        self.cardskipper = cardskipper
+        self.organisation_id = organisation_id
+
+    def get_active_members(self, modified_since=None):
+        if modified_since is None:
+            return self.cardskipper.get_active_members(self.organisation_id)
+        return self.cardskipper.get_active_members(self.organisation_id, modified_since)
+
+
+class SitePipeline:
+    """Sync pipeline for one (organisation, site) pair."""
+    def __init__(self, organisation_id, site_id, service, interval_seconds=DEFAULT_INTERVAL_SECONDS,
+                 clock=time.monotonic):
+        self.organisation_id = str(organisation_id)
+        self.site_id = str(site_id)
+        self.name = f"{self.organisation_id}/{self.site_id}"
+        self.service = service
+        self.interval_seconds = interval_seconds
+        self.clock = clock
+
+        # Total time spent syncing; the scheduler prefers the smallest
+        self.vruntime = 0.0
+        self.cycles = 0
+        # Incremental cycles since the last full one; None until this process ran a full cycle
+        self.incremental_cycles = None
+        self.timers_held_until = None
+        self.next_due = clock()
+        self.watermark = service.db.get_state("watermark")
+        if self.watermark:
+            # Resume the schedule where the last run left it
+            elapsed = (datetime.now() - datetime.strptime(self.watermark, "%Y-%m-%dT%H:%M:%S")).total_seconds()
+            self.next_due = clock() + max(0.0, interval_seconds - elapsed)
+
+    def run_cycle(self):
+        """Run one sync cycle; returns the cycle summary."""
+        started_at = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        # A cycle compares every member the first time in this process and
+        # every FULL_SYNC_EVERY cycles; members waiting for an IVMS match are
+        # retried by the service whenever it refreshes the mirror
+        full = (
+            self.watermark is None or self.incremental_cycles is None
+            or self.incremental_cycles >= FULL_SYNC_EVERY
+        )
+        summary = self.service.sync(changed_since=None if full else self.watermark)
+        summary["full"] = full
+
+        # Changes made in Cardskipper after the cycle started are picked up next time
+        if summary.get("succeeded"):
+            self.watermark = started_at
+            self.service.db.set_state("watermark", started_at)
+            self.incremental_cycles = 0 if full else self.incremental_cycles + 1
+        return summary
+
+    def timers_due_at(self):
+        """Clock time at which an expiry or coalesced write falls due; None if none is waiting."""
+        seconds = self.service.seconds_until_due()
+        if seconds is None:
+            return None
+        return max(self.clock() + seconds, self.timers_held_until or 0.0)
+
+    def run_timers(self):
+        """Fire the expiries and coalesced writes that have fallen due."""
+        self.service.run_due()
+
+    def close(self):
+        self.service.close()
+        for device in self.service.devices:
+            device.close()
+        self.service.db.close()
+
+
+class SyncOrchestrator:
+    """Runs site pipelines concurrently with fair scheduling."""
+    def __init__(self, pipelines, max_workers=DEFAULT_MAX_WORKERS, clock=time.monotonic):
+        self.pipelines = list(pipelines)
+        self.max_workers = max_workers
+        self.clock = clock
+        self.stop_event = threading.Event()
+
+    def pick(self, busy, now):
+        """Return the due pipelines that are not busy, in scheduling order."""
+        due = [p for p in self.pipelines if p not in busy and p.next_due <= now]
+        due.sort(key=lambda p: (p.vruntime, p.next_due))
+        return due
+
+    def run(self, max_cycles=None, duration=None):
+        """Schedule cycles until every pipeline ran max_cycles, duration passed or stop() is called."""
+        deadline = self.clock() + duration if duration else None
+        # future -> (pipeline, started, kind); a pipeline has at most one entry
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="site") as pool:
+            while not self.stop_event.is_set():
+                now = self.clock()
+                if deadline and now >= deadline and not running:
+                    break
+                if max_cycles and all(p.cycles >= max_cycles for p in self.pipelines) and not running:
+                    break
+
+                accepting = not (deadline and now >= deadline)
+                busy = {pipeline for pipeline, _, _ in running.values()}
+                for pipeline in self.pick(busy, now) if accepting else []:
+                    if len(running) >= self.max_workers:
+                        break
+                    if max_cycles and pipeline.cycles >= max_cycles:
+                        continue
+                    running[pool.submit(pipeline.run_cycle)] = (pipeline, self.clock(), CYCLE)
+                    busy.add(pipeline)
+
+                # Pipelines waiting for their next cycle fire expiries and coalesced writes on time
+                timers = {p: p.timers_due_at() for p in self.pipelines if p not in busy}
+                for pipeline, due_at in timers.items() if accepting else []:
+                    if len(running) >= self.max_workers:
+                        break
+                    if due_at is not None and due_at <= self.clock():
+                        running[pool.submit(pipeline.run_timers)] = (pipeline, self.clock(), TIMERS)
+                        busy.add(pipeline)
+
+                # Sleep until work finishes or the next pipeline or timer falls due
+                idle = [p for p in self.pipelines if p not in busy]
+                wake_at = [p.next_due for p in idle if not (max_cycles and p.cycles >= max_cycles)]
+                wake_at += [timers[p] for p in idle if timers.get(p) is not None]
+                wake_at = [t for t in wake_at + [deadline] if t is not None]
+                timeout = max(0.0, min(wake_at) - self.clock()) if wake_at else None
+
+                if running:
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish(future, *running.pop(future))
+                elif timeout is None:
+                    break
+                else:
+                    self.stop_event.wait(timeout)
+
+            # Let work in flight finish before returning
+            for future, entry in running.items():
+                self._finish(future, *entry)
+
+    def _finish(self, future, pipeline, started, kind=CYCLE):
+        elapsed = self.clock() - started
+        pipeline.vruntime += elapsed
+        if kind == TIMERS:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Expiries and coalesced writes for %s failed: %s", pipeline.name, e)
+                pipeline.timers_held_until = self.clock() + TIMER_RETRY_SECONDS
+            return
+
+        pipeline.cycles += 1
+        pipeline.next_due = started + pipeline.interval_seconds
+
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.error("Sync cycle for %s failed: %s", pipeline.name, e)
+            return
+
+        logger.info(
+            "Site %s: %s cycle %d in %.2f s, %d members, %d pushed, %d queued",
+            pipeline.name, "full" if summary.get("full", True) else "incremental", pipeline.cycles,
+            elapsed, summary["members"], summary["updates_pushed"], summary["updates_queued"]
+        )
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        for pipeline in self.pipelines:
+            pipeline.close()
+
+
+def build_pipelines(sites, cardskipper, data_dir=MOCK_DATA_DIR):
+    """Create a pipeline for every site entry of the config."""
+    pipelines = []
+    for site in sites:
+        organisation_id = str(site["organisation_id"])
+        site_id = str(site["site_id"])
+        # Sites without a device list get a controller of their own, so no
+        # two pipelines write the same mock device file
+        device_files = site.get("devices") or [
+            os.path.join(data_dir, f"ivms_users_{organisation_id}_{site_id}.json")
+        ]
+        devices = [
+            MockIVMS(data_file, device_id=f"{site_id}-ivms-{index}")
+            for index, data_file in enumerate(device_files, 1)
+        ]
+        # Each pipeline keeps its members, mirror, backlog and watermark apart
+        db = MockDatabase(os.path.join(data_dir, f"integration_{organisation_id}_{site_id}.db"))
+        service = MockSyncService(OrganisationView(cardskipper, organisation_id), devices, db)
+        pipelines.append(SitePipeline(
+            organisation_id, site_id, service,
+            interval_seconds=site.get("interval_seconds", DEFAULT_INTERVAL_SECONDS)
+        ))
+    return pipelines
+
+
+def default_sites(cardskipper):
+    """One site per organisation found in Cardskipper."""
+    organisation_ids = sorted({
+        str(organisation["Id"])
+        for member in cardskipper.iter_members()
+        for organisation, _ in member_roles(member)
+    })
+    return [{"organisation_id": org, "site_id": "main"} for org in organisation_ids]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", help="JSON file listing the sites (default: one site per organisation)")
+    parser.add_argument("--cycles", type=int, help="stop after this many cycles per site")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS)
+    args = parser.parse_args(argv)
+
+    init()
+    cardskipper = MockCardskipper(CARDSKIPPER_MEMBERS_FILE)
+    if args.config:
+        with open(args.config) as f:
+            sites = json.load(f)["sites"]
+    else:
+        sites = default_sites(cardskipper)
+
+    orchestrator = SyncOrchestrator(build_pipelines(sites, cardskipper), max_workers=args.workers)
+    logger.info("Orchestrating %d site pipelines on %d workers", len(orchestrator.pipelines), args.workers)
+    try:
+        orchestrator.run(max_cycles=args.cycles, duration=args.duration)
+    except KeyboardInterrupt:
+        orchestrator.stop()
+    finally:
+        orchestrator.close()
+        cardskipper.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
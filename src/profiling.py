@@ -0,0 +1,92 @@
+"""
+Optional profiling of sync cycles.
+Sampled cycles run under cProfile and tracemalloc; each one leaves a pstats
+file and a report of its largest allocations in the profiles directory.
+Cycles that are not sampled run without any instrumentation.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger("MockIntegrationFinal.profiling")
+
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_TOP_ALLOCATIONS = 25
+
+
+class CycleProfiler:
+    """Profiles every Nth sync cycle into a directory."""
+    def __init__(self, directory=DEFAULT_PROFILE_DIR, every=1, top=DEFAULT_TOP_ALLOCATIONS):
+        self.directory = directory
+        self.every = max(1, every)
+        self.top = top
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        os.makedirs(directory, exist_ok=True)
+
+    def should_profile(self, cycle):
+        return cycle % self.every == 0
+
+    @contextmanager
+    def cycle(self, cycle):
+        """Profile the enclosed block if this cycle is sampled."""
+        if not self.should_profile(cycle):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        # Leave tracing alone if someone else started it
+        owns_tracing = not tracemalloc.is_tracing()
+        if owns_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if owns_tracing:
+                tracemalloc.stop()
+            self._write(cycle, profiler, snapshot, elapsed, current, peak)
+
+    def _write(self, cycle, profiler, snapshot, elapsed, current, peak):
+        base = os.path.join(self.directory, f"sync-{self.run_id}-cycle{cycle:04d}")
+        stats_file = base + ".pstats"
+        report_file = base + "-alloc.txt"
+
+        try:
+            profiler.dump_stats(stats_file)
+
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ))
+            with open(report_file, "w") as f:
+                f.write(f"Cycle {cycle}: {elapsed:.3f} s, "
+                        f"{current / 1024:.1f} KiB still allocated, peak {peak / 1024:.1f} KiB\n\n")
+                f.write(f"Top {self.top} allocations by line:\n")
+                for index, stat in enumerate(snapshot.statistics("lineno")[:self.top], 1):
+                    frame = stat.traceback[0]
+                    f.write(f"{index:3}. {frame.filename}:{frame.lineno}: "
+                            f"{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+
+                # The slowest functions, so the report is readable without pstats
+                buffer = io.StringIO()
+                pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(self.top)
+                f.write(f"\nTop {self.top} functions by cumulative time:\n")
+                f.write(buffer.getvalue())
+        except OSError as e:
+            logger.error("Error writing profile for cycle %s: %s", cycle, e)
+            return
+
+        logger.info("Profiled cycle %s in %.2f s (peak %.1f KiB): %s", cycle, elapsed, peak / 1024, stats_file)
@@ -0,0 +1,148 @@
+"""
+Propagation latency of membership changes, from Cardskipper to the door.
+Every sync_history row carries three timestamps in epoch milliseconds: when
+the change was made in Cardskipper (if known), when the sync detected it and
+when IVMS applied it. Only changes of members linked to an IVMS user are
+timed. Applied changes are counted into an hourly latency histogram, so
+percentiles over time come from the rollup, and changes still on their way
+are found through a partial index that only holds those rows.
+"""
+
+import bisect
+import time
+from datetime import datetime, timezone
+
+# Upper bounds of the latency histogram buckets; one more bucket holds the rest
+LATENCY_BUCKETS_MS = (
+    250, 500, 1000, 2500, 5000, 10000, 30000, 60000,
+    300000, 900000, 3600000, 14400000, 86400000
+)
+PROPAGATION_SLO_SECONDS = 900
+
+TIMESTAMP_COLUMNS = ("source_changed_ms", "detected_ms", "applied_ms")
+
+# Rows still waiting for IVMS; kept in sync with the partial index below
+_PENDING = "applied_ms IS NULL AND detected_ms IS NOT NULL AND sync_status != 'Superseded'"
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def to_ms(timestamp):
+    """Convert a local "%Y-%m-%dT%H:%M:%S" timestamp to epoch milliseconds; None if unset."""
+    if not timestamp:
+        return None
+    try:
+        return int(datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S").timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+def bucket_for(latency_ms):
+    return bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)
+
+
+def ensure_schema(conn):
+    """Add the timestamp columns to sync_history, the pending index and the rollup table."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sync_history)")}
+    for column in TIMESTAMP_COLUMNS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE sync_history ADD COLUMN {column} INTEGER")
+
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_sync_history_pending
+        ON sync_history (email, new_end_date) WHERE {_PENDING}
+    """)
+    # Changes of unmatched members were once timed too; they never reach a
+    # device and would stay pending for good
+    conn.execute(f"UPDATE sync_history SET detected_ms = NULL WHERE ivms_id = 'Not matched' AND {_PENDING}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS propagation_hourly (
+            hour TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (hour, bucket)
+        )
+    """)
+
+
+def supersede(conn, email):
+    """Close pending changes of a member that a newer change replaces."""
+    conn.execute(f"UPDATE sync_history SET sync_status = 'Superseded' WHERE email = ? AND {_PENDING}", (email,))
+
+
+def mark_applied(conn, entries):
+    """Record that IVMS applied the given (email, end_date, applied_ms) changes.
+
+    Latency is measured from the Cardskipper change where it is known and
+    from detection otherwise. Returns the number of changes marked.
+    """
+    counts = {}
+    marked = 0
+    for email, end_date, applied_ms in entries:
+        rows = conn.execute(
+            f"SELECT id, COALESCE(source_changed_ms, detected_ms) FROM sync_history "
+            f"WHERE email = ? AND new_end_date = ? AND {_PENDING}",
+            (email, end_date)
+        ).fetchall()
+        for row_id, started_ms in rows:
+            conn.execute("UPDATE sync_history SET applied_ms = ? WHERE id = ?", (applied_ms, row_id))
+            hour = datetime.fromtimestamp(applied_ms / 1000, timezone.utc).strftime("%Y-%m-%d %H:00")
+            key = (hour, bucket_for(max(0, applied_ms - started_ms)))
+            counts[key] = counts.get(key, 0) + 1
+            marked += 1
+
+    conn.executemany(
+        "INSERT INTO propagation_hourly (hour, bucket, count) VALUES (?, ?, ?) "
+        "ON CONFLICT (hour, bucket) DO UPDATE SET count = count + excluded.count",
+        [key + (count,) for key, count in counts.items()]
+    )
+    return marked
+
+
+def histogram_percentile(counts, q):
+    """Estimate the q-th percentile in ms from bucket counts, interpolating within a bucket."""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * q / 100
+    seen = 0
+    for bucket, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS_MS[bucket - 1] if bucket else 0
+            upper = LATENCY_BUCKETS_MS[min(bucket, len(LATENCY_BUCKETS_MS) - 1)]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS_MS[-1]
+
+
+def latency_percentiles(cursor, since_hour, quantiles=(50, 95, 99)):
+    """Return (hour, count, {q: ms}) per hour since since_hour, from the rollup."""
+    cursor.execute(
+        "SELECT hour, bucket, count FROM propagation_hourly WHERE hour >= ? ORDER BY hour",
+        (since_hour,)
+    )
+    hours = {}
+    for hour, bucket, count in cursor.fetchall():
+        hours.setdefault(hour, [0] * (len(LATENCY_BUCKETS_MS) + 1))[bucket] += count
+    return [
+        (hour, sum(counts), {q: histogram_percentile(counts, q) for q in quantiles})
+        for hour, counts in hours.items()
+    ]
+
+
+def breaching(cursor, slo_seconds=PROPAGATION_SLO_SECONDS, at_ms=None, limit=100):
+    """Return changes not yet applied that have been on their way longer than the SLO."""
+    at_ms = at_ms or now_ms()
+    cursor.execute(f"""
+        SELECT email, ivms_id, new_end_date, COALESCE(source_changed_ms, detected_ms) AS started_ms
+        FROM sync_history
+        WHERE {_PENDING} AND COALESCE(source_changed_ms, detected_ms) < ?
+        ORDER BY started_ms
+        LIMIT ?
+    """, (at_ms - slo_seconds * 1000, limit))
+    return [
+        {"email": email, "ivms_id": ivms_id, "new_end_date": end_date, "waiting_seconds": (at_ms - started) / 1000}
+        for email, ivms_id, end_date, started in cursor.fetchall()
+    ]
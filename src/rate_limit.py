@@ -0,0 +1,188 @@
+"""
+Pacing of IVMS device writes.
+Every device gets a token bucket that meters users written per second and
+an adaptive limit on concurrent requests and users per request. Limits
+follow AIMD: they grow step by step while the device answers quickly and
+without errors, and are halved when it throttles, fails or slows down past
+the latency target. Until the first cut they double instead (slow start),
+so a fresh limiter finds the device's capacity quickly. A bulk push thereby
+settles just below the rate the device can sustain.
+"""
+
+import logging
+import threading
+import time
+
+from metrics import DEVICE_BATCH_SIZE, DEVICE_THROTTLED, DEVICE_WRITE_CONCURRENCY, DEVICE_WRITE_RATE
+
+logger = logging.getLogger("MockIntegrationFinal.pacing")
+
+# Longest a caller sleeps before the token bucket is checked again
+MAX_WAIT_STEP = 0.1
+
+# Outcomes of a device request as seen by the limiter
+OK = "ok"
+THROTTLED = "throttled"
+ERROR = "error"
+
+
+class TokenBucket:
+    """Token bucket metering a rate per second, with one second's worth of burst."""
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self, tokens=1):
+        """Take tokens, waiting until the bucket has them.
+
+        A request larger than the bucket goes once the bucket is full. The
+        wait is re-evaluated in short steps, so a rate change applies to
+        callers that are already waiting.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+            self.sleep(min(wait, MAX_WAIT_STEP))
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if the bucket has them; never waits."""
+        with self._lock:
+            self._refill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class AdaptiveLimiter:
+    """Write rate, concurrency and batch size of one device, adjusted by AIMD.
+
+    After every increase_every requests that were all fast and successful,
+    the rate grows by rate_step, and concurrency and batch size by one step
+    each; before the first decrease, rate and batch size double after every
+    such request. A throttled or failed request, or one slower than
+    latency_target, halves all three; requests started before a cut do not
+    cut again, so one overload is not punished twice.
+    """
+    def __init__(self, device_id, rate=50.0, min_rate=1.0, max_rate=2000.0, rate_step=50.0,
+                 concurrency=1, max_concurrency=8, batch_size=10, max_batch_size=100, batch_step=5,
+                 latency_target=0.5, increase_every=5, clock=time.monotonic, sleep=time.sleep):
+        self.device_id = device_id
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.max_concurrency = max_concurrency
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.latency_target = latency_target
+        self.increase_every = increase_every
+        self.clock = clock
+        self.sleep = sleep
+
+        self.bucket = TokenBucket(rate, clock, sleep)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.in_flight = 0
+        self.healthy_streak = 0
+        self.slow_start = True
+        self.decreases = 0
+        self.throttled = 0
+        self._cut_at = None
+        self._condition = threading.Condition()
+        self._publish()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def acquire(self, users):
+        """Wait for a free request slot and for the bucket to admit users; returns the start time."""
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                self._condition.wait()
+            self.in_flight += 1
+        self.bucket.acquire(users)
+        return self.clock()
+
+    def release(self, started_at, outcome, latency=None):
+        """Finish a request started at started_at and adapt the limits to its outcome."""
+        latency = self.clock() - started_at if latency is None else latency
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == THROTTLED:
+                self.throttled += 1
+                DEVICE_THROTTLED.labels(self.device_id).inc()
+
+            if outcome != OK or latency > self.latency_target:
+                # Requests that started before the last cut report the old overload
+                if self._cut_at is None or started_at >= self._cut_at:
+                    self._decrease(outcome, latency)
+            else:
+                self.healthy_streak += 1
+                if self.slow_start or self.healthy_streak >= self.increase_every:
+                    self._increase()
+            self._condition.notify_all()
+
+    def _increase(self):
+        self.healthy_streak = 0
+        if self.slow_start:
+            rate, batch_size = self.rate * 2, self.batch_size * 2
+        else:
+            rate, batch_size = self.rate + self.rate_step, self.batch_size + self.batch_step
+        self.bucket.set_rate(min(self.max_rate, rate))
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+        self.batch_size = min(self.max_batch_size, batch_size)
+        self._publish()
+
+    def _decrease(self, outcome, latency):
+        self.healthy_streak = 0
+        self.slow_start = False
+        self.decreases += 1
+        self._cut_at = self.clock()
+        self.bucket.set_rate(max(self.min_rate, self.rate / 2))
+        self.concurrency = max(1, self.concurrency // 2)
+        self.batch_size = max(1, self.batch_size // 2)
+        self._publish()
+        logger.info(
+            "Device %s %s (%.0f ms), pacing down to %.0f users/s, %d concurrent, %d per request",
+            self.device_id, "slow" if outcome == OK else outcome, latency * 1000,
+            self.rate, self.concurrency, self.batch_size
+        )
+
+    def _publish(self):
+        DEVICE_WRITE_RATE.labels(self.device_id).set(self.rate)
+        DEVICE_WRITE_CONCURRENCY.labels(self.device_id).set(self.concurrency)
+        DEVICE_BATCH_SIZE.labels(self.device_id).set(self.batch_size)
+
+    def snapshot(self):
+        with self._condition:
+            return {
+                "device_id": self.device_id,
+                "rate": self.rate,
+                "concurrency": self.concurrency,
+                "batch_size": self.batch_size,
+                "decreases": self.decreases,
+                "throttled": self.throttled,
+            }
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Retention for the sync_history and sync_errors tables.
+Rows older than the retention age are moved into monthly archive tables (or
+appended to gzip-compressed JSON lines files) and counted into daily rollups,
+so the dashboard totals stay complete while the live tables stay small.
+Rows are moved in small batches, each in its own short transaction, on a
+separate connection so the sync writer is never held up for long.
+
+Usage:
+    python retention.py mock_data/integration_demo.db --history-days 90 --errors-days 30
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+logger = logging.getLogger("MockIntegrationFinal.retention")
+
+HISTORY_RETENTION_DAYS = 90
+ERRORS_RETENTION_DAYS = 30
+BATCH_SIZE = 500
+# Pause between batches so a waiting writer gets the lock
+BATCH_PAUSE_SECONDS = 0.05
+BUSY_TIMEOUT_MS = 5000
+
+HISTORY_COLUMNS = (
+    "id", "email", "cardskipper_id", "ivms_id", "previous_end_date",
+    "new_end_date", "sync_status", "sync_time",
+    "source_changed_ms", "detected_ms", "applied_ms"
+)
+ERROR_COLUMNS = ("id", "email", "error_message", "error_time", "resolved")
+
+# table -> (columns, timestamp column, rollup table, rollup key columns)
+TABLES = {
+    "sync_history": (HISTORY_COLUMNS, "sync_time", "sync_history_daily", ("sync_status",)),
+    "sync_errors": (ERROR_COLUMNS, "error_time", "sync_errors_daily", ()),
+}
+
+
+def ensure_schema(conn):
+    """Create the rollup tables and the indexes retention relies on."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_history_daily (
+            day TEXT NOT NULL,
+            sync_status TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, sync_status)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_errors_daily (
+            day TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_history_time ON sync_history (sync_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_errors_time ON sync_errors (error_time)")
+
+
+def connect(db_path):
+    """Open a connection for retention work that waits briefly on a busy writer."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # Readers keep working while a batch is moved
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+
+def archive_table_name(table, month):
+    return f"{table}_archive_{month}"
+
+
+def archive_expired(db_path, history_days=HISTORY_RETENTION_DAYS, errors_days=ERRORS_RETENTION_DAYS,
+                    archive_dir=None, batch_size=BATCH_SIZE, pause=BATCH_PAUSE_SECONDS):
+    """Move expired rows of both tables out of the live tables.
+
+    With archive_dir set, rows are appended to gzip files there instead of
+    archive tables. Returns the number of rows moved per table.
+    """
+    conn = connect(db_path)
+    try:
+        ensure_schema(conn)
+        return {
+            "sync_history": _archive_table(conn, "sync_history", history_days, archive_dir, batch_size, pause),
+            "sync_errors": _archive_table(conn, "sync_errors", errors_days, archive_dir, batch_size, pause),
+        }
+    finally:
+        conn.close()
+
+
+def _archive_table(conn, table, days, archive_dir, batch_size, pause):
+    columns, time_column, rollup_table, rollup_keys = TABLES[table]
+    # Databases created before a column was added don't have it
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    columns = tuple(column for column in columns if column in existing)
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{int(days)} days",)).fetchone()[0]
+    moved = 0
+
+    while True:
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE {time_column} < ? ORDER BY {time_column} LIMIT ?",
+            (cutoff, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        time_index = columns.index(time_column)
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[time_index][:7].replace("-", "_"), []).append(row)
+
+        if archive_dir:
+            # Written before the delete commits: a crash can repeat rows in
+            # the export but never lose them
+            _export_rows(archive_dir, table, columns, by_month)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for month, month_rows in by_month.items():
+                if not archive_dir:
+                    archive = archive_table_name(table, month)
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {archive} AS SELECT * FROM {table} WHERE 0")
+                    archived = {row[1] for row in conn.execute(f"PRAGMA table_info({archive})")}
+                    for column in columns:
+                        if column not in archived:
+                            conn.execute(f"ALTER TABLE {archive} ADD COLUMN {column}")
+                    conn.executemany(
+                        f"INSERT INTO {archive} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})",
+                        month_rows
+                    )
+            _add_to_rollup(conn, rollup_table, rollup_keys, columns, time_index, rows)
+            conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        moved += len(rows)
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    if moved:
+        logger.info("Archived %s rows from %s older than %s", moved, table, cutoff)
+    return moved
+
+
+def _add_to_rollup(conn, rollup_table, rollup_keys, columns, time_index, rows):
+    key_indexes = [columns.index(key) for key in rollup_keys]
+    counts = {}
+    for row in rows:
+        key = (row[time_index][:10],) + tuple(row[i] or "" for i in key_indexes)
+        counts[key] = counts.get(key, 0) + 1
+
+    key_columns = ("day",) + rollup_keys
+    conn.executemany(
+        f"INSERT INTO {rollup_table} ({', '.join(key_columns)}, count) "
+        f"VALUES ({', '.join('?' * len(key_columns))}, ?) "
+        f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET count = count + excluded.count",
+        [key + (count,) for key, count in counts.items()]
+    )
+
+
+def _export_rows(archive_dir, table, columns, by_month):
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_rows in by_month.items():
+        # Appending adds a gzip member; readers decompress all members in turn
+        path = os.path.join(archive_dir, f"{archive_table_name(table, month)}.jsonl.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for row in month_rows:
+                f.write(json.dumps(dict(zip(columns, row))) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db_path")
+    parser.add_argument("--history-days", type=int, default=HISTORY_RETENTION_DAYS)
+    parser.add_argument("--errors-days", type=int, default=ERRORS_RETENTION_DAYS)
+    parser.add_argument("--archive-dir", help="export to gzip files here instead of archive tables")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    moved = archive_expired(args.db_path, args.history_days, args.errors_days, args.archive_dir, args.batch_size)
+    print(f"Archived {moved['sync_history']} sync_history and {moved['sync_errors']} sync_errors rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
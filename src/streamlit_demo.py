@@ -3,32 +3,30 @@ import json
 import os
 import time
 import random
-import sqlite3
-import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import altair as alt
 
-# Set page configuration
-st.set_page_config(
-    page_title="Cardskipper to IVMS Integration Demo",
-    page_icon="🔄",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+from circuit_breaker import DeviceRouter
+from db_pool import ConnectionPool, WriteQueue
+from json_stream import iter_json_array
+from matching import IdentityMatcher, ensure_review_schema, save_reviews
+import propagation
+from retention import ERRORS_RETENTION_DAYS, HISTORY_RETENTION_DAYS, archive_expired, ensure_schema
+from sync_plan import suppress_redundant_updates
 
 # Path for mock data
 MOCK_DATA_DIR = "mock_data"
-if not os.path.exists(MOCK_DATA_DIR):
-    os.makedirs(MOCK_DATA_DIR)
 
 # Mock data files
 CARDSKIPPER_MEMBERS_FILE = os.path.join(MOCK_DATA_DIR, "cardskipper_members_demo.json")
 IVMS_USERS_FILE = os.path.join(MOCK_DATA_DIR, "ivms_users_demo.json")
 DB_FILE = os.path.join(MOCK_DATA_DIR, "integration_demo.db")
 
+# Under WAL, dashboard reads only wait during recovery or a checkpoint restart
+READ_BUSY_TIMEOUT_MS = 2000
+
 # Custom CSS
-st.markdown("""
+PAGE_CSS = """
     <style>
         .main {
             background-color: #f5f5f5;
@@ -74,82 +72,154 @@ st.markdown("""
             font-weight: bold;
         }
     </style>
-""", unsafe_allow_html=True)
+"""
 
 
 class DatabaseManager:
-    """Database manager for the integration."""
+    """Database manager for the integration.
+    
+    Writes from any thread go through a single writer thread; reads use a
+    connection per thread.
+    """
     def __init__(self, db_path):
         self.db_path = db_path
-        self.conn = None
-        self.cursor = None
+        # The pool puts the database in WAL mode, which lets dashboard queries
+        # read a committed snapshot while a sync transaction is open
+        self.pool = ConnectionPool(db_path)
+        self.writer = WriteQueue(self.pool)
+        self.read_pool = None
         self.initialize_db()
     
     def initialize_db(self):
         try:
-            self.conn = sqlite3.connect(self.db_path)
-            self.cursor = self.conn.cursor()
-            
-            # Create members table if it doesn't exist
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS members (
-                    email TEXT PRIMARY KEY,
-                    organization_member_id TEXT,
-                    start_date TEXT,
-                    end_date TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    ivms_employee_no TEXT,
-                    member_code TEXT,
-                    role_id TEXT,
-                    role_name TEXT,
-                    phone TEXT
-                )
-            ''')
-            
-            # Create sync_history table
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sync_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT NOT NULL,
-                    cardskipper_id TEXT NOT NULL,
-                    ivms_id TEXT,
-                    previous_end_date TEXT,
-                    new_end_date TEXT,
-                    sync_status TEXT,
-                    sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Create sync_errors table
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sync_errors (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT,
-                    error_message TEXT,
-                    error_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    resolved BOOLEAN DEFAULT FALSE
-                )
-            ''')
-            
-            self.conn.commit()
+            self.writer.run(self._create_schema)
+            self.read_pool = self.open_read_pool()
         except Exception as e:
             st.error(f"Error initializing database: {e}")
             raise
     
+    def _create_schema(self, conn):
+        # Create members table if it doesn't exist
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS members (
+                email TEXT PRIMARY KEY,
+                organization_member_id TEXT,
+                start_date TEXT,
+                end_date TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                ivms_employee_no TEXT,
+                member_code TEXT,
+                role_id TEXT,
+                role_name TEXT,
+                phone TEXT
+            )
+        ''')
+        
+        # Add match columns to databases created before fuzzy matching
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(members)")}
+        if "match_method" not in columns:
+            conn.execute("ALTER TABLE members ADD COLUMN match_method TEXT")
+        if "match_confidence" not in columns:
+            conn.execute("ALTER TABLE members ADD COLUMN match_confidence REAL")
+        
+        # Create sync_history table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT NOT NULL,
+                cardskipper_id TEXT NOT NULL,
+                ivms_id TEXT,
+                previous_end_date TEXT,
+                new_end_date TEXT,
+                sync_status TEXT,
+                sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Create sync_errors table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_errors (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT,
+                error_message TEXT,
+                error_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                resolved BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        
+        # Create ivms_backlog table for updates held back from offline devices
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ivms_backlog (
+                device_id TEXT NOT NULL,
+                employee_no TEXT NOT NULL,
+                email TEXT,
+                begin_time TEXT,
+                end_time TEXT,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (device_id, employee_no)
+            )
+        ''')
+        
+        # Create device_health table with the circuit breaker state per device
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS device_health (
+                device_id TEXT PRIMARY KEY,
+                state TEXT,
+                failure_count INTEGER DEFAULT 0,
+                trip_count INTEGER DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Daily rollups of archived history/errors and the time indexes
+        ensure_schema(conn)
+        
+        # Propagation timestamps on sync_history and their hourly rollup
+        propagation.ensure_schema(conn)
+        
+        # Weak identity matches waiting for a person to confirm them
+        ensure_review_schema(conn)
+    
+    def open_read_pool(self):
+        """Open read-only connections for dashboard queries."""
+        if self.db_path == ":memory:":
+            # A private in-memory database can't be opened twice
+            return self.pool
+        return ConnectionPool(self.db_path, read_only=True, busy_timeout_ms=READ_BUSY_TIMEOUT_MS)
+    
+    @contextmanager
+    def read_snapshot(self):
+        """Yield a cursor whose queries all see the same committed snapshot."""
+        cursor = self.read_pool.connection().cursor()
+        separate = self.read_pool is not self.pool
+        if separate:
+            cursor.execute("BEGIN")
+        try:
+            yield cursor
+        finally:
+            if separate:
+                # Ends the read transaction so the WAL can be checkpointed
+                cursor.execute("COMMIT")
+            cursor.close()
+    
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.writer.close()
+        if self.read_pool and self.read_pool is not self.pool:
+            self.read_pool.close()
+        self.pool.close()
     
     def get_all_members(self):
         try:
-            self.cursor.execute("""
+            cursor = self.pool.connection().cursor()
+            cursor.execute("""
                 SELECT email, organization_member_id, start_date, end_date, 
                        first_name, last_name, ivms_employee_no, member_code, 
                        role_id, role_name, phone 
                 FROM members
             """)
-            rows = self.cursor.fetchall()
+            rows = cursor.fetchall()
             
             members = {}
             for row in rows:
@@ -173,94 +243,55 @@ class DatabaseManager:
             st.error(f"Error getting members from database: {e}")
             return {}
     
-    def update_member(self, member, ivms_employee_no=None):
+    def update_member(self, member, ivms_employee_no=None, match=None, review=None):
+        """Write a member; review, a match too weak to link, is queued in the same transaction."""
+        def write(conn):
+            self._write_member(conn, member, ivms_employee_no, match)
+            if review is not None:
+                save_reviews(conn, [(member, review)])
+        
         try:
-            # Extract values from the member dict
-            email = member["email"]
-            org_member_id = member["organization_member_id"]
-            start_date = member["start_date"]
-            end_date = member["end_date"]
-            first_name = member["first_name"]
-            last_name = member["last_name"]
-            member_code = member.get("member_code", "")
-            role_id = member.get("role_id", "")
-            role_name = member.get("role_name", "")
-            phone = member.get("phone", "")
-            
-            # Check if the member exists
-            self.cursor.execute("SELECT email, end_date FROM members WHERE email = ?", (email,))
-            existing_member = self.cursor.fetchone()
+            self.writer.run(write)
+        except Exception as e:
+            st.error(f"Error updating member in database: {e}")
+            # Record error
+            self.record_sync_error(member.get("email"), str(e))
+    
+    def _write_member(self, conn, member, ivms_employee_no=None, match=None):
+        # Extract values from the member dict
+        email = member["email"]
+        org_member_id = member["organization_member_id"]
+        start_date = member["start_date"]
+        end_date = member["end_date"]
+        first_name = member["first_name"]
+        last_name = member["last_name"]
+        member_code = member.get("member_code", "")
+        role_id = member.get("role_id", "")
+        role_name = member.get("role_name", "")
+        phone = member.get("phone", "")
+        match_method = match.method if match else None
+        match_confidence = match.confidence if match else None
+        # Members are written as the sync detects their changes; a change of
+        # a member without an IVMS user never reaches a device, so it is not timed
+        detected_ms = propagation.now_ms() if ivms_employee_no else None
+        source_changed_ms = propagation.to_ms(member.get("changed_at"))
+        
+        # Check if the member exists
+        existing_member = conn.execute("SELECT email, end_date FROM members WHERE email = ?", (email,)).fetchone()
+        
+        if existing_member:
+            previous_end_date = existing_member[1]
             
-            if existing_member:
-                previous_end_date = existing_member[1]
-                
-                # Update existing member
-                if ivms_employee_no:
-                    self.cursor.execute("""
-                        UPDATE members 
-                        SET organization_member_id = ?, start_date = ?, end_date = ?, 
-                            first_name = ?, last_name = ?, ivms_employee_no = ?,
-                            member_code = ?, role_id = ?, role_name = ?, phone = ?
-                        WHERE email = ?
-                    """, (
-                        org_member_id, 
-                        start_date, 
-                        end_date,
-                        first_name,
-                        last_name,
-                        ivms_employee_no,
-                        member_code,
-                        role_id,
-                        role_name,
-                        phone,
-                        email
-                    ))
-                else:
-                    self.cursor.execute("""
-                        UPDATE members 
-                        SET organization_member_id = ?, start_date = ?, end_date = ?, 
-                            first_name = ?, last_name = ?,
-                            member_code = ?, role_id = ?, role_name = ?, phone = ?
-                        WHERE email = ?
-                    """, (
-                        org_member_id, 
-                        start_date, 
-                        end_date,
-                        first_name,
-                        last_name,
-                        member_code,
-                        role_id,
-                        role_name,
-                        phone,
-                        email
-                    ))
-                
-                # Record in sync history if end date changed
-                if previous_end_date != end_date:
-                    self.cursor.execute("""
-                        INSERT INTO sync_history (
-                            email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (
-                        email,
-                        org_member_id,
-                        ivms_employee_no or "Not matched",
-                        previous_end_date,
-                        end_date,
-                        "Success" if ivms_employee_no else "Pending"
-                    ))
-            else:
-                # Insert new member
-                self.cursor.execute("""
-                    INSERT INTO members (
-                        email, organization_member_id, start_date, end_date,
-                        first_name, last_name, ivms_employee_no, member_code, 
-                        role_id, role_name, phone
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            # Update existing member
+            if match:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?, ivms_employee_no = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?,
+                        match_method = ?, match_confidence = ?
+                    WHERE email = ?
                 """, (
-                    email, 
                     org_member_id, 
                     start_date, 
                     end_date,
@@ -270,39 +301,131 @@ class DatabaseManager:
                     member_code,
                     role_id,
                     role_name,
-                    phone
+                    phone,
+                    match_method,
+                    match_confidence,
+                    email
                 ))
-                
-                # Record in sync history as new member
-                self.cursor.execute("""
+            elif ivms_employee_no:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?, ivms_employee_no = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?
+                    WHERE email = ?
+                """, (
+                    org_member_id, 
+                    start_date, 
+                    end_date,
+                    first_name,
+                    last_name,
+                    ivms_employee_no,
+                    member_code,
+                    role_id,
+                    role_name,
+                    phone,
+                    email
+                ))
+            else:
+                conn.execute("""
+                    UPDATE members 
+                    SET organization_member_id = ?, start_date = ?, end_date = ?, 
+                        first_name = ?, last_name = ?,
+                        member_code = ?, role_id = ?, role_name = ?, phone = ?
+                    WHERE email = ?
+                """, (
+                    org_member_id, 
+                    start_date, 
+                    end_date,
+                    first_name,
+                    last_name,
+                    member_code,
+                    role_id,
+                    role_name,
+                    phone,
+                    email
+                ))
+            
+            # Record in sync history if end date changed
+            if previous_end_date != end_date:
+                propagation.supersede(conn, email)
+                conn.execute("""
                     INSERT INTO sync_history (
-                        email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status
+                        email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status,
+                        source_changed_ms, detected_ms
                     )
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     email,
                     org_member_id,
                     ivms_employee_no or "Not matched",
-                    None,
+                    previous_end_date,
                     end_date,
-                    "New member"
+                    "Success" if ivms_employee_no else "Pending",
+                    source_changed_ms,
+                    detected_ms
                 ))
+        else:
+            # Insert new member
+            conn.execute("""
+                INSERT INTO members (
+                    email, organization_member_id, start_date, end_date,
+                    first_name, last_name, ivms_employee_no, member_code, 
+                    role_id, role_name, phone, match_method, match_confidence
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                email, 
+                org_member_id, 
+                start_date, 
+                end_date,
+                first_name,
+                last_name,
+                ivms_employee_no,
+                member_code,
+                role_id,
+                role_name,
+                phone,
+                match_method,
+                match_confidence
+            ))
             
-            self.conn.commit()
+            # Record in sync history as new member
+            conn.execute("""
+                INSERT INTO sync_history (
+                    email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status,
+                    source_changed_ms, detected_ms
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                email,
+                org_member_id,
+                ivms_employee_no or "Not matched",
+                None,
+                end_date,
+                "New member",
+                source_changed_ms,
+                detected_ms
+            ))
+    
+    def mark_applied(self, entries):
+        """Record when IVMS applied (email, end_date, applied_ms) changes."""
+        try:
+            self.writer.run(propagation.mark_applied, entries)
         except Exception as e:
-            st.error(f"Error updating member in database: {e}")
-            # Record error
-            self.cursor.execute("""
-                INSERT INTO sync_errors (email, error_message)
-                VALUES (?, ?)
-            """, (email, str(e)))
-            self.conn.commit()
-            self.conn.rollback()
+            st.error(f"Error recording applied changes: {e}")
+    
+    def record_sync_error(self, email, message):
+        try:
+            self.writer.execute("INSERT INTO sync_errors (email, error_message) VALUES (?, ?)", (email, message))
+        except Exception as e:
+            st.error(f"Error recording sync error: {e}")
     
     def get_ivms_employee_no(self, email):
         try:
-            self.cursor.execute("SELECT ivms_employee_no FROM members WHERE email = ?", (email,))
-            result = self.cursor.fetchone()
+            cursor = self.pool.connection().cursor()
+            cursor.execute("SELECT ivms_employee_no FROM members WHERE email = ?", (email,))
+            result = cursor.fetchone()
             return result[0] if result and result[0] else None
         except Exception as e:
             st.error(f"Error getting IVMS employee number for {email}: {e}")
@@ -310,74 +433,93 @@ class DatabaseManager:
     
     def get_sync_history(self, limit=100):
         try:
-            self.cursor.execute("""
-                SELECT id, email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status, sync_time
-                FROM sync_history
-                ORDER BY sync_time DESC
-                LIMIT ?
-            """, (limit,))
-            return self.cursor.fetchall()
+            with self.read_snapshot() as cursor:
+                cursor.execute("""
+                    SELECT id, email, cardskipper_id, ivms_id, previous_end_date, new_end_date, sync_status, sync_time
+                    FROM sync_history
+                    ORDER BY sync_time DESC
+                    LIMIT ?
+                """, (limit,))
+                return cursor.fetchall()
         except Exception as e:
             st.error(f"Error getting sync history: {e}")
             return []
     
     def get_sync_errors(self, limit=100):
         try:
-            self.cursor.execute("""
-                SELECT id, email, error_message, error_time, resolved
-                FROM sync_errors
-                ORDER BY error_time DESC
-                LIMIT ?
-            """, (limit,))
-            return self.cursor.fetchall()
+            with self.read_snapshot() as cursor:
+                cursor.execute("""
+                    SELECT id, email, error_message, error_time, resolved
+                    FROM sync_errors
+                    ORDER BY error_time DESC
+                    LIMIT ?
+                """, (limit,))
+                return cursor.fetchall()
         except Exception as e:
             st.error(f"Error getting sync errors: {e}")
             return []
     
     def get_sync_stats(self):
         try:
-            # Get total members
-            self.cursor.execute("SELECT COUNT(*) FROM members")
-            total_members = self.cursor.fetchone()[0]
-            
-            # Get synced members (with IVMS ID)
-            self.cursor.execute("SELECT COUNT(*) FROM members WHERE ivms_employee_no IS NOT NULL")
-            synced_members = self.cursor.fetchone()[0]
-            
-            # Get unsynced members
-            self.cursor.execute("SELECT COUNT(*) FROM members WHERE ivms_employee_no IS NULL")
-            unsynced_members = self.cursor.fetchone()[0]
-            
-            # Get total sync operations
-            self.cursor.execute("SELECT COUNT(*) FROM sync_history")
-            total_syncs = self.cursor.fetchone()[0]
-            
-            # Get successful syncs
-            self.cursor.execute("SELECT COUNT(*) FROM sync_history WHERE sync_status = 'Success'")
-            successful_syncs = self.cursor.fetchone()[0]
-            
-            # Get sync errors
-            self.cursor.execute("SELECT COUNT(*) FROM sync_errors")
-            sync_errors = self.cursor.fetchone()[0]
-            
-            # Get sync history grouped by day
-            self.cursor.execute("""
-                SELECT DATE(sync_time) as sync_date, COUNT(*) as count
-                FROM sync_history
-                GROUP BY DATE(sync_time)
-                ORDER BY sync_date
-            """)
-            sync_by_date = self.cursor.fetchall()
-            
-            return {
-                "total_members": total_members,
-                "synced_members": synced_members,
-                "unsynced_members": unsynced_members,
-                "total_syncs": total_syncs,
-                "successful_syncs": successful_syncs,
-                "sync_errors": sync_errors,
-                "sync_by_date": sync_by_date
-            }
+            with self.read_snapshot() as cursor:
+                # Get total members
+                cursor.execute("SELECT COUNT(*) FROM members")
+                total_members = cursor.fetchone()[0]
+                
+                # Get synced members (with IVMS ID)
+                cursor.execute("SELECT COUNT(*) FROM members WHERE ivms_employee_no IS NOT NULL")
+                synced_members = cursor.fetchone()[0]
+                
+                # Get unsynced members
+                cursor.execute("SELECT COUNT(*) FROM members WHERE ivms_employee_no IS NULL")
+                unsynced_members = cursor.fetchone()[0]
+                
+                # Totals include rows already moved to the archive (daily rollups)
+                # Get total sync operations
+                cursor.execute("""
+                    SELECT (SELECT COUNT(*) FROM sync_history)
+                         + (SELECT COALESCE(SUM(count), 0) FROM sync_history_daily)
+                """)
+                total_syncs = cursor.fetchone()[0]
+                
+                # Get successful syncs
+                cursor.execute("""
+                    SELECT (SELECT COUNT(*) FROM sync_history WHERE sync_status = 'Success')
+                         + (SELECT COALESCE(SUM(count), 0) FROM sync_history_daily WHERE sync_status = 'Success')
+                """)
+                successful_syncs = cursor.fetchone()[0]
+                
+                # Get sync errors
+                cursor.execute("""
+                    SELECT (SELECT COUNT(*) FROM sync_errors)
+                         + (SELECT COALESCE(SUM(count), 0) FROM sync_errors_daily)
+                """)
+                sync_errors = cursor.fetchone()[0]
+                
+                # Get sync history grouped by day
+                cursor.execute("""
+                    SELECT sync_date, SUM(count) as count
+                    FROM (
+                        SELECT DATE(sync_time) as sync_date, COUNT(*) as count
+                        FROM sync_history
+                        GROUP BY DATE(sync_time)
+                        UNION ALL
+                        SELECT day, count FROM sync_history_daily
+                    )
+                    GROUP BY sync_date
+                    ORDER BY sync_date
+                """)
+                sync_by_date = cursor.fetchall()
+                
+                return {
+                    "total_members": total_members,
+                    "synced_members": synced_members,
+                    "unsynced_members": unsynced_members,
+                    "total_syncs": total_syncs,
+                    "successful_syncs": successful_syncs,
+                    "sync_errors": sync_errors,
+                    "sync_by_date": sync_by_date
+                }
         except Exception as e:
             st.error(f"Error getting sync stats: {e}")
             return {
@@ -390,10 +532,121 @@ class DatabaseManager:
                 "sync_by_date": []
             }
     
+    def enqueue_backlog(self, device_id, update):
+        try:
+            self.writer.execute("""
+                INSERT OR REPLACE INTO ivms_backlog (device_id, employee_no, email, begin_time, end_time)
+                VALUES (?, ?, ?, ?, ?)
+            """, (
+                device_id,
+                update["ivms_employee_no"],
+                update["email"],
+                update["start_date"],
+                update["end_date"]
+            ))
+        except Exception as e:
+            st.error(f"Error adding backlog entry: {e}")
+    
+    def get_backlog(self, device_id):
+        try:
+            cursor = self.pool.connection().cursor()
+            cursor.execute("""
+                SELECT employee_no, email, begin_time, end_time
+                FROM ivms_backlog
+                WHERE device_id = ?
+                ORDER BY queued_at
+            """, (device_id,))
+            return [
+                {
+                    "ivms_employee_no": employee_no,
+                    "email": email,
+                    "start_date": begin_time,
+                    "end_date": end_time
+                }
+                for employee_no, email, begin_time, end_time in cursor.fetchall()
+            ]
+        except Exception as e:
+            st.error(f"Error getting backlog: {e}")
+            return []
+    
+    def remove_backlog(self, device_id, employee_no):
+        def remove(conn):
+            # The entry was replayed to the device, so its change has now been applied
+            row = conn.execute(
+                "SELECT email, end_time FROM ivms_backlog WHERE device_id = ? AND employee_no = ?",
+                (device_id, employee_no)
+            ).fetchone()
+            conn.execute("DELETE FROM ivms_backlog WHERE device_id = ? AND employee_no = ?", (device_id, employee_no))
+            if row:
+                propagation.mark_applied(conn, [(row[0], row[1], propagation.now_ms())])
+        
+        try:
+            self.writer.run(remove)
+        except Exception as e:
+            st.error(f"Error removing backlog entry: {e}")
+    
+    def save_device_health(self, snapshots):
+        try:
+            self.writer.executemany("""
+                INSERT OR REPLACE INTO device_health (
+                    device_id, state, failure_count, trip_count, last_error, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, [
+                (s["device_id"], s["state"], s["failure_count"], s["trip_count"], s["last_error"])
+                for s in snapshots
+            ])
+        except Exception as e:
+            st.error(f"Error saving device health: {e}")
+    
+    def get_device_health(self):
+        try:
+            with self.read_snapshot() as cursor:
+                cursor.execute("""
+                    SELECT h.device_id, h.state, h.failure_count, h.trip_count, h.last_error,
+                           (SELECT COUNT(*) FROM ivms_backlog b WHERE b.device_id = h.device_id)
+                    FROM device_health h
+                    ORDER BY h.device_id
+                """)
+                return [
+                    {
+                        "device_id": device_id,
+                        "state": state,
+                        "failure_count": failure_count,
+                        "trip_count": trip_count,
+                        "last_error": last_error,
+                        "backlog": backlog
+                    }
+                    for device_id, state, failure_count, trip_count, last_error, backlog in cursor.fetchall()
+                ]
+        except Exception as e:
+            st.error(f"Error getting device health: {e}")
+            return []
+    
+    def get_propagation_slo(self, slo_seconds=propagation.PROPAGATION_SLO_SECONDS, hours=48):
+        """Hourly latency percentiles from the rollup and the changes currently breaching the SLO."""
+        since_hour = (datetime.utcnow() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:00")
+        try:
+            with self.read_snapshot() as cursor:
+                return {
+                    "percentiles": propagation.latency_percentiles(cursor, since_hour),
+                    "breaching": propagation.breaching(cursor, slo_seconds)
+                }
+        except Exception as e:
+            st.error(f"Error getting propagation latency: {e}")
+            return {"percentiles": [], "breaching": []}
+    
+    def run_retention(self, history_days=HISTORY_RETENTION_DAYS, errors_days=ERRORS_RETENTION_DAYS):
+        """Archive old sync history and errors on a separate connection."""
+        try:
+            return archive_expired(self.db_path, history_days, errors_days)
+        except Exception as e:
+            st.error(f"Error archiving old sync records: {e}")
+            return {"sync_history": 0, "sync_errors": 0}
+    
     def resolve_error(self, error_id):
         try:
-            self.cursor.execute("UPDATE sync_errors SET resolved = 1 WHERE id = ?", (error_id,))
-            self.conn.commit()
+            self.writer.execute("UPDATE sync_errors SET resolved = 1 WHERE id = ?", (error_id,))
             return True
         except Exception as e:
             st.error(f"Error resolving error: {e}")
@@ -404,18 +657,26 @@ class MockCardskipper:
     """Mock Cardskipper API with sample data."""
     def __init__(self, data_file):
         self.data_file = data_file
+        self._members = None
         self.load_or_create_data()
     
     def load_or_create_data(self):
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-                self.members = data.get("members", [])
-        else:
+        if not os.path.exists(self.data_file):
             # Create mock data
-            self.members = self.generate_mock_members()
+            self._members = self.generate_mock_members()
             with open(self.data_file, 'w') as f:
-                json.dump({"members": self.members}, f, indent=2)
+                json.dump({"members": self._members}, f, indent=2)
+    
+    @property
+    def members(self):
+        """All raw members, loaded on first access for modification."""
+        if self._members is None:
+            self._members = list(self.iter_members())
+        return self._members
+    
+    def iter_members(self):
+        """Yield raw members one at a time straight from the data file."""
+        return iter_json_array(self.data_file, ["members"])
     
     def save_data(self):
         with open(self.data_file, 'w') as f:
@@ -700,10 +961,13 @@ class MockCardskipper:
     
     def get_active_members(self):
         """Return only active members in a simplified format."""
-        active_members = []
+        return list(self.iter_active_members())
+    
+    def iter_active_members(self):
+        """Yield active members in a simplified format as they are read."""
         today = datetime.now()
         
-        for member in self.members:
+        for member in self.iter_members():
             try:
                 # Extract key information
                 role = member["Organisations"]["Organisation"]["Roles"]["Role"]
@@ -723,13 +987,12 @@ class MockCardskipper:
                         "start_date": role["StartDate"],
                         "end_date": role["EndDate"],
                         "role_id": str(role["Id"]),
-                        "role_name": role["Name"]
+                        "role_name": role["Name"],
+                        "changed_at": member.get("LastModified")
                     }
-                    active_members.append(simplified_member)
+                    yield simplified_member
             except (KeyError, ValueError) as e:
                 st.error(f"Error processing member {member.get('OrganisationMemberId', 'unknown')}: {e}")
-        
-        return active_members
     
     def extend_membership(self, email, days=30):
         """Extend a member's membership by the specified number of days."""
@@ -748,6 +1011,7 @@ class MockCardskipper:
                     
                     # Update the member
                     role["EndDate"] = new_end.strftime("%Y-%m-%dT%H:%M:%S")
+                    member["LastModified"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
                     
                     # Save changes
                     self.save_data()
@@ -779,17 +1043,18 @@ class MockCardskipper:
 
 class MockIVMS:
     """Mock IVMS API with sample data."""
-    def __init__(self, data_file):
+    def __init__(self, data_file, device_id="ivms-1"):
         self.data_file = data_file
+        self.device_id = device_id
+        self.online = True
         self.load_or_create_data()
     
     def load_or_create_data(self):
         if os.path.exists(self.data_file):
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-                self.user_info = data.get("UserInfoSearchResult", {}).get("UserInfo", [])
-                self.search_id = data.get("UserInfoSearchResult", {}).get("searchID", "1")
-                self.total_matches = len(self.user_info)
+            header = {}
+            self.user_info = list(iter_json_array(self.data_file, ["UserInfoSearchResult", "UserInfo"], header))
+            self.search_id = header.get("searchID", "1")
+            self.total_matches = len(self.user_info)
         else:
             # Create mock data
             self.user_info = self.generate_mock_users()
@@ -902,6 +1167,16 @@ class MockIVMS:
         
         return users
     
+    def check_available(self):
+        """Raise TimeoutError if the simulated device is offline."""
+        if not self.online:
+            raise TimeoutError(f"IVMS device {self.device_id} did not respond")
+    
+    def get_device_info(self):
+        """Return basic device information (used as a health probe)."""
+        self.check_available()
+        return {"deviceID": self.device_id, "model": "MockIVMS"}
+    
     def get_all_users(self):
         """Return all IVMS users."""
         return self.user_info
@@ -915,6 +1190,7 @@ class MockIVMS:
     
     def update_user_validity(self, employee_no, begin_time, end_time):
         """Update a user's validity period."""
+        self.check_available()
         for user in self.user_info:
             if user["employeeNo"] == employee_no:
                 user["Valid"]["beginTime"] = begin_time
@@ -924,6 +1200,22 @@ class MockIVMS:
                 return True
         
         return False
+    
+    def update_users_validity(self, validities):
+        """Update the validity of several users in one request; returns the employee numbers found."""
+        self.check_available()
+        users = {user["employeeNo"]: user for user in self.user_info}
+        updated = []
+        for employee_no, begin_time, end_time in validities:
+            user = users.get(employee_no)
+            if user is not None:
+                user["Valid"]["beginTime"] = begin_time
+                user["Valid"]["endTime"] = end_time
+                user["Valid"]["enable"] = True
+                updated.append(employee_no)
+        if updated:
+            self.save_data()
+        return updated
 
 
 class MockSyncService:
@@ -932,10 +1224,14 @@ class MockSyncService:
         self.cardskipper = cardskipper
         self.ivms = ivms
         self.db = db
+        self.router = DeviceRouter([ivms], db, saved_health=db.get_device_health())
     
     def sync(self):
         """Synchronize membership data between systems."""
         try:
+            # Replay backlogged updates if the device has come back online
+            drained_count = self.router.recover()
+            
             # Get active members from Cardskipper
             cardskipper_members = self.cardskipper.get_active_members()
             
@@ -948,14 +1244,10 @@ class MockSyncService:
             # Get all members from database
             db_members = self.db.get_all_members()
             
-            # Get all IVMS users
+            # Index IVMS users for matching, skipping users already linked to a member
             ivms_users = self.ivms.get_all_users()
-            
-            # Create email to user ID mapping
-            email_to_user_id = {}
-            for user in ivms_users:
-                if "email" in user and user["email"]:
-                    email_to_user_id[user["email"]] = user["employeeNo"]
+            claimed = {m["ivms_employee_no"] for m in db_members.values() if m["ivms_employee_no"]}
+            matcher = IdentityMatcher(ivms_users, claimed=claimed)
             
             # Process each member from Cardskipper
             updates_needed = []
@@ -983,11 +1275,19 @@ class MockSyncService:
                         needs_update = True
                     
                     # If we don't have an IVMS employee number yet, try to find one
-                    if not ivms_employee_no and email in email_to_user_id:
-                        ivms_employee_no = email_to_user_id[email]
+                    match = None
+                    review = None
+                    if not ivms_employee_no:
+                        match = matcher.match(member)
+                        if match and match.needs_review:
+                            # Too weak to grant access without a person confirming it
+                            review, match = match, None
+                        elif match:
+                            ivms_employee_no = match.employee_no
+                            matcher.claim(ivms_employee_no)
                     
                     # Update member in our database
-                    self.db.update_member(member, ivms_employee_no)
+                    self.db.update_member(member, ivms_employee_no, match, review)
                     
                     # If member needs update and we have an IVMS employee number, update IVMS
                     if needs_update and ivms_employee_no:
@@ -1000,30 +1300,39 @@ class MockSyncService:
                 
                 except Exception as e:
                     # Record error
-                    self.db.cursor.execute("""
-                        INSERT INTO sync_errors (email, error_message)
-                        VALUES (?, ?)
-                    """, (member.get("email", "unknown"), str(e)))
-                    self.db.conn.commit()
+                    self.db.record_sync_error(member.get("email", "unknown"), str(e))
+            
+            # Skip writes for users whose IVMS validity already matches
+            device_state = {
+                u["employeeNo"]: (u["Valid"]["beginTime"], u["Valid"]["endTime"], u["Valid"]["enable"])
+                for u in ivms_users
+            }
+            updates_needed, suppressed = suppress_redundant_updates(updates_needed, device_state)
+            
+            # IVMS already holds the suppressed changes
+            applied = [(u["email"], u["end_date"], propagation.now_ms()) for u in suppressed]
             
-            # Perform IVMS updates
+            # Perform IVMS updates in paced batches, backlogging them while the device is unhealthy
             updated_count = 0
-            for update in updates_needed:
-                success = self.ivms.update_user_validity(
-                    update["ivms_employee_no"],
-                    update["start_date"],
-                    update["end_date"]
-                )
-                
-                if success:
+            queued_count = 0
+            for update, result in zip(updates_needed, self.router.push_updates(updates_needed)):
+                if result["applied"]:
                     updated_count += 1
+                    applied.append((update["email"], update["end_date"], propagation.now_ms()))
+                elif result["queued"]:
+                    queued_count += 1
+            
+            self.db.mark_applied(applied)
             
             return {
                 "success": True,
                 "message": f"Synchronization completed successfully",
                 "total_members": len(cardskipper_members),
-                "updates_needed": len(updates_needed),
-                "updates_completed": updated_count
+                "updates_needed": len(updates_needed) + len(suppressed),
+                "updates_completed": updated_count,
+                "writes_suppressed": len(suppressed),
+                "updates_queued": queued_count,
+                "backlog_replayed": drained_count
             }
             
         except Exception as e:
@@ -1031,10 +1340,25 @@ class MockSyncService:
                 "success": False,
                 "message": f"Error during synchronization: {e}"
             }
+        finally:
+            self.db.save_device_health(self.router.snapshot())
+
+
+def configure_page():
+    """Set up the page; must run before anything else is rendered."""
+    st.set_page_config(
+        page_title="Cardskipper to IVMS Integration Demo",
+        page_icon="🔄",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 
 def initialize_demo():
     """Initialize the demo environment."""
+    os.makedirs(MOCK_DATA_DIR, exist_ok=True)
+    
     # Initialize components
     cardskipper = MockCardskipper(CARDSKIPPER_MEMBERS_FILE)
     ivms = MockIVMS(IVMS_USERS_FILE)
@@ -1056,6 +1380,10 @@ def show_header():
 
 def show_dashboard(db, sync_service):
     """Display the main dashboard."""
+    # pandas, matplotlib and altair are imported where they are used rather
+    # than at module level; they dominate the script's startup time
+    import pandas as pd
+    
     st.markdown("## Dashboard", unsafe_allow_html=True)
     
     # Get stats
@@ -1078,6 +1406,8 @@ def show_dashboard(db, sync_service):
     with col1:
         st.markdown("### Members Status", unsafe_allow_html=True)
         if stats["total_members"] > 0:
+            import matplotlib.pyplot as plt
+            
             fig, ax = plt.subplots()
             ax.pie(
                 [stats["synced_members"], stats["unsynced_members"]], 
@@ -1092,6 +1422,8 @@ def show_dashboard(db, sync_service):
     with col2:
         st.markdown("### Sync History", unsafe_allow_html=True)
         if stats["sync_by_date"]:
+            import altair as alt
+            
             # Create a pandas DataFrame from the sync_by_date data
             df = pd.DataFrame(stats["sync_by_date"], columns=["Date", "Count"])
             df["Date"] = pd.to_datetime(df["Date"])
@@ -1123,6 +1455,74 @@ def show_dashboard(db, sync_service):
     else:
         st.info("No sync operations have been performed yet.")
     
+    # Show renewal-to-door latency from the hourly rollup
+    st.markdown("### Propagation Latency", unsafe_allow_html=True)
+    slo_minutes = st.number_input(
+        "SLO (minutes from a Cardskipper change to IVMS)",
+        min_value=1,
+        value=propagation.PROPAGATION_SLO_SECONDS // 60,
+        key="propagation_slo"
+    )
+    slo = db.get_propagation_slo(slo_seconds=slo_minutes * 60)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if slo["percentiles"]:
+            import altair as alt
+            
+            latency_df = pd.DataFrame([
+                {"Hour": hour, "Percentile": f"p{q}", "Seconds": value / 1000}
+                for hour, count, values in slo["percentiles"]
+                for q, value in values.items()
+            ])
+            latency_df["Hour"] = pd.to_datetime(latency_df["Hour"])
+            
+            chart = alt.Chart(latency_df).mark_line(point=True).encode(
+                x=alt.X('Hour:T', title='Hour (UTC)'),
+                y=alt.Y('Seconds:Q', title='Propagation latency (s)'),
+                color=alt.Color('Percentile:N')
+            ).properties(height=300)
+            
+            st.altair_chart(chart, use_container_width=True)
+        else:
+            st.info("No applied changes in the last 48 hours.")
+    
+    with col2:
+        if slo["breaching"]:
+            st.warning(f"{len(slo['breaching'])} change(s) not in IVMS after {slo_minutes} minutes")
+            breach_df = pd.DataFrame([
+                {
+                    "Email": b["email"],
+                    "IVMS ID": b["ivms_id"],
+                    "New End Date": b["new_end_date"],
+                    "Waiting (min)": round(b["waiting_seconds"] / 60, 1)
+                }
+                for b in slo["breaching"]
+            ])
+            st.dataframe(breach_df, hide_index=True)
+        else:
+            st.success(f"All changes reached IVMS within {slo_minutes} minutes.")
+    
+    # Show IVMS device health
+    st.markdown("### IVMS Device Health", unsafe_allow_html=True)
+    device_health = db.get_device_health()
+    
+    if device_health:
+        health_df = pd.DataFrame([
+            {
+                "Device": d["device_id"],
+                "Circuit": d["state"].replace("_", "-").title(),
+                "Consecutive Failures": d["failure_count"],
+                "Trips": d["trip_count"],
+                "Backlog": d["backlog"],
+                "Last Error": d["last_error"] or ""
+            }
+            for d in device_health
+        ])
+        st.dataframe(health_df, hide_index=True)
+    else:
+        st.info("No device health information yet. Run a synchronization first.")
+    
     # Show sync errors
     st.markdown("### Sync Errors", unsafe_allow_html=True)
     sync_errors = db.get_sync_errors(limit=10)
@@ -1147,6 +1547,8 @@ def show_cardskipper_members(cardskipper):
     
     # Convert to DataFrame for display
     if active_members:
+        import pandas as pd
+        
         df = pd.DataFrame([
             {
                 "Name": f"{m['first_name']} {m['last_name']}",
@@ -1202,6 +1604,8 @@ def show_ivms_users(ivms):
     
     # Convert to DataFrame for display
     if users:
+        import pandas as pd
+        
         df = pd.DataFrame([
             {
                 "Employee No": u['employeeNo'],
@@ -1224,6 +1628,13 @@ def show_sync_controls(sync_service):
     st.markdown("## Synchronization", unsafe_allow_html=True)
     st.markdown("This section allows you to manually trigger the synchronization process.")
     
+    # Simulate an IVMS controller that stops responding
+    sync_service.ivms.online = not st.checkbox(
+        "Simulate IVMS device offline",
+        key="ivms_offline",
+        help="Updates are held in a backlog while the device circuit is open and replayed once it recovers."
+    )
+    
     if st.button("Run Synchronization", type="primary"):
         with st.spinner("Running synchronization..."):
             # Add a small delay to simulate processing
@@ -1235,14 +1646,29 @@ def show_sync_controls(sync_service):
                 st.markdown(f"""
                 **Total members processed:** {result['total_members']}  
                 **Updates needed:** {result['updates_needed']}  
-                **Updates completed:** {result['updates_completed']}
+                **Updates completed:** {result['updates_completed']}  
+                **Writes skipped (IVMS already up to date):** {result['writes_suppressed']}  
+                **Updates queued for offline device:** {result['updates_queued']}  
+                **Backlogged updates replayed:** {result['backlog_replayed']}
                 """)
             else:
                 st.error(result["message"])
+    
+    # Retention: move old history/errors into monthly archive tables
+    st.markdown("### Maintenance", unsafe_allow_html=True)
+    if st.button("Archive Old Sync Records"):
+        with st.spinner("Archiving..."):
+            moved = sync_service.db.run_retention()
+        st.success(
+            f"Archived {moved['sync_history']} sync history rows older than {HISTORY_RETENTION_DAYS} days "
+            f"and {moved['sync_errors']} errors older than {ERRORS_RETENTION_DAYS} days."
+        )
 
 
 def main():
     """Main application function."""
+    configure_page()
+    
     # Initialize demo environment
     cardskipper, ivms, db, sync_service = initialize_demo()
     
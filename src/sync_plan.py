@@ -0,0 +1,197 @@
+"""
+Change planning for the sync service.
+Comparing Cardskipper members with the stored state is a pure function that
+produces a change set; the sync service applies the change set afterwards.
+For very large organisations the comparison can be split into shards by a
+hash of the member email and run across a process pool.
+"""
+
+import logging
+import sqlite3
+import zlib
+
+from matching import EMAIL_CONFIDENCE, Match, normalize_email
+
+logger = logging.getLogger("MockIntegrationFinal.plan")
+
+MEMBER_COLUMNS = (
+    "email", "organization_member_id", "start_date", "end_date",
+    "first_name", "last_name", "ivms_employee_no", "member_code",
+    "role_id", "role_name", "phone", "match_method", "match_confidence"
+)
+
+# Fields copied from Cardskipper into the members table
+SYNCED_FIELDS = (
+    "organization_member_id", "start_date", "end_date", "first_name", "last_name",
+    "member_code", "role_id", "role_name", "phone"
+)
+
+
+def shard_for(email, shard_count):
+    """Return the shard a member belongs to; stable across processes and runs."""
+    return zlib.crc32(normalize_email(email).encode("utf-8")) % shard_count
+
+
+def plan_changes(members, db_members, match_member=None):
+    """Compare members against their stored state and return a change set.
+
+    match_member(member) is called for members without an IVMS employee
+    number and may return a Match. The change set has:
+    - writes: (member, ivms_employee_no, match) tuples to store
+    - updates: validity updates to push to IVMS
+    - unmatched: members that still have no IVMS employee number
+    - review: (member, match) for matches too weak to link automatically;
+      their members are unmatched too
+    """
+    writes = []
+    updates = []
+    unmatched = []
+    review = []
+
+    for member in members:
+        try:
+            email = member["email"]
+            db_member = db_members.get(email)
+
+            if db_member is None:
+                # New member, needs update
+                needs_update = True
+                ivms_employee_no = None
+                logger.debug("New member found: %s", email)
+            else:
+                # If end date has changed, we need to update
+                needs_update = db_member["end_date"] != member["end_date"]
+                if needs_update:
+                    logger.debug("Member %s needs update: end date changed from %s to %s", email, db_member['end_date'], member['end_date'])
+                ivms_employee_no = db_member["ivms_employee_no"]
+
+            # If we don't have an IVMS employee number yet, try to find one
+            match = None
+            if not ivms_employee_no and match_member:
+                match = match_member(member)
+                if match and match.needs_review:
+                    review.append((member, match))
+                    logger.debug("Match for %s needs review: %s", email, match)
+                    match = None
+                elif match:
+                    ivms_employee_no = match.employee_no
+                    logger.debug("Found IVMS employee number for %s: %s (by %s, confidence %.2f)", email, ivms_employee_no, match.method, match.confidence)
+
+            if needs_update or match or _fields_changed(member, db_member):
+                writes.append((member, ivms_employee_no, match))
+
+            if not ivms_employee_no:
+                unmatched.append(member)
+            elif needs_update or match:
+                updates.append({
+                    "email": email,
+                    "ivms_employee_no": ivms_employee_no,
+                    "start_date": member["start_date"],
+                    "end_date": member["end_date"]
+                })
+
+        except Exception as e:
+            logger.error("Error processing member %s: %s", member.get('email', 'unknown'), e)
+
+    return {"writes": writes, "updates": updates, "unmatched": unmatched, "review": review}
+
+
+def suppress_redundant_updates(updates, device_state):
+    """Split updates into those that would change the device and those it already has.
+
+    device_state maps employeeNo to the known (beginTime, endTime, enable)
+    on the device. Returns (needed, suppressed).
+    """
+    needed = []
+    suppressed = []
+
+    for update in updates:
+        intended = (update["start_date"], update["end_date"], True)
+        if device_state.get(update["ivms_employee_no"]) == intended:
+            suppressed.append(update)
+        else:
+            needed.append(update)
+
+    return needed, suppressed
+
+
+def _fields_changed(member, db_member):
+    return any(member.get(field, "") != db_member[field] for field in SYNCED_FIELDS)
+
+
+def load_member_slice(db_path, shard_index, shard_count):
+    """Read the stored members belonging to one shard."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        conn.create_function("shard_for", 2, shard_for, deterministic=True)
+        rows = conn.execute(
+            f"SELECT {', '.join(MEMBER_COLUMNS)} FROM members WHERE shard_for(email, ?) = ?",
+            (shard_count, shard_index)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return {row[0]: dict(zip(MEMBER_COLUMNS, row)) for row in rows}
+
+
+def plan_shard(db_path, shard_index, shard_count, members, ivms_users, claimed=()):
+    """Plan one shard; runs in a worker process.
+
+    Only email matches are made here, since a phone or name match is only
+    safe if it is unique across all shards. claimed holds the employee
+    numbers linked to members of any shard, which must not be linked
+    again. Members left unmatched are returned for the coordinator to
+    match globally.
+    """
+    db_members = load_member_slice(db_path, shard_index, shard_count)
+
+    email_to_user_id = {}
+    for user in ivms_users:
+        email_to_user_id.setdefault(normalize_email(user.get("email")), user["employeeNo"])
+
+    # A user linked earlier by phone or name may belong to a member of another shard
+    claimed = set(claimed)
+    claimed.update(m["ivms_employee_no"] for m in db_members.values() if m["ivms_employee_no"])
+
+    def match_member(member):
+        employee_no = email_to_user_id.get(normalize_email(member["email"]))
+        if employee_no and employee_no not in claimed:
+            claimed.add(employee_no)
+            return Match(employee_no, "email", EMAIL_CONFIDENCE)
+        return None
+
+    changes = plan_changes(members, db_members, match_member)
+    changes["db_members"] = {m["email"]: db_members[m["email"]] for m in changes["unmatched"] if m["email"] in db_members}
+    return changes
+
+
+def plan_sharded(executor, db_path, members, ivms_users, shard_count, claimed=()):
+    """Partition members and IVMS users by email hash and plan every shard in the executor.
+
+    claimed is the set of employee numbers already linked to a member; it
+    is passed to every shard. Returns the merged change set; db_members
+    holds the stored rows of the unmatched members so the coordinator can
+    finish matching them.
+    """
+    member_slices = [[] for _ in range(shard_count)]
+    for member in members:
+        member_slices[shard_for(member["email"], shard_count)].append(member)
+
+    user_slices = [[] for _ in range(shard_count)]
+    for user in ivms_users:
+        if user.get("email"):
+            user_slices[shard_for(user["email"], shard_count)].append(user)
+
+    futures = [
+        executor.submit(plan_shard, db_path, index, shard_count, member_slices[index], user_slices[index], claimed)
+        for index in range(shard_count)
+    ]
+
+    merged = {"writes": [], "updates": [], "unmatched": [], "review": [], "db_members": {}}
+    for future in futures:
+        changes = future.result()
+        for key in ("writes", "updates", "unmatched", "review"):
+            merged[key].extend(changes[key])
+        merged["db_members"].update(changes["db_members"])
+
+    return merged
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+# The modules under src/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from benchmark import generate_ivms_users, generate_members, generate_raw_members  # noqa: E402
+from integration import MockCardskipper, MockDatabase, MockIVMS  # noqa: E402
+
+
+class Site:
+    """Cardskipper, IVMS and database mocks of one site, backed by SQLite files in a temporary directory."""
+    def __init__(self, workdir, member_count, stale_validity=False):
+        self.members = generate_members(member_count)
+        self.cardskipper = MockCardskipper(os.path.join(workdir, "cardskipper.json"), storage="sqlite")
+        self.cardskipper.store.replace(generate_raw_members(member_count))
+
+        users = generate_ivms_users(self.members)
+        if stale_validity:
+            # Every member needs a write to reach the device
+            for user in users:
+                user["Valid"]["endTime"] = "2026-01-01T00:00:00"
+        self.ivms = MockIVMS(os.path.join(workdir, "ivms.json"), storage="sqlite")
+        self.ivms.store.replace(users)
+        self.db = MockDatabase(os.path.join(workdir, "integration.db"))
+
+    def end_time(self, employee_no):
+        return self.ivms.store.get(employee_no)["Valid"]["endTime"]
+
+    def close(self):
+        self.cardskipper.close()
+        self.ivms.close()
+        self.db.close()
+
+
+@pytest.fixture
+def make_site(tmp_path):
+    sites = []
+
+    def make(member_count=20, stale_validity=False):
+        workdir = tmp_path / f"site{len(sites)}"
+        workdir.mkdir()
+        site = Site(str(workdir), member_count, stale_validity)
+        sites.append(site)
+        return site
+
+    yield make
+    for site in sites:
+        site.close()
@@ -0,0 +1,53 @@
+import pytest
+
+from backfill import Backfill
+from integration import MockSyncService
+
+
+def test_interrupted_backfill_resumes_after_the_last_saved_chunk(make_site):
+    site = make_site(100, stale_validity=True)
+    service = MockSyncService(site.cardskipper, site.ivms, site.db)
+    push_updates = service.router.push_updates
+    calls = []
+
+    def crash_on_third_chunk(updates):
+        calls.append(len(updates))
+        if len(calls) == 3:
+            raise RuntimeError("simulated crash")
+        return push_updates(updates)
+
+    service.router.push_updates = crash_on_third_chunk
+    with pytest.raises(RuntimeError):
+        Backfill(service, chunk_size=20, workers=1).run()
+
+    # Only the chunks that reached IVMS were saved
+    assert len(site.db.get_all_members()) == 40
+
+    service.router.push_updates = push_updates
+    summary = Backfill(service, chunk_size=20, workers=1).run()
+
+    assert summary["finished"] and summary["chunks_done"] == 5
+    assert summary["pushed"] == 60
+    assert len(site.db.get_all_members()) == 100
+    assert all(site.end_time(f"{i:08d}") == member["end_date"] for i, member in enumerate(site.members))
+    service.close()
+
+
+def test_interrupt_stops_handing_out_chunks(make_site):
+    site = make_site(100, stale_validity=True)
+    service = MockSyncService(site.cardskipper, site.ivms, site.db)
+
+    def interrupt(summary):
+        # Ctrl-C reaches run() through the chunk that was running
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        Backfill(service, chunk_size=20, workers=2).run(progress=interrupt)
+
+    # Only the chunks already running when the interrupt came were saved
+    assert len(site.db.get_all_members()) <= 40
+
+    summary = Backfill(service, chunk_size=20, workers=2).run()
+    assert summary["finished"]
+    assert len(site.db.get_all_members()) == 100
+    service.close()
@@ -0,0 +1,110 @@
+import io
+import re
+from datetime import datetime, timedelta
+
+from cardskipper_client import DATE_FORMAT, CardskipperClient, iter_members_xml
+from cardskipper_server import generate_members
+from integration import MockSyncService
+from orchestrator import OrganisationView, SitePipeline
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.raw = io.BytesIO(body)
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Serves /Member/Export/ pages like the stand-in, capped at max_page_size."""
+    def __init__(self, members, max_page_size):
+        self.members = [xml for _, xml in members]
+        self.max_page_size = max_page_size
+        self.pages_served = 0
+
+    def request(self, method, url, data=None, **kwargs):
+        criteria = dict(re.findall(r"<(Page|PageSize)>(\d+)<", data.decode("utf-8")))
+        page_size = min(int(criteria["PageSize"]), self.max_page_size)
+        start = (int(criteria["Page"]) - 1) * page_size
+        members = self.members[start:start + page_size]
+        self.pages_served += 1
+        return FakeResponse(("<ArrayOfMember>" + "".join(members) + "</ArrayOfMember>").encode("utf-8"))
+
+
+def test_pages_capped_by_the_server_are_all_read():
+    members = generate_members(230, expired_share=0)
+    client = CardskipperClient("http://standin", "admin", "admin", organisation_id=123, page_size=100)
+    client._session = FakeSession(members, max_page_size=50)
+
+    emails = [member["email"] for member in client.iter_active_members()]
+
+    assert len(emails) == 230 and len(set(emails)) == 230
+    assert client._session.pages_served == 5
+
+
+def test_full_last_page_is_followed_by_an_empty_one():
+    members = generate_members(200, expired_share=0)
+    client = CardskipperClient("http://standin", "admin", "admin", organisation_id=123, page_size=100)
+    client._session = FakeSession(members, max_page_size=100)
+
+    assert len(client.get_active_members()) == 200
+    assert client._session.pages_served == 3
+
+
+def test_client_serves_a_pipeline_through_incremental_cycles(make_site):
+    site = make_site(20)
+    client = CardskipperClient("http://standin", "admin", "admin", organisation_id=123, page_size=100)
+    client._session = FakeSession(generate_members(20, expired_share=0), max_page_size=100)
+    service = MockSyncService(OrganisationView(client, "123"), site.ivms, site.db)
+    pipeline = SitePipeline("123", "main", service)
+
+    first = pipeline.run_cycle()
+    second = pipeline.run_cycle()
+
+    assert first["full"] and first["succeeded"] and first["members"] == 20
+    # The client cannot filter on modified_since and returns every member
+    assert not second["full"] and second["succeeded"] and second["members"] == 20
+    assert second["updates_needed"] == 0
+    service.close()
+
+
+def member_xml(*roles):
+    role_xml = "".join(
+        f"<Role><Id>{number}</Id><Name>Role {number}</Name>"
+        f"<StartDate>{start.strftime(DATE_FORMAT)}</StartDate><EndDate>{end.strftime(DATE_FORMAT)}</EndDate></Role>"
+        for number, (start, end) in enumerate(roles, 1)
+    )
+    return (
+        "<ArrayOfMember><Member><OrganisationMemberId>1</OrganisationMemberId>"
+        "<Firstname>Ana</Firstname><Lastname>Novak</Lastname><MemberCode>a1</MemberCode>"
+        "<ContactInfo><EMail>ana@example.com</EMail><CellPhone1>+38640000000</CellPhone1></ContactInfo>"
+        f"<Organisations><Organisation><Id>123</Id><Roles>{role_xml}</Roles></Organisation></Organisations>"
+        "</Member></ArrayOfMember>"
+    ).encode("utf-8")
+
+
+def test_back_to_back_roles_are_one_window():
+    now = datetime(2026, 6, 1)
+    current = (now - timedelta(days=20), now + timedelta(days=10))
+    renewal = (current[1] + timedelta(seconds=1), now + timedelta(days=100))
+
+    [member] = iter_members_xml(io.BytesIO(member_xml(current, renewal)), now.strftime(DATE_FORMAT))
+
+    # The renewal extends the current membership; it does not move its start
+    assert member["start_date"] == current[0].strftime(DATE_FORMAT)
+    assert member["end_date"] == renewal[1].strftime(DATE_FORMAT)
+    assert member["role_id"] == "2"
+
+
+def test_role_after_a_pause_does_not_replace_the_current_one():
+    now = datetime(2026, 6, 1)
+    current = (now - timedelta(days=20), now + timedelta(days=10))
+    later = (now + timedelta(days=40), now + timedelta(days=100))
+
+    [member] = iter_members_xml(io.BytesIO(member_xml(later, current)), now.strftime(DATE_FORMAT))
+
+    assert (member["start_date"], member["end_date"]) == tuple(d.strftime(DATE_FORMAT) for d in current)
+    assert member["role_id"] == "2"
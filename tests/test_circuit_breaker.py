@@ -0,0 +1,49 @@
+import time
+
+from circuit_breaker import DeviceRouter
+
+NEW_END = "2030-01-01T00:00:00"
+
+
+def fill_backlog(site, device_id="ivms-1"):
+    for index, member in enumerate(site.members):
+        site.db.enqueue_backlog(device_id, {
+            "email": member["email"],
+            "ivms_employee_no": f"{index:08d}",
+            "start_date": member["start_date"],
+            "end_date": NEW_END,
+        })
+
+
+def test_recover_stops_for_now_when_device_is_busy(make_site):
+    site = make_site(300)
+    fill_backlog(site)
+    site.ivms.max_users_per_second = 50
+    router = DeviceRouter([site.ivms], site.db)
+
+    drained = router.recover()
+    assert drained + len(site.db.get_backlog("ivms-1")) == 300
+
+    # Later calls carry on where the busy device stopped the replay
+    deadline = time.monotonic() + 60
+    while site.db.get_backlog("ivms-1") and time.monotonic() < deadline:
+        time.sleep(0.2)
+        router.recover()
+
+    assert site.db.get_backlog("ivms-1") == []
+    assert all(site.end_time(f"{index:08d}") == NEW_END for index in range(300))
+
+
+def test_recover_keeps_backlog_of_offline_device(make_site):
+    site = make_site(30)
+    fill_backlog(site)
+    site.ivms.online = False
+    router = DeviceRouter([site.ivms], site.db, failure_threshold=1)
+
+    assert router.recover() == 0
+    assert len(site.db.get_backlog("ivms-1")) == 30
+
+    site.ivms.online = True
+    router.breakers["ivms-1"].reset_timeout = 0
+    assert router.recover() == 30
+    assert site.db.get_backlog("ivms-1") == []
@@ -0,0 +1,76 @@
+from coalesce import WriteCoalescer
+from integration import MockDatabase, MockSyncService
+
+NEW_END = "2030-01-01T00:00:00"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def update(employee_no, end_date):
+    return {"email": f"{employee_no}@example.com", "ivms_employee_no": employee_no,
+            "start_date": "2026-01-01T00:00:00", "end_date": end_date}
+
+
+def test_changes_within_the_window_become_one_write():
+    clock = FakeClock()
+    coalescer = WriteCoalescer(10, clock)
+    for end_date in ("2030-01-01T00:00:00", "2030-02-01T00:00:00", "2030-03-01T00:00:00"):
+        coalescer.offer(update("1", end_date))
+        clock.now += 1
+
+    assert coalescer.take_due() == []
+    clock.now = 10
+    assert coalescer.take_due() == [update("1", "2030-03-01T00:00:00")]
+    assert coalescer.coalesced == 2
+    assert len(coalescer) == 0
+
+
+def test_drain_returns_everything_in_due_order():
+    clock = FakeClock()
+    coalescer = WriteCoalescer(10, clock)
+    coalescer.offer(update("2", NEW_END))
+    clock.now = 1
+    coalescer.offer(update("1", NEW_END))
+
+    assert [u["ivms_employee_no"] for u in coalescer.drain()] == ["2", "1"]
+    assert len(coalescer) == 0
+    assert coalescer.seconds_until_due() is None
+
+
+def test_close_pushes_waiting_updates(make_site):
+    site = make_site(5)
+    service = MockSyncService(site.cardskipper, site.ivms, site.db, coalesce_window_seconds=60)
+    service.sync()
+    site.cardskipper.store.set_end_date(site.members[2]["email"], NEW_END)
+    service.sync()
+    assert site.end_time("00000002") != NEW_END
+
+    service.close()
+    assert site.end_time("00000002") == NEW_END
+    assert site.db.get_pending_writes() == []
+
+
+def test_waiting_updates_survive_a_crash(make_site):
+    site = make_site(5)
+    service = MockSyncService(site.cardskipper, site.ivms, site.db, coalesce_window_seconds=60)
+    service.sync()
+    site.cardskipper.store.set_end_date(site.members[2]["email"], NEW_END)
+    service.sync()
+
+    # The process dies within the window; the stored end dates already
+    # match Cardskipper, so no later cycle would plan the update again
+    db = MockDatabase(site.db.db_path)
+    restarted = MockSyncService(site.cardskipper, site.ivms, db, coalesce_window_seconds=60)
+    assert restarted.sync()["updates_needed"] == 0
+    assert len(restarted.coalescer) == 5
+
+    restarted.close()
+    assert site.end_time("00000002") == NEW_END
+    assert db.get_pending_writes() == []
+    db.close()
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from expiry import ExpiryIndex
+
+
+def test_member_linked_later_can_be_rescheduled_at_the_same_time():
+    index = ExpiryIndex.from_rows([("a@example.com", "2030-01-01T00:00:00", None)])
+    # First seen unmatched, then linked to an IVMS user with the same end date
+    index.schedule("a@example.com", "2030-01-01T00:00:00", "00000001")
+
+    assert index.pop_due(datetime(2030, 1, 2)) == [("a@example.com", datetime(2030, 1, 1), "00000001")]
+    assert len(index) == 0
+
+
+def test_rescheduled_expiry_replaces_the_old_one():
+    index = ExpiryIndex()
+    index.schedule("a@example.com", "2030-01-01T00:00:00", "1")
+    index.schedule("b@example.com", "2030-01-02T00:00:00", "2")
+    index.schedule("a@example.com", "2030-01-03T00:00:00", "1")
+
+    assert index.next_expiry() == datetime(2030, 1, 2)
+    assert [email for email, _, _ in index.pop_due(datetime(2030, 1, 4))] == ["b@example.com", "a@example.com"]
@@ -0,0 +1,46 @@
+from ivms_paging import iter_user_pages
+
+
+class CappedDevice:
+    """UserInfo/search that serves at most cap users per page, like many controllers."""
+    def __init__(self, count, cap, short_at=()):
+        self.users = [{"employeeNo": f"{i:08d}"} for i in range(count)]
+        self.cap = cap
+        # Positions at which the page comes back a few users short
+        self.short_at = set(short_at)
+        self.requests = []
+
+    def search(self, search_id, position, max_results):
+        self.requests.append((position, max_results))
+        served = min(max_results, self.cap)
+        if position in self.short_at:
+            served -= 7
+        page = self.users[position:position + served]
+        return {
+            "searchID": search_id,
+            "responseStatusStrg": "MORE" if position + len(page) < len(self.users) else "OK",
+            "numOfMatches": len(page),
+            "totalMatches": len(self.users),
+            "UserInfo": page,
+        }
+
+
+def employee_numbers(pages):
+    return [user["employeeNo"] for page in pages for user in page]
+
+
+def test_pages_capped_by_the_device_are_all_read():
+    device = CappedDevice(250, cap=30)
+
+    numbers = employee_numbers(iter_user_pages(device.search, page_size=100))
+
+    assert numbers == [f"{i:08d}" for i in range(250)]
+    assert len(device.requests) == 9
+
+
+def test_short_pages_are_filled_in_before_moving_on():
+    device = CappedDevice(250, cap=30, short_at=(60, 150))
+
+    numbers = employee_numbers(iter_user_pages(device.search, page_size=100, max_in_flight=2))
+
+    assert numbers == [f"{i:08d}" for i in range(250)]
@@ -0,0 +1,81 @@
+import sqlite3
+
+from benchmark import generate_ivms_users
+from integration import MockSyncService
+from matching import PHONE_CONFIDENCE, IdentityMatcher, Match, ensure_review_schema, save_reviews
+
+
+def user(employee_no, name, email="", phone=""):
+    return {"employeeNo": employee_no, "name": name, "email": email, "phoneNo": phone}
+
+
+def member(first_name, last_name, email="", phone=""):
+    return {"first_name": first_name, "last_name": last_name, "email": email, "phone": phone}
+
+
+MATCHER_USERS = [
+    user("1", "Luka Starcevic", "luka@example.com", "+386 70 111 222"),
+    user("2", "Maja Novak", phone="+386 70 333 444"),
+    user("3", "Ana Kovac"),
+]
+
+
+def test_email_and_phone_with_agreeing_name_are_linked():
+    matcher = IdentityMatcher(MATCHER_USERS)
+
+    by_email = matcher.match(member("Luka", "Starčević", " LUKA@example.com "))
+    assert (by_email.employee_no, by_email.method, by_email.needs_review) == ("1", "email", False)
+
+    by_phone = matcher.match(member("Luka", "Starčević", phone="070 111 222"))
+    assert (by_phone.method, by_phone.needs_review) == ("phone+name", False)
+
+
+def test_phone_with_another_name_needs_review():
+    # A family sharing one phone number
+    match = IdentityMatcher(MATCHER_USERS).match(member("Tine", "Novak", phone="070 333 444"))
+    assert (match.employee_no, match.method, match.needs_review) == ("2", "phone", True)
+
+
+def test_name_only_matches_need_review():
+    matcher = IdentityMatcher(MATCHER_USERS)
+    assert matcher.match(member("Ana", "Kovač")).needs_review
+    assert matcher.match(member("Anaa", "Kovac")).needs_review
+
+
+def test_weak_match_is_queued_until_approved(make_site):
+    site = make_site(3)
+    users = generate_ivms_users(site.members)
+    # Only the phone number still points at member 0's IVMS user
+    users[0].update(email="someone.else@example.com", name="Someone Else")
+    users[0]["Valid"]["endTime"] = "2026-01-01T00:00:00"
+    site.ivms.store.replace(users)
+    service = MockSyncService(site.cardskipper, site.ivms, site.db)
+
+    summary = service.sync()
+    email = site.members[0]["email"]
+    assert summary["matches_to_review"] == 1
+    assert site.db.get_all_members()[email]["ivms_employee_no"] is None
+    assert [r["employee_no"] for r in site.db.get_match_reviews()] == ["00000000"]
+    assert site.end_time("00000000") == "2026-01-01T00:00:00"
+
+    assert site.db.approve_match(email)
+    service.sync()
+    assert site.db.get_all_members()[email]["ivms_employee_no"] == "00000000"
+    assert site.end_time("00000000") == site.members[0]["end_date"]
+    assert site.db.get_match_reviews() == []
+    service.close()
+
+
+def test_review_decision_is_kept_while_the_candidate_stays():
+    conn = sqlite3.connect(":memory:")
+    ensure_review_schema(conn)
+    ana = member("Ana", "Novak", "ana@example.com")
+    save_reviews(conn, [(ana, Match("00000001", "phone", PHONE_CONFIDENCE))])
+    conn.execute("UPDATE match_review SET status = 'rejected'")
+
+    save_reviews(conn, [(ana, Match("00000001", "phone", PHONE_CONFIDENCE))])
+    assert conn.execute("SELECT status FROM match_review").fetchone() == ("rejected",)
+
+    # A new candidate needs a new decision
+    save_reviews(conn, [(ana, Match("00000002", "phone", PHONE_CONFIDENCE))])
+    assert conn.execute("SELECT employee_no, status FROM match_review").fetchone() == ("00000002", "pending")
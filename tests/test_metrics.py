@@ -0,0 +1,30 @@
+import threading
+
+from metrics import Counter, Histogram, Registry
+
+
+def hammer(function, threads=8, calls=20000):
+    def work():
+        for _ in range(calls):
+            function()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * calls
+
+
+def test_concurrent_updates_are_not_lost():
+    registry = Registry()
+    counter = Counter("test_total", "Test counter", registry=registry)
+    histogram = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0), registry=registry)
+
+    total = hammer(lambda: (counter.inc(), histogram.observe(0.5)))
+
+    assert counter.value == total
+    counts, observed_sum, count = histogram.snapshot()
+    assert count == sum(counts) == total
+    assert observed_sum == total * 0.5
+    assert f"test_seconds_count {total}" in registry.render()
@@ -0,0 +1,52 @@
+import json
+
+from benchmark import generate_raw_members
+from mock_storage import JsonMemberStore, SqliteUserStore
+
+NEW_END = "2030-01-01T00:00:00"
+
+
+def test_json_member_store_streams_again_after_a_change(tmp_path):
+    data_file = str(tmp_path / "members.json")
+    store = JsonMemberStore(data_file)
+    store.replace(generate_raw_members(5))
+
+    assert store.find_by_email("member1@example.com")["Firstname"] == "First1"
+    assert store.set_end_date("member1@example.com", NEW_END)
+    assert store._members is None
+
+    # A change made to the file by something else is seen on the next read
+    with open(data_file) as f:
+        members = json.load(f)["members"]
+    members.append(generate_raw_members(6)[5])
+    with open(data_file, "w") as f:
+        json.dump({"members": members}, f)
+
+    emails = [member["ContactInfo"]["EMail"] for member in store.iter_members()]
+    assert emails == [f"member{i}@example.com" for i in range(6)]
+    member = store.find_by_email("member1@example.com")
+    assert member["Organisations"]["Organisation"]["Roles"]["Role"]["EndDate"] == NEW_END
+
+
+def users(count, prefix="user"):
+    return [{"employeeNo": f"{prefix}{i:04d}", "Valid": {"enable": True}} for i in range(count)]
+
+
+def numbers(page):
+    return [user["employeeNo"] for user in page]
+
+
+def test_sqlite_user_pages_follow_their_own_search(tmp_path):
+    store = SqliteUserStore(str(tmp_path / "users.db"))
+    store.replace(users(10))
+
+    assert numbers(store.page(0, 4, "a")) == [f"user{i:04d}" for i in range(4)]
+    assert numbers(store.page(0, 3, "b")) == [f"user{i:04d}" for i in range(3)]
+    assert numbers(store.page(4, 4, "a")) == [f"user{i:04d}" for i in range(4, 8)]
+    assert numbers(store.page(3, 3, "b")) == [f"user{i:04d}" for i in range(3, 6)]
+
+    # A search that continues after the users were replaced reads the new ones
+    store.replace(users(10, prefix="new"))
+    assert store._continuations == {}
+    assert numbers(store.page(8, 4, "a")) == ["new0008", "new0009"]
+    store.close()
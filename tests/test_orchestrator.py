@@ -0,0 +1,120 @@
+import threading
+import time
+
+from integration import MockSyncService
+from orchestrator import OrganisationView, SitePipeline, SyncOrchestrator, default_sites
+
+
+class FakePipeline:
+    """Pipeline whose cycles take a fixed time and record how many ran at once."""
+    def __init__(self, name, cycle_seconds, interval_seconds):
+        self.name = name
+        self.cycle_seconds = cycle_seconds
+        self.interval_seconds = interval_seconds
+        self.vruntime = 0.0
+        self.cycles = 0
+        self.next_due = time.monotonic()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def run_cycle(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.cycle_seconds)
+        with self.lock:
+            self.active -= 1
+        return {"members": 0, "updates_pushed": 0, "updates_queued": 0}
+
+    def timers_due_at(self):
+        return None
+
+    def run_timers(self):
+        pass
+
+
+def test_running_pipeline_is_not_submitted_again():
+    big = FakePipeline("big", cycle_seconds=0.5, interval_seconds=0)
+    small = FakePipeline("small", cycle_seconds=0.01, interval_seconds=0.02)
+
+    SyncOrchestrator([big, small], max_workers=4).run(duration=1.2)
+
+    # The small site's wake-ups must not start more cycles of the big one
+    assert big.max_active == 1
+    assert small.max_active == 1
+    assert small.cycles > 10
+
+
+def test_cycles_after_the_first_compare_only_changed_members(make_site):
+    site = make_site(20)
+    service = MockSyncService(OrganisationView(site.cardskipper, "123"), site.ivms, site.db)
+    pipeline = SitePipeline("123", "main", service)
+
+    first = pipeline.run_cycle()
+    assert first["full"] and first["members"] == 20
+
+    # Everything in the store predates the watermark except the renewal below
+    site.cardskipper.store.writer.execute("UPDATE members SET modified_at = '2000-01-01T00:00:00'")
+    site.cardskipper.store.set_end_date(site.members[3]["email"], "2030-01-01T00:00:00")
+
+    second = pipeline.run_cycle()
+    assert not second["full"] and second["members"] == 1
+    assert site.end_time("00000003") == "2030-01-01T00:00:00"
+    service.close()
+
+
+def test_coalesced_writes_fire_between_cycles(make_site):
+    site = make_site(5)
+    service = MockSyncService(OrganisationView(site.cardskipper, "123"), site.ivms, site.db,
+                              coalesce_window_seconds=0.2)
+    pipeline = SitePipeline("123", "main", service, interval_seconds=60)
+    pipeline.run_cycle()
+
+    site.cardskipper.store.set_end_date(site.members[1]["email"], "2030-01-01T00:00:00")
+    pipeline.next_due = time.monotonic()
+    SyncOrchestrator([pipeline], max_workers=2).run(duration=1.0)
+
+    # Written by the timer, not by a later cycle or the drain on close
+    assert pipeline.cycles == 1
+    assert site.end_time("00000001") == "2030-01-01T00:00:00"
+    service.close()
+
+
+def test_unmatched_member_does_not_force_full_cycles(make_site):
+    site = make_site(20)
+    users = site.ivms.store.all_users()
+    site.ivms.store.replace([user for user in users if user["employeeNo"] != "00000005"])
+    service = MockSyncService(OrganisationView(site.cardskipper, "123"), site.ivms, site.db)
+    pipeline = SitePipeline("123", "main", service)
+
+    assert pipeline.run_cycle()["full"]
+    assert service.unmatched_count == 1
+    site.cardskipper.store.writer.execute("UPDATE members SET modified_at = '2000-01-01T00:00:00'")
+
+    second = pipeline.run_cycle()
+    assert not second["full"] and second["members"] == 0
+    assert site.db.get_ivms_employee_no(site.members[5]["email"]) is None
+
+    # The member is retried on its own once the mirror is refreshed
+    site.ivms.store.replace(users)
+    site.db.set_state("ivms_mirror_refreshed_at", "2000-01-01T00:00:00")
+    third = pipeline.run_cycle()
+    assert not third["full"] and third["members"] == 1
+    assert site.db.get_ivms_employee_no(site.members[5]["email"]) == "00000005"
+    assert service.unmatched_count == 0
+    service.close()
+
+
+def test_default_sites_reads_organisations_in_either_shape():
+    class Members:
+        def iter_members(self):
+            return [
+                {"Organisations": {"Organisation": {"Id": 123, "Roles": {"Role": {"Id": 1}}}}},
+                {"Organisations": {"Organisation": [
+                    {"Id": 123, "Roles": {"Role": {"Id": 1}}},
+                    {"Id": 456, "Roles": {"Role": [{"Id": 2}, {"Id": 3}]}},
+                ]}},
+            ]
+
+    assert [site["organisation_id"] for site in default_sites(Members())] == ["123", "456"]
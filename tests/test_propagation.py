@@ -0,0 +1,39 @@
+import sqlite3
+
+import propagation
+
+HOUR_MS = 3600 * 1000
+
+
+def history_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""
+        CREATE TABLE sync_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            cardskipper_id TEXT NOT NULL,
+            ivms_id TEXT,
+            previous_end_date TEXT,
+            new_end_date TEXT,
+            sync_status TEXT,
+            sync_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return conn
+
+
+def test_unmatched_members_are_not_reported_as_breaching():
+    conn = history_db()
+    detected_ms = propagation.now_ms() - HOUR_MS
+    conn.execute("ALTER TABLE sync_history ADD COLUMN detected_ms INTEGER")
+    conn.executemany(
+        "INSERT INTO sync_history (email, cardskipper_id, ivms_id, new_end_date, sync_status, detected_ms) "
+        "VALUES (?, ?, ?, '2030-01-01T00:00:00', ?, ?)",
+        [("a@example.com", "1", "00000001", "Success", detected_ms),
+         ("b@example.com", "2", "Not matched", "New member", detected_ms)]
+    )
+
+    # Rows recorded for unmatched members before are closed on startup
+    propagation.ensure_schema(conn)
+
+    assert [row["email"] for row in propagation.breaching(conn.cursor())] == ["a@example.com"]
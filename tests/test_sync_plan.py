@@ -0,0 +1,25 @@
+from collections import Counter
+
+from integration import MockSyncService
+from matching import Match
+from sync_plan import shard_for
+
+
+def test_user_linked_in_another_shard_is_not_claimed_again(make_site):
+    site = make_site(20)
+    # A member linked earlier by phone to the IVMS user whose email belongs
+    # to a member of the other shard
+    linked, other = next(
+        (a, b) for a in range(20) for b in range(20)
+        if shard_for(site.members[a]["email"], 2) != shard_for(site.members[b]["email"], 2)
+    )
+    site.db.update_members([(site.members[linked], f"{other:08d}", Match(f"{other:08d}", "phone", 0.95))])
+
+    service = MockSyncService(site.cardskipper, site.ivms, site.db, shards=2)
+    summary = service.sync()
+    service.close()
+
+    assert summary["succeeded"]
+    assert site.db.get_ivms_employee_no(site.members[other]["email"]) != f"{other:08d}"
+    linked_numbers = Counter(m["ivms_employee_no"] for m in site.db.get_all_members().values() if m["ivms_employee_no"])
+    assert all(count == 1 for count in linked_numbers.values())